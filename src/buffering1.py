@@ -1,9 +1,9 @@
 import os
-import sys
 import pathlib
 import tempfile
 import pyfastcgi
 import pyfastcgi.listener
+import pyfastcgi.log as log
 import pyfastcgi.responders.buffering as buffering
 
 
@@ -42,7 +42,7 @@ class Responder(buffering.BufferingResponder):
         cotype = 'text/plain'
 
         with self.open_stdin() as mem:
-            print(f'{len(mem)=}', file=sys.stderr)
+            log.app.debug('len(mem)=%d', len(mem))
 
             if len(mem) > 1024:
                 cobody = f'{len(mem)}'
@@ -56,7 +56,7 @@ class Responder(buffering.BufferingResponder):
         return cotype, cobody
 
     def make_response(self):
-        print(f'{__file__}: {os.getpid()=} from {self.client=}', file=sys.stderr)
+        log.app.debug('%s: from %s', __file__, self.client)
         #pprint.pprint(params)
 
         if self.params['REQUEST_METHOD'] == 'GET':
@@ -78,10 +78,10 @@ class Responder(buffering.BufferingResponder):
 
 
 def event_handler(context:pyfastcgi.Context, event:pyfastcgi.Event):
-    print(f'{__file__}: {event.name=} {type(event.data)=}', file=sys.stderr)
+    log.app.debug('%s: event.name=%s %s', __file__, event.name, type(event.data))
 
     if event.name == 'IDLE':
-        print(f'{__file__}: {context.stats=}', file=sys.stderr)
+        log.app.debug('%s: context.stats=%s', __file__, context.stats)
 
 
 if __name__ == '__main__':
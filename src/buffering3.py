@@ -1,10 +1,10 @@
 import os
-import sys
 import pathlib
 import socket
 import collections
 import pyfastcgi
 import pyfastcgi.listener
+import pyfastcgi.log as log
 import pyfastcgi.responders
 import pyfastcgi.responders.buffering as buffering
 
@@ -41,7 +41,7 @@ class PostResponder(buffering.BufferingResponder):
 
 
 def ResponderSelector(context:pyfastcgi.Context, conn:socket.socket, client:tuple, reqid:int, params:collections.Mapping):
-    print(f'{__file__}: {os.getpid()=} from {client=}', file=sys.stderr)
+    log.app.debug('%s: from %s', __file__, client)
 
     if params['REQUEST_METHOD'] == 'GET':
         requri = params['REQUEST_URI']
@@ -0,0 +1,547 @@
+import os
+import sys
+import argparse
+import dataclasses
+import gc
+import json
+import pathlib
+import platform
+import socket
+import tempfile
+import time
+import tracemalloc
+import pyfastcgi
+import pyfastcgi.protocol as protocol
+import pyfastcgi.responders.streaming as streaming
+from dataclasses import dataclass
+
+
+'''
+protocol (codec) のマイクロベンチマーク
+
+    protocol.read_record, protocol.make_params, protocol.send_record,
+    pyfastcgi.send_record, _ChunkedTransferStream.write
+
+をメモリ上の socket 代替と socketpair で、データの大きさや params の数を変えて実行し、
+操作毎に以下を記録する
+
+    ns_op           ... 処理時間 (ナノ秒, --repeat 回のうち最小)
+    alloc_peak      ... tracemalloc による一時的な確保の最大 (バイト)
+    alloc_retained  ... 実行後も解放されない確保 (バイト / 操作)
+    syscalls        ... socket のメソッド (recv_into, send, sendall) の呼び出し回数 / 操作
+                        (ブロッキングの socket ではシステムコールの回数とほぼ同じ)
+
+    # 実行して基準と比較する (回帰があれば終了コード 1)
+    python codec-bench.py --baseline=bench/codec-baseline.json
+
+    # 最適化の後などに基準を更新する
+    python codec-bench.py --save-baseline=bench/codec-baseline.json
+
+* ns_op はマシンに依存するので、基準と環境 (host) が異なる場合は警告して
+  確保とシステムコールの回数のみを比較する
+'''
+
+BENCH_VERSION = 1
+
+# 一回の計測の最小時間 (これを超えるまで回数を倍にする)
+MIN_MEASURE_NS = 50_000_000
+
+ALLOC_ITERATIONS = 64
+
+# 回帰とみなす基準からの増加率
+DEFAULT_TIME_THRESHOLD = 0.25
+DEFAULT_ALLOC_THRESHOLD = 0.10
+
+# 割当の増加がこの値以下であれば、増加率にかかわらず無視する (バイト)
+ALLOC_SLACK = 256
+
+
+@dataclass
+class CallCounter:
+    calls:int = 0
+
+
+@dataclass
+class NullSocket:
+    '''
+    送信を捨てる socket 代替
+    '''
+    counter:CallCounter = dataclasses.field(default_factory=CallCounter)
+    nbytes:int = 0
+
+    def getblocking(self) -> bool:
+        return True
+
+    def sendall(self, data):
+        self.counter.calls += 1
+        self.nbytes += len(data)
+
+
+@dataclass
+class LoopReader:
+    '''
+    {data} を繰り返し受信する socket 代替
+    '''
+    data:bytes
+    counter:CallCounter = dataclasses.field(default_factory=CallCounter)
+    pos:int = 0
+
+    def getblocking(self) -> bool:
+        return True
+
+    def recv_into(self, buff, nbytes:int=0, flags:int=0) -> int:
+        self.counter.calls += 1
+
+        nbytes = min(nbytes or len(buff), len(self.data) - self.pos)
+        buff[:nbytes] = self.data[self.pos:self.pos+nbytes]
+
+        self.pos = (self.pos + nbytes) % len(self.data)
+
+        return nbytes
+
+
+@dataclass
+class CountingSocket:
+    '''
+    socket のメソッドの呼び出し回数を数える
+    '''
+    sock:socket.socket
+    counter:CallCounter = dataclasses.field(default_factory=CallCounter)
+
+    def getblocking(self) -> bool:
+        return self.sock.getblocking()
+
+    def recv_into(self, buff, nbytes:int=0, flags:int=0) -> int:
+        self.counter.calls += 1
+        return self.sock.recv_into(buff, nbytes, flags)
+
+    def sendall(self, data, flags:int=0):
+        self.counter.calls += 1
+        return self.sock.sendall(data, flags)
+
+
+'''
+計測する操作
+
+prepare(n) で n 回分の準備 (計測しない) をして、run(n) の時間を計測する
+'''
+@dataclass
+class Case:
+    name:str
+    counter:CallCounter = dataclasses.field(init=False, default_factory=CallCounter)
+
+    def prepare(self, n:int):
+        ...
+
+    def run(self, n:int):
+        raise NotImplementedError()
+
+    def close(self):
+        ...
+
+
+def record_bytes(recordType:int, size:int) -> bytes:
+    return protocol.make_record(recordType, 1, contentData=os.urandom(size)).dump()
+
+
+def make_param_data(count:int, value_len:int) -> bytes:
+    return protocol.dump_params({ f'HTTP_X_BENCH_{n:03d}': 'v' * value_len for n in range(count) })
+
+
+@dataclass
+class ReadRecordMemory(Case):
+    size:int = 0
+
+    def __post_init__(self):
+        self.sock = LoopReader(record_bytes(protocol.FCGI_STDIN, self.size), self.counter)
+
+    def run(self, n:int):
+        read_record = protocol.read_record
+        sock = self.sock
+
+        for _ in range(n):
+            read_record(sock)
+
+
+@dataclass
+class ReadRecordSocketpair(Case):
+    '''
+    送信側の sendall を含む (socket のバッファに収まる数ずつ送信して受信する)
+    '''
+    size:int = 0
+
+    def __post_init__(self):
+        self.wsock, rsock = socket.socketpair()
+        self.rsock = CountingSocket(rsock, self.counter)
+        self.data = record_bytes(protocol.FCGI_STDIN, self.size)
+        self.batch = max(1, 65536 // len(self.data))
+
+    def run(self, n:int):
+        read_record = protocol.read_record
+
+        while n > 0:
+            k = min(n, self.batch)
+            self.wsock.sendall(self.data * k)
+
+            for _ in range(k):
+                read_record(self.rsock)
+
+            n -= k
+
+    def close(self):
+        self.wsock.close()
+        self.rsock.sock.close()
+
+
+@dataclass
+class MakeParams(Case):
+    '''
+    make_params() は受け取った領域を書き換えるので、複製を準備しておく
+    '''
+    count:int = 0
+    value_len:int = 0
+
+    def __post_init__(self):
+        self.data = make_param_data(self.count, self.value_len)
+        self.prepared = []
+
+    def prepare(self, n:int):
+        self.prepared = [ bytearray(self.data) for _ in range(n) ]
+
+    def run(self, n:int):
+        make_params = protocol.make_params
+
+        for buff in self.prepared:
+            make_params(memoryview(buff))
+
+
+@dataclass
+class SendRecordMemory(Case):
+    size:int = 0
+
+    def __post_init__(self):
+        self.sock = NullSocket(self.counter)
+        self.data = os.urandom(self.size)
+
+    def run(self, n:int):
+        send_record = protocol.send_record
+        sock = self.sock
+        data = self.data
+
+        for _ in range(n):
+            send_record(sock, protocol.FCGI_STDOUT, 1, contentData=data)
+
+
+@dataclass
+class SendRecordSocketpair(Case):
+    '''
+    受信側で読み捨てる時間を含む
+    '''
+    size:int = 0
+
+    def __post_init__(self):
+        wsock, self.rsock = socket.socketpair()
+        self.wsock = CountingSocket(wsock, self.counter)
+        self.data = os.urandom(self.size)
+        self.buff = bytearray(1 << 20)
+
+    def run(self, n:int):
+        send_record = protocol.send_record
+
+        for _ in range(n):
+            nsend = send_record(self.wsock, protocol.FCGI_STDOUT, 1, contentData=self.data)
+
+            while nsend > 0:
+                nsend -= self.rsock.recv_into(self.buff)
+
+    def close(self):
+        self.wsock.sock.close()
+        self.rsock.close()
+
+
+@dataclass
+class SendResponse(Case):
+    '''
+    pyfastcgi.send_record() (Response, str, ファイル)
+    '''
+    kind:str = 'bytes'
+    size:int = 0
+
+    def __post_init__(self):
+        self.sock = NullSocket(self.counter)
+        self.path = None
+
+        if self.kind == 'path':
+            with tempfile.NamedTemporaryFile('wb', delete=False, prefix='pyfastcgi-bench-', suffix='.tmp') as f:
+                f.write(os.urandom(self.size))
+
+            self.path = f.name
+
+    def make_data(self):
+        headers = { pyfastcgi.CONST_STATUS: '200 OK', pyfastcgi.CONST_CONTENT_TYPE: 'text/plain' }
+
+        if self.kind == 'str':
+            return 'x' * self.size
+
+        if self.kind == 'path':
+            return pyfastcgi.Response(headers, pathlib.Path(self.path))
+
+        return pyfastcgi.Response(headers, b'x' * self.size)
+
+    def run(self, n:int):
+        send_record = pyfastcgi.send_record
+        sock = self.sock
+        data = self.make_data()
+
+        for _ in range(n):
+            send_record(sock, protocol.FCGI_STDOUT, 1, contentData=data)
+
+    def close(self):
+        if not self.path is None:
+            os.unlink(self.path)
+
+
+@dataclass
+class ChunkedWrite(Case):
+    '''
+    _ChunkedTransferStream.write() (close() は含まない)
+    '''
+    size:int = 0
+
+    def __post_init__(self):
+        self.sock = NullSocket(self.counter)
+        self.data = os.urandom(self.size)
+        self.stream = None
+
+    def prepare(self, n:int):
+        self.stream = streaming._ChunkedTransferStream(self.sock, 1)
+
+    def run(self, n:int):
+        write = self.stream.write
+        data = self.data
+
+        for _ in range(n):
+            write(data)
+
+    def close(self):
+        if not self.stream is None:
+            self.stream.close()
+
+
+def make_cases() -> list:
+    cases = []
+
+    for size in (0, 128, 1024, 8184, 65528):
+        cases.append(ReadRecordMemory(f'read_record/memory/{size}', size))
+
+    for size in (128, 8184):
+        cases.append(ReadRecordSocketpair(f'read_record/socketpair/{size}', size))
+
+    for count in (4, 16, 64):
+        cases.append(MakeParams(f'make_params/{count}x16', count, 16))
+
+    cases.append(MakeParams('make_params/16x300', 16, 300))
+
+    for size in (0, 128, 8192, 65535):
+        cases.append(SendRecordMemory(f'protocol.send_record/memory/{size}', size))
+
+    for size in (128, 8192):
+        cases.append(SendRecordSocketpair(f'protocol.send_record/socketpair/{size}', size))
+
+    for kind, size in (('bytes', 128), ('bytes', 8192), ('str', 8192), ('path', 65536)):
+        cases.append(SendResponse(f'pyfastcgi.send_record/{kind}/{size}', kind, size))
+
+    for size in (128, 8176, 65536):
+        cases.append(ChunkedWrite(f'chunked.write/{size}', size))
+
+    return cases
+
+
+def timed(case:Case, n:int) -> int:
+    '''
+    timeit と同じく計測中は GC を止める
+    '''
+    case.prepare(n)
+    gc.collect()
+    gc.disable()
+
+    try:
+        started = time.perf_counter_ns()
+        case.run(n)
+
+        return time.perf_counter_ns() - started
+
+    finally:
+        gc.enable()
+
+
+def measure(case:Case, repeat:int) -> dict:
+    '''
+    処理時間が MIN_MEASURE_NS を超える回数を求めてから {repeat} 回計測する
+    '''
+    n = 1
+
+    while True:
+        elapsed = timed(case, n)
+
+        if elapsed >= MIN_MEASURE_NS or n >= 1 << 24:
+            break
+
+        n *= 2
+
+    best = elapsed / n
+
+    for _ in range(repeat - 1):
+        best = min(best, timed(case, n) / n)
+
+    '''
+    割当 (tracemalloc の計測中は遅くなるので別に実行する)
+    '''
+    case.prepare(ALLOC_ITERATIONS)
+
+    tracemalloc.start()
+    try:
+        base, _ = tracemalloc.get_traced_memory()
+        case.run(ALLOC_ITERATIONS)
+        current, peak = tracemalloc.get_traced_memory()
+
+    finally:
+        tracemalloc.stop()
+
+    '''
+    socket のメソッドの呼び出し回数
+    '''
+    case.prepare(ALLOC_ITERATIONS)
+    case.counter.calls = 0
+    case.run(ALLOC_ITERATIONS)
+
+    return {
+        'iterations':       n,
+        'ns_op':            best,
+        'alloc_peak':       max(peak - base, 0),
+        'alloc_retained':   max(current - base, 0) / ALLOC_ITERATIONS,
+        'syscalls':         case.counter.calls / ALLOC_ITERATIONS,
+    }
+
+
+def compare(results:dict, baseline:dict, time_threshold:float, alloc_threshold:float, timing:bool=True) -> list:
+    '''
+    基準からの回帰 (case 名, 項目, 基準値, 今回の値) の一覧
+
+    * {timing} が False なら ns/op は比べない (別のホスト、Python で記録した基準は時間を比べられない)
+    '''
+    regressions = []
+
+    for name, now in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+
+        if timing and now['ns_op'] > base['ns_op'] * (1 + time_threshold):
+            regressions.append((name, 'ns_op', base['ns_op'], now['ns_op']))
+
+        for key in ('alloc_peak', 'alloc_retained'):
+            if now[key] > base[key] * (1 + alloc_threshold) + ALLOC_SLACK:
+                regressions.append((name, key, base[key], now[key]))
+
+        if now['syscalls'] > base['syscalls'] + 0.01:
+            regressions.append((name, 'syscalls', base['syscalls'], now['syscalls']))
+
+    return regressions
+
+
+def host_info() -> dict:
+    return {
+        'node':     platform.node(),
+        'python':   platform.python_version(),
+        'platform': platform.platform(),
+    }
+
+
+def print_table(results:dict, baseline:dict):
+    print(f'{"case":40s} {"ns/op":>12s} {"vs base":>8s} {"alloc":>8s} {"retain":>8s} {"calls":>6s}', file=sys.stderr)
+
+    for name, a in results.items():
+        base = baseline.get(name)
+        ratio = f'{a["ns_op"] / base["ns_op"]:7.2f}x' if base and base['ns_op'] else '       -'
+
+        print(f'{name:40s} {a["ns_op"]:12.1f} {ratio:>8s} {a["alloc_peak"]:8d} {a["alloc_retained"]:8.1f} {a["syscalls"]:6.2f}', file=sys.stderr)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='protocol codec microbenchmarks')
+
+    parser.add_argument('--baseline', dest='baseline', help='compare with this result and exit 1 on regressions')
+    parser.add_argument('--save-baseline', dest='save_baseline', help='write the result as a new baseline')
+    parser.add_argument('--output', dest='output', help='write json result to this file')
+    parser.add_argument('--filter', dest='filter', help='run only cases whose name contains this')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5, help='measure each case this many times and take the best')
+    parser.add_argument('--time-threshold', dest='time_threshold', type=float, default=DEFAULT_TIME_THRESHOLD, help='allowed ns/op increase ratio')
+    parser.add_argument('--alloc-threshold', dest='alloc_threshold', type=float, default=DEFAULT_ALLOC_THRESHOLD, help='allowed allocation increase ratio')
+
+    return parser.parse_args()
+
+
+def main() -> int:
+    cmdargs = parse_args()
+
+    results = {}
+
+    for case in make_cases():
+        if cmdargs.filter and not cmdargs.filter in case.name:
+            case.close()
+            continue
+
+        try:
+            results[case.name] = measure(case, cmdargs.repeat)
+
+        finally:
+            case.close()
+
+    output = {
+        'bench':    'codec-bench',
+        'version':  BENCH_VERSION,
+        'started':  time.time(),
+        'host':     host_info(),
+        'results':  results,
+    }
+
+    baseline = {}
+    regressions = []
+
+    if cmdargs.baseline:
+        with open(cmdargs.baseline, encoding='utf-8') as f:
+            a = json.load(f)
+
+        baseline = a['results']
+
+        same_host = a.get('host') == output['host']
+
+        if not same_host:
+            print(f'warning: baseline was recorded on a different host {a.get("host")}, ns/op is not compared', file=sys.stderr)
+
+        regressions = compare(results, baseline, cmdargs.time_threshold, cmdargs.alloc_threshold, timing=same_host)
+        output['regressions'] = [ dict(zip(('case', 'metric', 'baseline', 'current'), a)) for a in regressions ]
+
+    print_table(results, baseline)
+
+    for name, key, base, now in regressions:
+        print(f'REGRESSION {name} {key}: {base:.1f} -> {now:.1f}', file=sys.stderr)
+
+    data = json.dumps(output, indent=2)
+
+    for path in (cmdargs.output, cmdargs.save_baseline):
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(data + '\n')
+
+    if not cmdargs.output and not cmdargs.save_baseline:
+        print(data)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# EOF
@@ -1,9 +1,8 @@
-import os
-import sys
 import socket
 import collections
 import pyfastcgi
 import pyfastcgi.listener
+import pyfastcgi.log as log
 import pyfastcgi.responders
 import pyfastcgi.responders.streaming as streaming
 
@@ -20,7 +19,7 @@ class Responder(streaming.StreamingResponder):
 
 
 def ResponderSelector(context:pyfastcgi.Context, conn:socket.socket, client:tuple, reqid:int, params:collections.Mapping):
-    print(f'{__file__}: {os.getpid()=} from {client=}', file=sys.stderr)
+    log.app.debug('%s: from %s', __file__, client)
 
     if params['REQUEST_METHOD'] == 'POST':
         responder = Responder
@@ -0,0 +1,577 @@
+import os
+import sys
+import argparse
+import contextlib
+import dataclasses
+import itertools
+import json
+import multiprocessing
+import platform
+import random
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import threading
+import time
+import pyfastcgi.protocol as protocol
+from dataclasses import dataclass
+
+
+'''
+FastCGI の負荷生成とベンチマーク
+
+hash-client.py, echo-client.py は HTTP サーバ (nginx など) を経由するので、その処理時間も含まれる。
+こちらは FastCGI のレコードを直接 (tcp/ip または unix-domain-socket) 送信する
+
+    # 起動済みのサーバに対して
+    python fcgi-bench.py --port=9000 --concurrency=8 --duration=10 --uri=/app/x.js
+
+    # シナリオ (bench/*.json) の実行毎にサーバを起動して比較する
+    python fcgi-bench.py --scenario=bench/modes.json --output=modes-result.json
+
+結果は JSON (--output, 無指定なら標準出力) で、要約を標準エラー出力に表示する
+(リリース間の比較用に、設定と環境も結果に含める)
+
+* クライアントも python なので、サーバより先に上限に達しないよう --client-procs で分散する
+* 送信と受信は selectors で並行して行う (streaming の echo で大きな body を送る場合に
+  互いの送信バッファが埋まって止まらないように)
+'''
+
+BENCH_VERSION = 1
+
+DEFAULT_RECORD_SIZE = protocol.PACKET_IO_LEN
+RECV_BUFFER_LEN = 65536
+
+# サーバの起動 (接続可能になる) を待つ最大の秒数
+SERVER_START_TIMEOUT = 10.0
+SERVER_STOP_TIMEOUT = 15.0
+
+# シナリオ, コマンドラインで指定できる実行毎の設定
+RUN_DEFAULTS = {
+    'concurrency':  8,
+    'client_procs': 1,
+    'duration':     10.0,
+    'warmup':       1.0,
+    'requests_max': 0,
+    'keep_conn':    False,
+    'record_size':  DEFAULT_RECORD_SIZE,
+    'timeout':      10.0,
+    'server':       None,
+}
+
+
+@dataclass(frozen=True)
+class RequestSpec:
+    '''
+    送信するリクエストの種類 (weight の比率で選ぶ)
+    '''
+    method:str = 'GET'
+    uri:str = '/'
+    body_size:int = 0
+    weight:float = 1.0
+    params:dict = dataclasses.field(default_factory=dict)
+
+    def make_params(self) -> dict:
+        path, _, query = self.uri.partition('?')
+
+        params = {
+            'GATEWAY_INTERFACE':    'CGI/1.1',
+            'SERVER_PROTOCOL':      'HTTP/1.1',
+            'SERVER_SOFTWARE':      'fcgi-bench',
+            'REQUEST_METHOD':       self.method,
+            'REQUEST_URI':          self.uri,
+            'SCRIPT_NAME':          path,
+            'QUERY_STRING':         query,
+            'CONTENT_LENGTH':       str(self.body_size) if self.body_size else '',
+            'CONTENT_TYPE':         'application/octet-stream' if self.body_size else '',
+            'REMOTE_ADDR':          '127.0.0.1',
+            'HTTP_HOST':            'localhost',
+        }
+
+        params.update(self.params)
+
+        return params
+
+
+@dataclass
+class Result:
+    '''
+    クライアント (プロセス) 毎の結果 (latencies は秒)
+    '''
+    latencies:list = dataclasses.field(default_factory=list)
+    errors:int = 0
+    status:dict = dataclasses.field(default_factory=dict)
+    bytes_out:int = 0
+    bytes_in:int = 0
+    connections:int = 0
+
+    def merge(self, other:'Result'):
+        self.latencies.extend(other.latencies)
+        self.errors += other.errors
+        self.bytes_out += other.bytes_out
+        self.bytes_in += other.bytes_in
+        self.connections += other.connections
+
+        for k, v in other.status.items():
+            self.status[k] = self.status.get(k, 0) + v
+
+
+def connect(target, timeout:float) -> socket.socket:
+    if type(target) == str:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(timeout)
+        conn.connect(target)
+
+    else:
+        conn = socket.create_connection(target, timeout=timeout)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    return conn
+
+
+def encode_records(recordType:int, requestId:int, data:bytes, record_size:int) -> bytearray:
+    '''
+    {data} を最大 {record_size} の content のレコードに分割し、最後に空のレコード (終端) を付ける
+    '''
+    buff = bytearray()
+    record_size = max(1, min(record_size, protocol.FCGI_MAX_LENGTH))
+
+    with memoryview(data) as mem:
+        for pos in range(0, len(mem), record_size):
+            buff += protocol.make_record(recordType, requestId, contentData=mem[pos:pos+record_size].tobytes()).dump()
+
+    buff += protocol.make_record(recordType, requestId, contentData=b'').dump()
+
+    return buff
+
+
+def encode_request(spec:RequestSpec, requestId:int, body:bytes, keep_conn:bool, record_size:int) -> bytes:
+    begin = protocol.FCGI_BeginRequestBody(protocol.FCGI_RESPONDER, protocol.FCGI_KEEP_CONN if keep_conn else 0)
+
+    buff = bytearray(protocol.make_record(protocol.FCGI_BEGIN_REQUEST, requestId, contentData=begin.dump()).dump())
+    buff += encode_records(protocol.FCGI_PARAMS, requestId, protocol.dump_params(spec.make_params()), record_size)
+    buff += encode_records(protocol.FCGI_STDIN, requestId, body[:spec.body_size], record_size)
+
+    return bytes(buff)
+
+
+def parse_status(head:bytes) -> int:
+    '''
+    FCGI_STDOUT の先頭 (CGI のヘッダ) から Status を取り出す (無ければ 200)
+    '''
+    for line in head.split(b'\r\n\r\n', 1)[0].split(b'\n'):
+        name, _, value = line.partition(b':')
+
+        if name.strip().lower() == b'status':
+            with contextlib.suppress(ValueError):
+                return int(value.split()[0])
+
+    return 200
+
+
+def exchange(conn:socket.socket, request:bytes, requestId:int, timeout:float) -> tuple:
+    '''
+    {request} を送信しながら FCGI_END_REQUEST まで受信する
+
+        return (status, 送信バイト数, 受信バイト数)
+    '''
+    deadline = time.monotonic() + timeout
+    conn.setblocking(False)
+
+    head = bytearray()
+    recvbuf = bytearray()
+    buff = bytearray(RECV_BUFFER_LEN)
+    sent = 0
+    nrecv = 0
+
+    with selectors.DefaultSelector() as selector, memoryview(request) as outgoing:
+        selector.register(conn, selectors.EVENT_READ | selectors.EVENT_WRITE)
+
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout('fcgi-bench: request timeout')
+
+            for _, events in selector.select(remaining):
+                if events & selectors.EVENT_WRITE:
+                    sent += conn.send(outgoing[sent:])
+
+                    if sent == len(outgoing):
+                        selector.modify(conn, selectors.EVENT_READ)
+
+                if events & selectors.EVENT_READ:
+                    nread = conn.recv_into(buff)
+                    if nread == 0:
+                        raise ConnectionResetError('fcgi-bench: closed before FCGI_END_REQUEST')
+
+                    nrecv += nread
+                    recvbuf += buff[:nread]
+
+            '''
+            受信済の完全なレコードを処理する
+            '''
+            while len(recvbuf) >= protocol.FCGI_HEADER_LEN:
+                _, recordType, rid, contentLength, paddingLength, _ = struct.unpack_from('>2B2H2B', recvbuf)
+                total = protocol.FCGI_HEADER_LEN + contentLength + paddingLength
+
+                if len(recvbuf) < total:
+                    break
+
+                if rid == requestId:
+                    if recordType == protocol.FCGI_STDOUT and len(head) < RECV_BUFFER_LEN:
+                        head += recvbuf[protocol.FCGI_HEADER_LEN:protocol.FCGI_HEADER_LEN+contentLength]
+
+                    elif recordType == protocol.FCGI_END_REQUEST:
+                        conn.setblocking(True)
+
+                        appStatus, protocolStatus = struct.unpack_from('>IB', recvbuf, protocol.FCGI_HEADER_LEN)
+                        if protocolStatus != protocol.FCGI_REQUEST_COMPLETE:
+                            return -protocolStatus, sent, nrecv
+
+                        return parse_status(head), sent, nrecv
+
+                del recvbuf[:total]
+
+
+@dataclass
+class ClientThread:
+    target:any
+    config:dict
+    specs:list
+    body:bytes
+    deadline:float
+    measure_after:float
+    counter:callable
+    result:Result = dataclasses.field(init=False, default_factory=Result)
+
+    def run(self):
+        rng = random.Random()
+        weights = [ spec.weight for spec in self.specs ]
+        indexes = range(len(self.specs))
+        requests = [ encode_request(spec, 1, self.body, self.config['keep_conn'], self.config['record_size']) for spec in self.specs ]
+
+        conn = None
+
+        try:
+            while time.monotonic() < self.deadline:
+                if self.config['requests_max'] and self.counter() >= self.config['requests_max']:
+                    break
+
+                index = rng.choices(indexes, weights)[0]
+                started = time.perf_counter()
+
+                try:
+                    if conn is None:
+                        conn = connect(self.target, self.config['timeout'])
+                        self.result.connections += 1
+
+                    status, sent, nrecv = exchange(conn, requests[index], 1, self.config['timeout'])
+
+                except OSError:
+                    status, sent, nrecv = None, 0, 0
+
+                    if not conn is None:
+                        conn.close()
+                        conn = None
+
+                elapsed = time.perf_counter() - started
+
+                if time.monotonic() < self.measure_after:
+                    # warmup
+                    pass
+
+                elif status is None:
+                    self.result.errors += 1
+
+                else:
+                    self.result.latencies.append(elapsed)
+                    self.result.status[str(status)] = self.result.status.get(str(status), 0) + 1
+                    self.result.bytes_out += sent
+                    self.result.bytes_in += nrecv
+
+                if not self.config['keep_conn'] and not conn is None:
+                    conn.close()
+                    conn = None
+
+        finally:
+            if not conn is None:
+                conn.close()
+
+
+def run_client(target, config:dict, specs:list, threads:int, started:float) -> Result:
+    '''
+    クライアントのプロセス毎に {threads} 個の接続で送信する
+    '''
+    body = os.urandom(max(( spec.body_size for spec in specs ), default=0))
+    measure_after = started + config['warmup']
+    deadline = measure_after + config['duration']
+
+    # --requests-max はプロセス内のスレッドで共有する
+    counter = itertools.count()
+    counter_lock = threading.Lock()
+
+    def next_count() -> int:
+        with counter_lock:
+            return next(counter)
+
+    clients = [ ClientThread(target, config, specs, body, deadline, measure_after, next_count) for _ in range(threads) ]
+    workers = [ threading.Thread(target=client.run, daemon=True) for client in clients ]
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+    result = Result()
+
+    for client in clients:
+        result.merge(client.result)
+
+    return result
+
+
+def _run_client_proc(args:tuple) -> Result:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    return run_client(*args)
+
+
+def percentile(values:list, ratio:float) -> float:
+    '''
+    {values} はソート済
+    '''
+    if not values:
+        return 0.0
+
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+def summarize(result:Result, duration:float) -> dict:
+    latencies = sorted(result.latencies)
+    count = len(latencies)
+
+    return {
+        'requests':     count,
+        'errors':       result.errors,
+        'status':       result.status,
+        'connections':  result.connections,
+        'throughput':   count / duration if duration else 0.0,
+        'bytes_out':    result.bytes_out,
+        'bytes_in':     result.bytes_in,
+        'latency_ms': {
+            'mean':     sum(latencies) / count * 1000 if count else 0.0,
+            'p50':      percentile(latencies, 0.50) * 1000,
+            'p90':      percentile(latencies, 0.90) * 1000,
+            'p99':      percentile(latencies, 0.99) * 1000,
+            'p999':     percentile(latencies, 0.999) * 1000,
+            'max':      latencies[-1] * 1000 if count else 0.0,
+        },
+    }
+
+
+def run_load(target, config:dict, specs:list) -> dict:
+    procs = max(1, min(config['client_procs'], config['concurrency']))
+    threads = [ config['concurrency'] // procs + (1 if n < config['concurrency'] % procs else 0) for n in range(procs) ]
+
+    if config['requests_max']:
+        # プロセス毎に均等に分ける
+        config = dict(config, requests_max=max(1, config['requests_max'] // procs))
+
+    started = time.monotonic()
+
+    if procs == 1:
+        result = run_client(target, config, specs, threads[0], started)
+
+    else:
+        with multiprocessing.Pool(procs) as pool:
+            results = pool.map(_run_client_proc, [ (target, config, specs, n, started) for n in threads ])
+
+        result = Result()
+
+        for a in results:
+            result.merge(a)
+
+    # warmup を除く実際の計測時間 (requests_max で早く終わる場合がある)
+    duration = max(time.monotonic() - started - config['warmup'], 1e-9)
+
+    return summarize(result, duration)
+
+
+@contextlib.contextmanager
+def run_server(server:list, target, cwd:str):
+    '''
+    シナリオの実行毎にサーバを起動する ({target} の --port/--file は自動で付ける)
+    '''
+    if not server:
+        yield None
+        return
+
+    if type(target) == str:
+        bind = [ f'--file={target}' ]
+
+    else:
+        bind = [ f'--addr={target[0]}', f'--port={target[1]}' ]
+
+    env = dict(os.environ)
+    libdir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lib')
+    env['PYTHONPATH'] = os.pathsep.join(( a for a in (libdir, env.get('PYTHONPATH')) if a ))
+
+    proc = subprocess.Popen([ sys.executable ] + list(server) + bind, cwd=cwd, env=env)
+
+    try:
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+
+        while True:
+            if not proc.poll() is None:
+                raise RuntimeError(f'server exited {proc.returncode}: {server}')
+
+            try:
+                connect(target, 1.0).close()
+                break
+
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+
+                time.sleep(0.1)
+
+        yield proc
+
+    finally:
+        proc.send_signal(signal.SIGTERM)
+
+        try:
+            proc.wait(SERVER_STOP_TIMEOUT)
+
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+def load_specs(a:list) -> list:
+    return [ RequestSpec(**spec) for spec in a ]
+
+
+def make_target(addr:str, port:int, path:str):
+    return path if path else (addr or '127.0.0.1', port)
+
+
+def print_summary(name:str, summary:dict):
+    lat = summary['latency_ms']
+
+    print(
+        f'{name}: {summary["throughput"]:.1f} req/s requests={summary["requests"]} errors={summary["errors"]} '
+        f'p50={lat["p50"]:.2f}ms p99={lat["p99"]:.2f}ms p999={lat["p999"]:.2f}ms max={lat["max"]:.2f}ms status={summary["status"]}',
+        file=sys.stderr)
+
+
+def run_scenario(scenario:dict, overrides:dict, target, cwd:str) -> list:
+    '''
+    シナリオの設定は defaults < runs[] < コマンドラインの順に優先する
+    '''
+    defaults = dict(RUN_DEFAULTS, **scenario.get('defaults', {}))
+    results = []
+
+    for run in scenario.get('runs') or [ {} ]:
+        run = dict(run)
+        name = run.pop('name', scenario.get('name', 'default'))
+        specs = load_specs(run.pop('requests', scenario.get('requests', [ {} ])))
+
+        config = dict(defaults, **run)
+        config.update(overrides)
+
+        with run_server(config['server'], target, cwd):
+            summary = run_load(target, config, specs)
+
+        print_summary(name, summary)
+
+        results.append({
+            'name':     name,
+            'config':   config,
+            'requests': [ dataclasses.asdict(spec) for spec in specs ],
+            **summary,
+        })
+
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='FastCGI load generator')
+
+    parser.add_argument('--addr', dest='addr', default='127.0.0.1', help='server tcp/ip address')
+    parser.add_argument('--port', dest='port', type=int, default=9000, help='server tcp/ip port-number')
+    parser.add_argument('--file', dest='file', help='server unix-domain-socket')
+    parser.add_argument('--scenario', dest='scenario', help='scenario json file (bench/*.json)')
+    parser.add_argument('--run', dest='runs', action='append', help='run only these names in the scenario')
+    parser.add_argument('--output', dest='output', help='write json result to this file (default: stdout)')
+    parser.add_argument('--method', dest='method', default='GET', help='request method (without --scenario)')
+    parser.add_argument('--uri', dest='uri', default='/', help='request uri (without --scenario)')
+    parser.add_argument('--body-size', dest='body_size', type=int, default=0, help='bytes of FCGI_STDIN (without --scenario)')
+
+    for name, value in RUN_DEFAULTS.items():
+        if name == 'server':
+            continue
+
+        option = '--' + name.replace('_', '-')
+        atype = (lambda a: a.lower() in ('1', 'true', 'yes', 'on')) if type(value) == bool else type(value)
+        parser.add_argument(option, dest=name, type=atype, default=None, help=f'(default: {value})')
+
+    return parser.parse_args()
+
+
+def main():
+    cmdargs = parse_args()
+
+    target = make_target(cmdargs.addr, cmdargs.port, cmdargs.file)
+    overrides = { name: getattr(cmdargs, name) for name in RUN_DEFAULTS if getattr(cmdargs, name, None) is not None }
+
+    if cmdargs.scenario:
+        with open(cmdargs.scenario, encoding='utf-8') as f:
+            scenario = json.load(f)
+
+        cwd = os.path.dirname(os.path.abspath(cmdargs.scenario))
+        cwd = os.path.join(cwd, scenario.get('server_cwd', '.'))
+
+        if cmdargs.runs:
+            scenario['runs'] = [ run for run in scenario.get('runs', []) if run.get('name') in cmdargs.runs ]
+
+    else:
+        scenario = {
+            'name': 'command-line',
+            'requests': [ { 'method': cmdargs.method, 'uri': cmdargs.uri, 'body_size': cmdargs.body_size } ],
+        }
+
+        cwd = os.getcwd()
+
+    output = {
+        'bench':    'fcgi-bench',
+        'version':  BENCH_VERSION,
+        'scenario': scenario.get('name'),
+        'started':  time.time(),
+        'target':   target,
+        'host': {
+            'node':     platform.node(),
+            'python':   platform.python_version(),
+            'platform': platform.platform(),
+            'cpus':     os.cpu_count(),
+        },
+        'runs':     run_scenario(scenario, overrides, target, cwd),
+    }
+
+    data = json.dumps(output, indent=2)
+
+    if cmdargs.output:
+        with open(cmdargs.output, 'w', encoding='utf-8') as f:
+            f.write(data + '\n')
+
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOF
@@ -0,0 +1,428 @@
+import sys
+import argparse
+import collections
+import concurrent.futures
+import dataclasses
+import glob
+import json
+import socket
+import struct
+import threading
+import time
+import pyfastcgi.capture as capture
+import pyfastcgi.protocol as protocol
+from dataclasses import dataclass
+
+
+'''
+--capture-path で記録したリクエストの再送
+
+    # 記録 (子プロセス毎に /tmp/fcgi.cap.{pid} に書き込まれる)
+    python prefork.py --app-path=buffering1.py --capture-path=/tmp/fcgi.cap --capture-sample=0.1
+
+    # 元の間隔で再送して、記録時の処理時間と比較する
+    python fcgi-replay.py --port=9000 '/tmp/fcgi.cap.*'
+
+    # 2 倍の速さで (--speed=0 は間隔を空けずに --max-connections の並列で)
+    python fcgi-replay.py --port=9000 --speed=2 --output=replay.json '/tmp/fcgi.cap.*'
+
+* 接続の開始とレコードの送信は、記録時の時刻の差を --speed で割った間隔で行う
+* 多重化していない接続 (FCGI_KEEP_CONN で順に送られたリクエスト) では、次の FCGI_BEGIN_REQUEST は
+  前のリクエストの FCGI_END_REQUEST を受信してから、記録時の間隔 (前の終了から次の開始まで) を空けて送る
+* 切り詰められた FCGI_STDIN は元の長さまで 0 で埋めて送信する
+* 記録時の処理時間は FCGI_BEGIN_REQUEST の受信から FCGI_END_REQUEST の送信まで
+  (再送時は FCGI_BEGIN_REQUEST の送信から FCGI_END_REQUEST の受信まで)
+'''
+
+# 比較の一覧に表示する SCRIPT_NAME の数
+TOP_SCRIPTS = 20
+
+
+@dataclass
+class Request:
+    '''
+    記録された一つのリクエスト
+
+    FCGI_KEEP_CONN の接続では同じ requestId が次のリクエストに使われるので、
+    FCGI_BEGIN_REQUEST から同じ requestId の次の FCGI_END_REQUEST までを一つとする
+    '''
+    requestId:int
+    begin:capture.Entry
+    params:list = dataclasses.field(default_factory=list)
+    end:capture.Entry = None
+
+    @property
+    def original_latency(self) -> float:
+        if self.end is None:
+            return None
+
+        return self.end.time - self.begin.time
+
+    @property
+    def original_status(self) -> tuple:
+        if self.end is None:
+            return None
+
+        return struct.unpack('>IB', self.end.contentData[:5])
+
+    @property
+    def script_name(self) -> str:
+        '''
+        FCGI_PARAMS から SCRIPT_NAME (無ければ REQUEST_URI のパス部分)
+        '''
+        data = b''.join(( a.contentData for a in self.params ))
+
+        try:
+            params = protocol.make_params(memoryview(bytearray(data)))
+
+        except Exception:
+            return '(unknown)'
+
+        return params.get('SCRIPT_NAME') or params.get('REQUEST_URI', '').split('?', 1)[0] or '(unknown)'
+
+
+@dataclass
+class Session:
+    '''
+    記録された一つの接続
+    '''
+    connId:int
+    records:list = dataclasses.field(default_factory=list)
+    ends:list = dataclasses.field(default_factory=list)
+    requests:list = dataclasses.field(init=False, default_factory=list)
+    begins:dict = dataclasses.field(init=False, default_factory=dict)
+
+    @property
+    def started(self) -> float:
+        return self.records[0].time
+
+    @property
+    def multiplexed(self) -> bool:
+        '''
+        前のリクエストが終わる前に次のリクエストを開始しているか
+        '''
+        return any(( not a.end is None and b.begin.time < a.end.time for a, b in zip(self.requests, self.requests[1:]) ))
+
+    def pair(self):
+        '''
+        レコードをリクエスト毎に分け、FCGI_END_REQUEST を requestId 毎に記録順で対応させる
+
+            begins ... records の FCGI_BEGIN_REQUEST の位置 -> requests の位置
+        '''
+        current = {}
+        waiting = {}
+
+        for index, entry in enumerate(self.records):
+            if entry.recordType == protocol.FCGI_BEGIN_REQUEST:
+                request = Request(entry.requestId, entry)
+
+                self.begins[index] = len(self.requests)
+                self.requests.append(request)
+
+                current[entry.requestId] = request
+                waiting.setdefault(entry.requestId, collections.deque()).append(request)
+
+            elif entry.recordType == protocol.FCGI_PARAMS and entry.requestId in current:
+                current[entry.requestId].params.append(entry)
+
+        for entry in self.ends:
+            queue = waiting.get(entry.requestId)
+
+            if queue:
+                queue.popleft().end = entry
+
+
+@dataclass
+class Outcome:
+    connId:int
+    requestId:int
+    script:str
+    original:float
+    replay:float = None
+    original_status:tuple = None
+    replay_status:tuple = None
+    error:str = None
+
+
+def load_sessions(paths:list) -> list:
+    sessions = {}
+
+    for path in paths:
+        for entry in capture.read_entries(path):
+            session = sessions.setdefault(entry.connId, Session(entry.connId))
+
+            if entry.kind == capture.ENTRY_RECORD:
+                session.records.append(entry)
+
+            elif entry.kind == capture.ENTRY_END:
+                session.ends.append(entry)
+
+    for session in sessions.values():
+        session.pair()
+
+    return sorted(( a for a in sessions.values() if a.records ), key=lambda a: a.started)
+
+
+def encode_record(entry:capture.Entry) -> bytes:
+    contentData = entry.contentData
+
+    if entry.truncated:
+        contentData += bytes(entry.contentLength - len(contentData))
+
+    return protocol.make_record(entry.recordType, entry.requestId, contentData=contentData).dump()
+
+
+def connect(target, timeout:float) -> socket.socket:
+    if type(target) == str:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(timeout)
+        conn.connect(target)
+
+    else:
+        conn = socket.create_connection(target, timeout=timeout)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    return conn
+
+
+def replay_session(session:Session, target, speed:float, timeout:float) -> list:
+    '''
+    送信は別のスレッドで記録時の間隔に合わせて行い、こちらは FCGI_END_REQUEST を受信する
+    (streaming の responder は受信しながら送信するので、送信を待つと止まる場合がある)
+
+    受信した FCGI_END_REQUEST は、同じ requestId で送信済みの最も古いリクエストのものとする
+
+    多重化していない接続では、FCGI_BEGIN_REQUEST を前のリクエストの終了 ({finished}) まで待たせる
+    (まとめて送ると再送時の処理時間の大半が待ち時間になる)
+    '''
+    outcomes = [
+        Outcome(session.connId, a.requestId, a.script_name, a.original_latency, original_status=a.original_status) for a in session.requests
+    ]
+    sent_at = {}
+    pending = {}
+    lock = threading.Lock()
+    done = threading.Event()
+    serial = not session.multiplexed
+    finished = [ threading.Event() for _ in session.requests ]
+
+    try:
+        conn = connect(target, timeout)
+
+    except OSError as e:
+        for a in outcomes:
+            a.error = f'connect: {e}'
+
+        return outcomes
+
+    def sender():
+        # 記録時の {origin} を再送時の {started} に合わせる
+        origin = session.started
+        started = time.monotonic()
+
+        try:
+            for index, entry in enumerate(session.records):
+                n = session.begins.get(index)
+
+                if serial and n:
+                    finished[n - 1].wait()
+
+                    with lock:
+                        if done.is_set():
+                            # 受信側で中断した
+                            break
+
+                    # 記録時の前のリクエストの終了を、再送時に終了を受信した時刻に合わせる
+                    previous = session.requests[n - 1].end
+                    origin = previous.time if not previous is None else entry.time
+                    started = time.monotonic()
+
+                if speed > 0:
+                    delay = (entry.time - origin) / speed - (time.monotonic() - started)
+                    if delay > 0:
+                        time.sleep(delay)
+
+                if not n is None:
+                    with lock:
+                        pending.setdefault(entry.requestId, collections.deque()).append(n)
+                        sent_at[n] = time.perf_counter()
+
+                conn.sendall(encode_record(entry))
+
+        except OSError:
+            # 受信側で検知する
+            pass
+
+        finally:
+            done.set()
+
+    thread = threading.Thread(target=sender, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            with lock:
+                if done.is_set() and not any(pending.values()):
+                    break
+
+            record = protocol.read_record(conn)
+
+            if record.header.recordType == protocol.FCGI_END_REQUEST:
+                requestId = record.header.requestId
+
+                with lock:
+                    queue = pending.get(requestId)
+                    n = queue.popleft() if queue else None
+
+                if not n is None:
+                    outcome = outcomes[n]
+                    outcome.replay = time.perf_counter() - sent_at[n]
+                    outcome.replay_status = struct.unpack('>IB', bytes(record.contentData[:5]))
+                    finished[n].set()
+
+    except (OSError, AssertionError) as e:
+        with lock:
+            for queue in pending.values():
+                for n in queue:
+                    outcomes[n].error = f'{type(e).__name__}: {e}'
+
+            done.set()
+
+    finally:
+        # 終了を待っている送信側を起こす
+        for event in finished:
+            event.set()
+
+        conn.close()
+        thread.join()
+
+    return outcomes
+
+
+def stats(values:list) -> dict:
+    values = sorted(values)
+    count = len(values)
+
+    def pick(ratio:float) -> float:
+        return values[min(count - 1, int(count * ratio))] * 1000 if count else 0.0
+
+    return {
+        'count':    count,
+        'mean':     sum(values) / count * 1000 if count else 0.0,
+        'p50':      pick(0.50),
+        'p90':      pick(0.90),
+        'p99':      pick(0.99),
+        'max':      values[-1] * 1000 if count else 0.0,
+    }
+
+
+def compare(outcomes:list) -> dict:
+    paired = [ a for a in outcomes if not a.original is None and not a.replay is None ]
+
+    original = stats([ a.original for a in paired ])
+    replay = stats([ a.replay for a in paired ])
+
+    return {
+        'original_ms':  original,
+        'replay_ms':    replay,
+        'diff_ms':      { key: replay[key] - original[key] for key in ('mean', 'p50', 'p90', 'p99', 'max') },
+    }
+
+
+def report(outcomes:list, elapsed:float) -> dict:
+    scripts = {}
+
+    for a in outcomes:
+        scripts.setdefault(a.script, []).append(a)
+
+    top = sorted(scripts.items(), key=lambda kv: -len(kv[1]))[:TOP_SCRIPTS]
+
+    return {
+        'requests':         len(outcomes),
+        'replayed':         sum(( 1 for a in outcomes if not a.replay is None )),
+        'errors':           sum(( 1 for a in outcomes if not a.error is None )),
+        'status_mismatch':  sum(( 1 for a in outcomes if a.original_status and a.replay_status and a.original_status != a.replay_status )),
+        'elapsed':          elapsed,
+        **compare(outcomes),
+        'scripts':          { name: compare(a) for name, a in top },
+    }
+
+
+def print_summary(result:dict):
+    o, r, d = result['original_ms'], result['replay_ms'], result['diff_ms']
+
+    print(f'requests={result["requests"]} replayed={result["replayed"]} errors={result["errors"]} status_mismatch={result["status_mismatch"]}', file=sys.stderr)
+
+    for key in ('mean', 'p50', 'p90', 'p99', 'max'):
+        print(f'  {key:5s} original={o[key]:9.2f}ms replay={r[key]:9.2f}ms diff={d[key]:+9.2f}ms', file=sys.stderr)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='replay captured FastCGI sessions')
+
+    parser.add_argument('paths', nargs='+', help='capture files (glob patterns are expanded)')
+    parser.add_argument('--addr', dest='addr', default='127.0.0.1', help='server tcp/ip address')
+    parser.add_argument('--port', dest='port', type=int, default=9000, help='server tcp/ip port-number')
+    parser.add_argument('--file', dest='file', help='server unix-domain-socket')
+    parser.add_argument('--speed', dest='speed', type=float, default=1.0, help='replay speed (2: twice as fast, 0: no wait)')
+    parser.add_argument('--max-connections', dest='max_connections', type=int, default=64, help='max concurrent connections')
+    parser.add_argument('--timeout', dest='timeout', type=float, default=30.0, help='socket timeout')
+    parser.add_argument('--output', dest='output', help='write json result to this file (default: stdout)')
+
+    return parser.parse_args()
+
+
+def main():
+    cmdargs = parse_args()
+
+    paths = sorted(set(( path for a in cmdargs.paths for path in (glob.glob(a) or [ a ]) )))
+    sessions = load_sessions(paths)
+
+    if not sessions:
+        print('no sessions captured', file=sys.stderr)
+        return
+
+    target = cmdargs.file if cmdargs.file else (cmdargs.addr, cmdargs.port)
+    first = sessions[0].started
+    outcomes = []
+
+    started = time.monotonic()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=cmdargs.max_connections) as executor:
+        futures = []
+
+        for session in sessions:
+            if cmdargs.speed > 0:
+                delay = (session.started - first) / cmdargs.speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+            futures.append(executor.submit(replay_session, session, target, cmdargs.speed, cmdargs.timeout))
+
+        for future in futures:
+            outcomes.extend(future.result())
+
+    result = {
+        'replay':   'fcgi-replay',
+        'captures': paths,
+        'target':   target,
+        'speed':    cmdargs.speed,
+        'sessions': len(sessions),
+        **report(outcomes, time.monotonic() - started),
+    }
+
+    print_summary(result)
+
+    data = json.dumps(result, indent=2)
+
+    if cmdargs.output:
+        with open(cmdargs.output, 'w', encoding='utf-8') as f:
+            f.write(data + '\n')
+
+    else:
+        print(data)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOF
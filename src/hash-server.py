@@ -1,10 +1,9 @@
-import os
-import sys
 import socket
 import collections
 import hashlib
 import pyfastcgi
 import pyfastcgi.listener
+import pyfastcgi.log as log
 import pyfastcgi.responders
 import pyfastcgi.responders.buffering as buffering
 
@@ -24,7 +23,7 @@ class Responder(buffering.BufferingResponder):
 
 
 def ResponderSelector(context:pyfastcgi.Context, conn:socket.socket, client:tuple, reqid:int, params:collections.Mapping):
-    print(f'{__file__}: {os.getpid()=} from {client=}', file=sys.stderr)
+    log.app.debug('%s: from %s', __file__, client)
 
     if params['REQUEST_METHOD'] == 'POST':
         responder = Responder
@@ -2,15 +2,17 @@ import os
 import sys
 import argparse
 import collections
+import contextlib
 import dataclasses
 import distutils.util
 import enum
 import pathlib
 import socket
 import tempfile
-import threading
-import traceback
 import types
+import pyfastcgi.histogram as histogram
+import pyfastcgi.log as log
+import pyfastcgi.metrics as metrics
 import pyfastcgi.protocol as protocol
 from dataclasses import dataclass
 
@@ -19,6 +21,7 @@ CONST_STATUS = 'STatus'
 CONST_CONTENT_TYPE = 'Content-Type'
 CONST_CONTENT_LENGTH = 'Content-Length'
 CONST_TRANSFER_ENCODING = 'Transfer-Encoding'
+CONST_SERVER_TIMING = 'Server-Timing'
 
 
 class StdioType(enum.Enum):
@@ -60,8 +63,7 @@ class Event:
 @dataclass
 class Context:
     pid:int
-    _stats:collections.Mapping
-    _stats_lock:any
+    metrics:metrics.Metrics
     _handler:callable
     responder_factory:callable
     bind_addr:any
@@ -71,8 +73,56 @@ class Context:
     nonblocking:bool
     max_stdio_mem:int
     so_timeout:float
+    max_queue:int
+    queue_target:float
+    queue_interval:float
+    overload_response:str
+    reuseport:bool
+    backlog:int
+    accept_budget:int
+    close_linger:float
+    status_path:str
+    loop_stats:bool
+    server_timing:bool
+    slowlog_timeout:float
+    slowlog_interval:float
+    request_terminate_timeout:float
+    profile_requests:int
+    profile_sample:float
+    profile_route:str
+    profile_tracemalloc:bool
+    profile_path:str
+    capture_path:str
+    capture_sample:float
+    capture_max_body:int
+    proxy_backends:tuple
+    proxy_balance:str
+    proxy_hash_param:str
+    proxy_max_connections:int
+    proxy_timeout:float
+    proxy_health_interval:float
+    proxy_eject_failures:int
+    asgi_app:str
+    asgi_max_reqs:int
+    cache_max_bytes:int
+    cache_ttl:float
+    cache_stale:float
+    cache_vary:tuple
+    cache_shared:bool
+    coalesce:bool
+    coalesce_timeout:float
     extra:collections.Mapping
     loop:bool = dataclasses.field(init=False, default=True)
+    accept_lock:any = dataclasses.field(init=False, default=None)
+    scoreboard:any = dataclasses.field(init=False, default=None)
+    worker:any = dataclasses.field(init=False, default=None)
+    watchdog:any = dataclasses.field(init=False, default=None)
+    profiler:any = dataclasses.field(init=False, default=None)
+    capture:any = dataclasses.field(init=False, default=None)
+    proxy:any = dataclasses.field(init=False, default=None)
+    cache:any = dataclasses.field(init=False, default=None)
+    coalescer:any = dataclasses.field(init=False, default=None)
+    reaper:any = dataclasses.field(init=False, default=None)
 
     def handler(self, event:Event):
         if self._handler:
@@ -80,24 +130,20 @@ class Context:
 
     @property
     def stats(self):
-        with self._stats_lock:
-            a = self._stats.copy()
-
-        return a
+        return self.metrics.snapshot()
 
+    '''
+    名前による加算は互換のため (頻繁に通る箇所では metrics.counter() で得た Counter を使う)
+    '''
     def incr_stats(self, *keys):
-        keys = set(keys)
+        for key in set(keys):
+            self.metrics.add(metrics.counter(key))
 
-        with self._stats_lock:
-            for key in keys:
-                self._stats.setdefault(key, 0)
-                self._stats[key] += 1
+    def add_stats(self, key:str, value:int):
+        self.metrics.add(metrics.counter(key), value)
 
     def get_stats(self, key:str) -> int:
-        with self._stats_lock:
-            a = self._stats[key]
-
-        return a
+        return self.metrics.get(metrics.counter(key))
 
 @dataclass(frozen=True)
 class Response:
@@ -148,7 +194,7 @@ class Response:
 
             deleted = self.deleteHeaderItem(CONST_CONTENT_LENGTH)
             if deleted:
-                print(f'header-key({CONST_CONTENT_LENGTH}) is ignore', file=sys.stderr)
+                log.responder.warning('header-key(%s) is ignore', CONST_CONTENT_LENGTH)
 
         else:
             if not self.hasContentLength():
@@ -156,7 +202,24 @@ class Response:
 
             deleted = self.deleteHeaderItem(CONST_TRANSFER_ENCODING)
             if deleted:
-                print(f'header-key({CONST_TRANSFER_ENCODING}) is ignore', file=sys.stderr)
+                log.responder.warning('header-key(%s) is ignore', CONST_TRANSFER_ENCODING)
+
+        timing = histogram.current()
+        if not timing is None and timing.server_timing and self.getKey(CONST_SERVER_TIMING) is None:
+            # ヘッダを送信する時点までに終わった段階 (queue, params, ...) の時間
+            h[CONST_SERVER_TIMING] = timing.header_value()
+
+        if not timing is None:
+            # アクセスログ用
+            key = self.getKey(CONST_STATUS)
+            timing.status = 200
+
+            if key:
+                # 不正な Status はアクセスログに出力しない (None)
+                timing.status = None
+
+                with contextlib.suppress(ValueError, IndexError):
+                    timing.status = int(str(self.headers[key]).split()[0])
 
         h = '\r\n'.join([ f'{k.strip()}: {str(v).strip()}' for k,v in h.items() ])
         h = h.encode('ascii')
@@ -216,7 +279,7 @@ def report_exception(func):
             return func(*args, **kwargs)
 
         except Exception as e:
-            traceback.print_exception(*sys.exc_info(), file=sys.stderr)
+            log.root.exception(f'{func.__name__} failed')
             raise
 
     return wrapper
@@ -248,6 +311,28 @@ def test_response():
         print('6:' + a.getContentLengthKey() + ';')
 
 
+def parse_targets(text:str) -> tuple:
+    '''
+    "addr:port,addr:port,/path/to.sock" --> ((addr, port), (addr, port), '/path/to.sock')
+    '''
+    targets = []
+
+    for a in (text or '').split(','):
+        a = a.strip()
+
+        if not a:
+            continue
+
+        if a.startswith('/') or not ':' in a:
+            targets.append(a)
+
+        else:
+            addr, port = a.rsplit(':', 1)
+            targets.append((addr.strip('[]'), int(port)))
+
+    return tuple(targets)
+
+
 def parse_args():
     #test_response()
     parser = argparse.ArgumentParser()
@@ -262,12 +347,56 @@ def parse_args():
     parser.add_argument('--non-blocking', dest='nonblocking', type=distutils.util.strtobool, default=0, help='use non-blocking select')
     parser.add_argument('--max-stdio-mem', dest='max_stdio_mem', type=int, default=sys.maxsize, help='max size of stdin in memory')
     parser.add_argument('--so-timeout', dest='so_timeout', type=float, default=3.0, help='socket timeout')
+    parser.add_argument('--max-queue', dest='max_queue', type=int, default=0, help='max waiting connections (0: threads x 4)')
+    parser.add_argument('--queue-target', dest='queue_target', type=float, default=0.05, help='acceptable queue time while overloaded')
+    parser.add_argument('--queue-interval', dest='queue_interval', type=float, default=0.5, help='queue time limit, and period to detect overload')
+    parser.add_argument('--reuseport', dest='reuseport', type=distutils.util.strtobool, default=0, help='use SO_REUSEPORT (per-process socket on prefork)')
+    parser.add_argument('--backlog', dest='backlog', type=int, default=socket.SOMAXCONN, help='listen backlog (capped by net.core.somaxconn)')
+    parser.add_argument('--accept-budget', dest='accept_budget', type=int, default=64, help='max connections accepted per wakeup')
+    parser.add_argument('--close-linger', dest='close_linger', type=float, default=0.1, help='seconds a closing connection may wait for the web server\'s close in the background (0: drain on the worker thread)')
+    parser.add_argument('--overload-response', dest='overload_response', choices=('http', 'fcgi'), default='http', help='reject by 503 or FCGI_OVERLOADED')
+    parser.add_argument('--loop-stats', dest='loop_stats', type=distutils.util.strtobool, default=0, help='count every accept-loop iteration')
+    parser.add_argument('--server-timing', dest='server_timing', type=distutils.util.strtobool, default=0, help='add Server-Timing header of elapsed phases')
+    parser.add_argument('--log-level', dest='log_level', default='INFO', help='log level (DEBUG, INFO, WARNING, ...)')
+    parser.add_argument('--log-category', dest='log_categories', action='append', help='log level per category (ex. listener=debug,prefork=warning)')
+    parser.add_argument('--log-path', dest='log_path', help='log file (default: stderr)')
+    parser.add_argument('--access-log', dest='access_log', help='write JSON access log to this file (-: stderr)')
+    parser.add_argument('--slowlog-timeout', dest='slowlog_timeout', type=float, default=0, help='log stack of request running longer than this seconds (0: disable)')
+    parser.add_argument('--slowlog-interval', dest='slowlog_interval', type=float, default=0, help='repeat slowlog every this seconds until finished (0: same as timeout)')
+    parser.add_argument('--request-terminate-timeout', dest='request_terminate_timeout', type=float, default=0, help='replace process (abort the request without prefork) when a request thread has no heartbeat for this seconds (0: disable)')
+    parser.add_argument('--profile-requests', dest='profile_requests', type=int, default=0, help='cProfile this many requests on SIGUSR2 or --profile-path (0: disable)')
+    parser.add_argument('--profile-sample', dest='profile_sample', type=float, default=1.0, help='ratio of requests to profile while profiling')
+    parser.add_argument('--profile-route', dest='profile_route', help='profile only requests whose route (responder class) or SCRIPT_NAME matches this regex')
+    parser.add_argument('--profile-tracemalloc', dest='profile_tracemalloc', type=distutils.util.strtobool, default=0, help='also dump tracemalloc snapshot')
+    parser.add_argument('--profile-path', dest='profile_path', help='start profiling on the process answering this path (needs --profile-requests)')
+    parser.add_argument('--capture-path', dest='capture_path', help='record received FastCGI records to this file (.{pid} is appended) for fcgi-replay.py')
+    parser.add_argument('--capture-sample', dest='capture_sample', type=float, default=1.0, help='ratio of connections to capture')
+    parser.add_argument('--capture-max-body', dest='capture_max_body', type=int, default=4096, help='bytes of FCGI_STDIN to keep per request (-1: all)')
+    parser.add_argument('--proxy-backends', dest='proxy_backends', help='forward requests to these FastCGI servers (ex. 10.0.0.1:9000,10.0.0.2:9000,/run/app.sock)')
+    parser.add_argument('--proxy-balance', dest='proxy_balance', choices=('least', 'hash'), default='least', help='least outstanding requests, or consistent hash of --proxy-hash-param')
+    parser.add_argument('--proxy-hash-param', dest='proxy_hash_param', default='REMOTE_ADDR', help='param for --proxy-balance=hash')
+    parser.add_argument('--proxy-max-connections', dest='proxy_max_connections', type=int, default=0, help='max connections per backend (0: same as threads)')
+    parser.add_argument('--proxy-timeout', dest='proxy_timeout', type=float, default=30.0, help='socket timeout to backends')
+    parser.add_argument('--proxy-health-interval', dest='proxy_health_interval', type=float, default=2.0, help='interval of FCGI_GET_VALUES health check (0: disable)')
+    parser.add_argument('--proxy-eject-failures', dest='proxy_eject_failures', type=int, default=3, help='eject backend after this many consecutive failures')
+    parser.add_argument('--asgi-app', dest='asgi_app', help='run this ASGI application on an asyncio loop per process (ex. myservice.main:app, app.py:app)')
+    parser.add_argument('--asgi-max-reqs', dest='asgi_max_reqs', type=int, default=256, help='max concurrent ASGI requests per process, advertised as FCGI_MAX_REQS (0: unlimited)')
+    parser.add_argument('--cache-max-bytes', dest='cache_max_bytes', type=int, default=0, help='cache BufferingResponder responses up to this many bytes per process (0: disable)')
+    parser.add_argument('--cache-ttl', dest='cache_ttl', type=float, default=0, help='seconds to cache responses without Cache-Control max-age (0: only with max-age)')
+    parser.add_argument('--cache-stale', dest='cache_stale', type=float, default=0, help='seconds to serve stale responses while one request revalidates (without stale-while-revalidate)')
+    parser.add_argument('--cache-vary', dest='cache_vary', default='HTTP_HOST', help='params added to the cache key (ex. HTTP_HOST,HTTP_ACCEPT_ENCODING)')
+    parser.add_argument('--cache-shared', dest='cache_shared', type=distutils.util.strtobool, default=0, help='share the response cache between prefork processes (--cache-max-bytes in total)')
+    parser.add_argument('--coalesce', dest='coalesce', type=distutils.util.strtobool, default=0, help='let concurrent identical GET/HEAD requests wait for one BufferingResponder run')
+    parser.add_argument('--coalesce-timeout', dest='coalesce_timeout', type=float, default=5.0, help='seconds to wait for the identical request before running the responder')
+    parser.add_argument('--status-path', dest='status_path', help='answer pool status at this path (ex. /status, ?format=prometheus)')
 
     cmdargs, _ = parser.parse_known_args()
 
     if not cmdargs.workdir is None:
         os.chdir(cmdargs.workdir)
 
+    log.setup(cmdargs.log_level, log.parse_levels(cmdargs.log_categories), cmdargs.log_path, cmdargs.access_log)
+
     if not cmdargs.pid_path is None:
         # https://qiita.com/pytry3g/items/aa38d8c2acf59b90aaac
         #print(f'{os.getpid()}', file=open(cmdargs.pid_path, 'w'), end='', flush=True)
@@ -285,6 +414,44 @@ def parse_args():
         'nonblocking':   cmdargs.nonblocking != 0,
         'max_stdio_mem': cmdargs.max_stdio_mem,
         'so_timeout':    cmdargs.so_timeout,
+        'max_queue':     cmdargs.max_queue,
+        'queue_target':  cmdargs.queue_target,
+        'queue_interval': cmdargs.queue_interval,
+        'overload_response': cmdargs.overload_response,
+        'reuseport':     cmdargs.reuseport != 0,
+        'backlog':       cmdargs.backlog,
+        'accept_budget': max(cmdargs.accept_budget, 1),
+        'close_linger':  cmdargs.close_linger,
+        'status_path':   cmdargs.status_path,
+        'loop_stats':    cmdargs.loop_stats != 0,
+        'server_timing': cmdargs.server_timing != 0,
+        'slowlog_timeout': cmdargs.slowlog_timeout,
+        'slowlog_interval': cmdargs.slowlog_interval,
+        'request_terminate_timeout': cmdargs.request_terminate_timeout,
+        'profile_requests': cmdargs.profile_requests,
+        'profile_sample': cmdargs.profile_sample,
+        'profile_route': cmdargs.profile_route,
+        'profile_tracemalloc': cmdargs.profile_tracemalloc != 0,
+        'profile_path':  cmdargs.profile_path,
+        'capture_path':  cmdargs.capture_path,
+        'capture_sample': cmdargs.capture_sample,
+        'capture_max_body': cmdargs.capture_max_body,
+        'proxy_backends': parse_targets(cmdargs.proxy_backends),
+        'proxy_balance': cmdargs.proxy_balance,
+        'proxy_hash_param': cmdargs.proxy_hash_param,
+        'proxy_max_connections': cmdargs.proxy_max_connections,
+        'proxy_timeout': cmdargs.proxy_timeout,
+        'proxy_health_interval': cmdargs.proxy_health_interval,
+        'proxy_eject_failures': cmdargs.proxy_eject_failures,
+        'asgi_app':      cmdargs.asgi_app,
+        'asgi_max_reqs': cmdargs.asgi_max_reqs,
+        'cache_max_bytes': cmdargs.cache_max_bytes,
+        'cache_ttl':     cmdargs.cache_ttl,
+        'cache_stale':   cmdargs.cache_stale,
+        'cache_vary':    tuple(( name.strip() for name in cmdargs.cache_vary.split(',') if name.strip() )),
+        'cache_shared':  cmdargs.cache_shared != 0,
+        'coalesce':      cmdargs.coalesce != 0,
+        'coalesce_timeout': cmdargs.coalesce_timeout,
         'extra':         {},
     }
 
@@ -294,8 +461,7 @@ def parse_args():
 def make_context(config:collections.Mapping, *, event_handler:callable=None, responder_factory=None):
     a = (
         os.getpid(),
-        {},                      # _stats
-        threading.Lock(),        # _stats_lock
+        metrics.Metrics(),
         event_handler,
         responder_factory,
         config['bind_addr'],
@@ -305,6 +471,44 @@ def make_context(config:collections.Mapping, *, event_handler:callable=None, res
         config['nonblocking'],
         config['max_stdio_mem'],
         config['so_timeout'],
+        config['max_queue'],
+        config['queue_target'],
+        config['queue_interval'],
+        config['overload_response'],
+        config['reuseport'],
+        config['backlog'],
+        config['accept_budget'],
+        config['close_linger'],
+        config['status_path'],
+        config['loop_stats'],
+        config['server_timing'],
+        config['slowlog_timeout'],
+        config['slowlog_interval'],
+        config['request_terminate_timeout'],
+        config['profile_requests'],
+        config['profile_sample'],
+        config['profile_route'],
+        config['profile_tracemalloc'],
+        config['profile_path'],
+        config['capture_path'],
+        config['capture_sample'],
+        config['capture_max_body'],
+        config['proxy_backends'],
+        config['proxy_balance'],
+        config['proxy_hash_param'],
+        config['proxy_max_connections'],
+        config['proxy_timeout'],
+        config['proxy_health_interval'],
+        config['proxy_eject_failures'],
+        config['asgi_app'],
+        config['asgi_max_reqs'],
+        config['cache_max_bytes'],
+        config['cache_ttl'],
+        config['cache_stale'],
+        config['cache_vary'],
+        config['cache_shared'],
+        config['coalesce'],
+        config['coalesce_timeout'],
         types.MappingProxyType(config['extra']),
     )
 
@@ -343,12 +547,8 @@ def send_record(conn:socket.socket, recordType:int, requestId:int, *, contentDat
                 sum_send = send_record(conn, recordType, requestId, contentData=http_headers)
 
                 with hresp.body.open('rb') as f:
-                    while True:
-                        contentData = f.read(protocol.PACKET_IO_LEN)
-                        if not len(contentData):
-                            break
-
-                        sum_send += send_record(conn, recordType, requestId, contentData=contentData)
+                    # 読み込まずに sendfile で送信する
+                    sum_send += protocol.send_file(conn, recordType, requestId, f, 0, os.fstat(f.fileno()).st_size)
 
                 return sum_send
             else:
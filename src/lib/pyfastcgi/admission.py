@@ -0,0 +1,242 @@
+import contextlib
+import concurrent.futures
+import dataclasses
+import functools
+import socket
+import struct
+import threading
+import time
+import pyfastcgi
+import pyfastcgi.histogram as histogram
+import pyfastcgi.log as log
+import pyfastcgi.metrics as metrics
+import pyfastcgi.protocol as protocol
+import pyfastcgi.reaper as reaper
+import pyfastcgi.responders
+from dataclasses import dataclass
+
+
+OVERLOAD_RESPONSE_HTTP = 'http'
+OVERLOAD_RESPONSE_FCGI = 'fcgi'
+
+# 過負荷時に BEGIN_REQUEST を待つ最大時間 (accept したスレッド以外で拒否する場合)
+REJECT_READ_TIMEOUT = 0.1
+
+STAT_QUEUE_REJECTED     = metrics.counter('queue-rejected')
+STAT_QUEUE_REJECTED_UNREAD = metrics.counter('queue-rejected-unread')
+STAT_QUEUE_SHED         = metrics.counter('queue-shed')
+STAT_QUEUE_WAIT_USEC    = metrics.counter('queue-wait-usec')
+
+
+'''
+ThreadPoolExecutor のキューは上限が無いため、受付済みの接続を数を制限したキュー経由で
+投入し、待ち時間が長くなったものは処理せずに破棄 (load-shedding) する。
+
+破棄の判定は CoDel (Controlled Delay) をリクエストキューに応用した方式
+
+    * 直近 {queue_interval} 秒の間に一度でもキューが空になっていれば正常状態とみなし
+      待ち時間が {queue_interval} を超えたものだけを破棄
+    * 空にならない状態が {queue_interval} 秒以上続いていれば過負荷状態とみなし
+      待ち時間が {queue_target} を超えたものを破棄
+
+Web サーバ側 (fastcgi_read_timeout) で既に諦められているリクエストを処理しないことで
+過負荷時でも応答時間が際限なく伸びないようにする。
+'''
+@dataclass
+class AdmissionQueue:
+    context:pyfastcgi.Context
+    executor:concurrent.futures.ThreadPoolExecutor
+    lock:any = dataclasses.field(init=False, default_factory=threading.Lock)
+    waiting:int = dataclasses.field(init=False, default=0)
+    last_empty:float = dataclasses.field(init=False, default_factory=time.monotonic)
+    pending:dict = dataclasses.field(init=False, default_factory=dict)
+
+    def __post_init__(self):
+        if not self.context.watchdog is None:
+            # 全てのスレッドが停止した場合に、処理待ちの接続に応答できるように
+            self.context.watchdog.queue = self
+
+    @property
+    def max_queue(self) -> int:
+        return self.context.max_queue or self.context.threads * 4
+
+    def submit(self, func:callable, conn:socket.socket, client:tuple) -> bool:
+        enqueued = time.monotonic()
+
+        with self.lock:
+            overflow = self.waiting >= self.max_queue
+
+            if not overflow:
+                if self.waiting == 0:
+                    self.last_empty = enqueued
+
+                self.waiting += 1
+                self.pending[conn] = client
+                self._publish()
+
+        if overflow:
+            # キューに空きがないので即座に拒否 (accept したスレッドなので待たない)
+            self.context.metrics.add(STAT_QUEUE_REJECTED)
+            reject_nowait(self.context, conn)
+
+            return False
+
+        self.executor.submit(self._dequeue, func, enqueued, conn, client)
+
+        return True
+
+    def reject_pending(self):
+        '''
+        処理待ちの接続を全て拒否する (watchdog により子プロセスを終了する前に)
+        '''
+        with self.lock:
+            pending = list(self.pending)
+            self.pending.clear()
+
+        for conn in pending:
+            self.context.metrics.add(STAT_QUEUE_REJECTED)
+            reject_overloaded(self.context, conn)
+
+    def _publish(self):
+        '''
+        prefork の親プロセスが負荷を判断できるよう、処理待ちの数を scoreboard に書き込む
+        '''
+        if not self.context.worker is None:
+            self.context.worker.slot.queued = self.waiting
+
+    def _dequeue(self, func:callable, enqueued:float, conn:socket.socket, client:tuple):
+        now = time.monotonic()
+        sojourn = now - enqueued
+
+        with self.lock:
+            if self.pending.pop(conn, None) is None:
+                # reject_pending() により応答済
+                return
+
+            overloaded = now - self.last_empty > self.context.queue_interval
+
+            self.waiting -= 1
+            if self.waiting == 0:
+                self.last_empty = now
+
+            self._publish()
+
+        self.context.metrics.add(STAT_QUEUE_WAIT_USEC, int(sojourn * 1000000))
+
+        limit = self.context.queue_target if overloaded else self.context.queue_interval
+        if sojourn > limit:
+            self.context.metrics.add(STAT_QUEUE_SHED)
+            log.admission.info('shed %s sojourn=%.3f overloaded=%s', conn, sojourn, overloaded)
+
+            reject_overloaded(self.context, conn)
+            return
+
+        timing = histogram.begin()
+        timing.add(histogram.PHASE_QUEUE, sojourn)
+
+        func(self.context, conn, client)
+
+
+@functools.lru_cache(maxsize=16)
+def overloaded_records(overload_response:str, requestId:int) -> bytes:
+    '''
+    拒否時の応答は requestId 以外は毎回同じなので、送信するレコードを作成して使い回す
+    '''
+    conn = protocol.MemorySocket()
+
+    if overload_response == OVERLOAD_RESPONSE_FCGI:
+        endreq = protocol.FCGI_EndRequestBody(0, protocol.FCGI_OVERLOADED)
+
+    else:
+        responder = pyfastcgi.responders.ServiceUnavailableResponder(None, conn, None, requestId, {})
+        appStatus = responder.do_response() or 0
+
+        endreq = protocol.FCGI_EndRequestBody(appStatus, protocol.FCGI_REQUEST_COMPLETE)
+
+    protocol.send_record(conn, protocol.FCGI_END_REQUEST, requestId, contentData=endreq.dump())
+
+    return bytes(conn.buff)
+
+
+def find_begin_request(data:bytes) -> int:
+    '''
+    受信済みのレコードの列から FCGI_BEGIN_REQUEST の requestId を探す (無ければ None)
+    '''
+    pos = 0
+
+    while pos + protocol.FCGI_HEADER_LEN <= len(data):
+        _, recordType, requestId, contentLength, paddingLength, _ = struct.unpack_from('>2B2H2B', data, pos)
+
+        if recordType == protocol.FCGI_BEGIN_REQUEST:
+            return requestId
+
+        pos += protocol.FCGI_HEADER_LEN + contentLength + paddingLength
+
+    return None
+
+
+def reject_nowait(context:pyfastcgi.Context, conn:socket.socket):
+    '''
+    accept したスレッドで拒否する
+
+    既に届いている分だけを読み、FCGI_BEGIN_REQUEST があれば拒否の応答を送信する
+    まだ届いていなければ応答せずに閉じる (待つと過負荷の間 accept が止まるため)
+    '''
+    try:
+        conn.setblocking(False)
+
+        data = bytearray()
+        requestId = None
+
+        with contextlib.suppress(BlockingIOError, InterruptedError):
+            while requestId is None:
+                chunk = conn.recv(protocol.PACKET_IO_LEN)
+                if not chunk:
+                    break
+
+                data += chunk
+                requestId = find_begin_request(data)
+
+        if requestId is None:
+            context.metrics.add(STAT_QUEUE_REJECTED_UNREAD)
+
+        else:
+            conn.sendall(overloaded_records(context.overload_response, requestId))
+
+    except (ConnectionError, BlockingIOError):
+        # ignore
+        pass
+
+    except:
+        # ignore
+        log.admission.warning('reject overloaded', exc_info=True)
+
+    finally:
+        reaper.close(context, conn)
+
+
+def reject_overloaded(context:pyfastcgi.Context, conn:socket.socket):
+    try:
+        conn.settimeout(min(context.so_timeout, REJECT_READ_TIMEOUT))
+
+        while True:
+            record = protocol.read_record(conn)
+
+            if record.header.recordType == protocol.FCGI_BEGIN_REQUEST:
+                break
+
+        conn.sendall(overloaded_records(context.overload_response, record.header.requestId))
+
+    except (ConnectionError, socket.timeout):
+        # ignore
+        pass
+
+    except:
+        # ignore
+        log.admission.warning('reject overloaded', exc_info=True)
+
+    finally:
+        reaper.close(context, conn)
+
+
+# EOF
@@ -0,0 +1,552 @@
+import os
+import asyncio
+import collections
+import dataclasses
+import http.client
+import importlib
+import importlib.util
+import socket
+import struct
+import urllib.parse
+import pyfastcgi
+import pyfastcgi.listener as listener
+import pyfastcgi.log as log
+import pyfastcgi.protocol as protocol
+from dataclasses import dataclass
+
+
+'''
+ASGI (3.0) のアプリケーションを asyncio のイベントループで実行する (--asgi-app)
+
+    python prefork.py --asgi-app=myservice.main:app --procs=4
+
+    * 子プロセス毎にイベントループを一つ動かし、リクエスト毎のスレッドは使わない
+      (--threads, --non-blocking は使われない)
+    * --asgi-app は "module:attr" または "path/to/app.py:attr" (attr の既定は app)
+    * lifespan (startup, shutdown) は子プロセス毎に送信する (対応していないアプリケーションは無視)
+    * 子プロセス毎に実行中のリクエストが --asgi-max-reqs に達していれば、新しいリクエストには
+      FCGI_OVERLOADED を返す (FCGI_GET_VALUES の FCGI_MAX_REQS として通知する値)
+
+FastCGI との対応
+
+    FCGI_PARAMS         --> scope (type=http)
+    FCGI_STDIN          --> http.request (空のレコードで more_body=False)
+    FCGI_ABORT_REQUEST, 接続の切断
+                        --> http.disconnect (FCGI_ABORT_REQUEST には FCGI_END_REQUEST を返す)
+    http.response.start --> 最初の body と一つの FCGI_STDOUT にまとめて送信する
+    http.response.body  --> FCGI_STDOUT (送信毎に drain して、応答全体を溜めない)
+
+* 一つの接続の受信はそれぞれのタスクで行い、requestId 毎に振り分ける
+  (FCGI_ABORT_REQUEST を応答中にも受信できるように)
+* status-path, profile, capture, watchdog はスレッドの responder 用なので使われない
+'''
+
+ASGI_VERSION = { 'version': '3.0', 'spec_version': '2.3' }
+
+# FCGI_STDIN をアプリケーションが読まずに溜めておく最大のレコード数
+# (超えると接続からの受信を止める)
+STDIN_QUEUE_MAX = 16
+
+
+class ClientDisconnected(OSError): ...
+
+
+def load_app(spec:str) -> callable:
+    '''
+    "module:attr" または "path/to/app.py:attr"
+    '''
+    name, _, attr = spec.partition(':')
+
+    if name.endswith('.py'):
+        mod_spec = importlib.util.spec_from_file_location(os.path.splitext(os.path.basename(name))[0], name)
+        module = importlib.util.module_from_spec(mod_spec)
+        mod_spec.loader.exec_module(module)
+
+    else:
+        module = importlib.import_module(name)
+
+    return getattr(module, attr or 'app')
+
+
+async def read_record(reader:asyncio.StreamReader) -> tuple:
+    '''
+    (recordType, requestId, contentData)
+    '''
+    header = await reader.readexactly(protocol.FCGI_HEADER_LEN)
+    version, recordType, requestId, contentLength, paddingLength, _ = struct.unpack('>2B2H2B', header)
+    assert version == protocol.FCGI_VERSION_1
+
+    data = b''
+    if contentLength + paddingLength:
+        data = await reader.readexactly(contentLength + paddingLength)
+
+    return recordType, requestId, data[:contentLength]
+
+
+def make_scope(params:dict, client:tuple, state:dict) -> dict:
+    '''
+    FCGI_PARAMS から HTTP の scope を作る (PATH_INFO が空の場合は REQUEST_URI のパス)
+    '''
+    request_uri = params.get('REQUEST_URI', '')
+    raw_path = request_uri.split('?', 1)[0]
+
+    if params.get('PATH_INFO'):
+        root_path = params.get('SCRIPT_NAME', '')
+        path = params['PATH_INFO']
+
+    else:
+        root_path = ''
+        path = urllib.parse.unquote(raw_path or params.get('SCRIPT_NAME', '/'))
+
+    headers = []
+
+    for key, value in params.items():
+        if key.startswith('HTTP_'):
+            headers.append((key[5:].lower().replace('_', '-').encode('latin-1'), value.encode('latin-1', 'replace')))
+
+        elif key in (protocol.FCGI_PARAMSKEY_CONTENT_TYPE, protocol.FCGI_PARAMSKEY_CONTENT_LENGTH) and value:
+            headers.append((key.lower().replace('_', '-').encode('latin-1'), value.encode('latin-1', 'replace')))
+
+    https = params.get('HTTPS', '').lower() in ('on', '1')
+    server_port = params.get('SERVER_PORT', '')
+    remote_port = params.get('REMOTE_PORT', '')
+
+    return {
+        'type':         'http',
+        'asgi':         ASGI_VERSION,
+        'http_version': params.get('SERVER_PROTOCOL', 'HTTP/1.1').split('/', 1)[-1],
+        'method':       params.get('REQUEST_METHOD', 'GET'),
+        'scheme':       params.get('REQUEST_SCHEME') or ('https' if https else 'http'),
+        'path':         path,
+        'raw_path':     raw_path.encode('latin-1', 'replace'),
+        'query_string': params.get('QUERY_STRING', '').encode('latin-1', 'replace'),
+        'root_path':    root_path,
+        'headers':      headers,
+        'client':       (params['REMOTE_ADDR'], int(remote_port)) if 'REMOTE_ADDR' in params and remote_port.isdigit() else client,
+        'server':       (params.get('SERVER_ADDR') or params.get('SERVER_NAME', ''), int(server_port)) if server_port.isdigit() else None,
+        'state':        dict(state),
+    }
+
+
+@dataclass(eq=False)
+class _Request:
+    connection:'_Connection'
+    requestId:int
+    keep_conn:bool
+    params_data:bytearray = dataclasses.field(default_factory=bytearray)
+    chunks:collections.deque = dataclasses.field(default_factory=collections.deque)
+    stdin_done:bool = False
+    body_done:bool = False
+    disconnected:bool = False
+    aborted:bool = False
+    head:bytes = None
+    started:bool = False
+    finished:bool = False
+    status:int = 0
+    changed:asyncio.Event = dataclasses.field(default_factory=asyncio.Event)
+    space:asyncio.Event = dataclasses.field(default_factory=asyncio.Event)
+    task:asyncio.Task = None
+
+    def notify(self):
+        self.changed.set()
+        self.space.set()
+
+    def disconnect(self):
+        self.disconnected = True
+        self.notify()
+
+    def abort(self):
+        '''
+        FCGI_ABORT_REQUEST (以降の FCGI_STDIN は送られず、FCGI_END_REQUEST は返す)
+        '''
+        self.aborted = True
+        self.chunks.clear()
+        self.stdin_done = self.body_done = True
+        self.disconnect()
+
+    async def push_stdin(self, data:bytes):
+        if not data:
+            self.stdin_done = True
+            self.notify()
+            return
+
+        # アプリケーションが読むまで待つ (応答済であれば捨てる)
+        while len(self.chunks) >= STDIN_QUEUE_MAX and not (self.disconnected or self.finished):
+            self.space.clear()
+            await self.space.wait()
+
+        if not self.finished:
+            self.chunks.append(data)
+            self.changed.set()
+
+    async def receive(self) -> dict:
+        while True:
+            if self.chunks:
+                data = self.chunks.popleft()
+                self.space.set()
+
+                more_body = bool(self.chunks) or not self.stdin_done
+                self.body_done = not more_body
+
+                return { 'type': 'http.request', 'body': data, 'more_body': more_body }
+
+            if self.stdin_done and not self.body_done:
+                self.body_done = True
+
+                return { 'type': 'http.request', 'body': b'', 'more_body': False }
+
+            if self.disconnected or self.finished:
+                return { 'type': 'http.disconnect' }
+
+            self.changed.clear()
+            await self.changed.wait()
+
+    async def send(self, message:dict):
+        mtype = message['type']
+
+        if self.disconnected:
+            raise ClientDisconnected(f'request {self.requestId} disconnected')
+
+        if mtype == 'http.response.start':
+            if self.started:
+                raise RuntimeError('http.response.start was already sent')
+
+            self.started = True
+            self.status = message['status']
+
+            reason = http.client.responses.get(self.status, '')
+            lines = [ f'Status: {self.status} {reason}'.rstrip().encode('latin-1') ]
+            lines.extend(( bytes(name) + b': ' + bytes(value) for name, value in message.get('headers', ()) ))
+
+            self.head = b'\r\n'.join(lines) + b'\r\n\r\n'
+
+        elif mtype == 'http.response.body':
+            if not self.started:
+                raise RuntimeError('http.response.start must be sent before http.response.body')
+
+            if self.finished:
+                raise RuntimeError('response already completed')
+
+            body = message.get('body', b'')
+            more_body = message.get('more_body', False)
+
+            if not self.head is None:
+                body = self.head + body
+                self.head = None
+
+            if body:
+                await self.connection.write(protocol.dump_records(protocol.FCGI_STDOUT, self.requestId, body))
+
+            if not more_body:
+                await self.finish(0)
+
+    async def finish(self, appStatus:int):
+        if self.finished:
+            return
+
+        self.finished = True
+        self.notify()
+
+        endreq = protocol.FCGI_EndRequestBody(appStatus, protocol.FCGI_REQUEST_COMPLETE)
+
+        await self.connection.write(protocol.dump_records(protocol.FCGI_STDOUT, self.requestId, b'')
+            + protocol.make_record(protocol.FCGI_END_REQUEST, self.requestId, contentData=endreq.dump()).dump())
+
+    async def send_error(self, code:int):
+        reason = http.client.responses[code]
+        body = f'<!doctype html><html><body>{code} {reason}</body></html>'.encode('utf-8')
+
+        self.started = True
+        self.status = code
+        self.head = None
+
+        data = f'Status: {code} {reason}\r\nContent-Type: text/html; charset=utf-8\r\nContent-Length: {len(body)}\r\n\r\n'.encode('utf-8') + body
+
+        await self.connection.write(protocol.dump_records(protocol.FCGI_STDOUT, self.requestId, data))
+        await self.finish(1)
+
+
+@dataclass(eq=False)
+class _Connection:
+    server:'_Server'
+    reader:asyncio.StreamReader
+    writer:asyncio.StreamWriter
+    client:tuple
+    requests:dict = dataclasses.field(default_factory=dict)
+    bytes_in:int = 0
+    bytes_out:int = 0
+    closing:bool = False
+
+    async def write(self, data:bytes):
+        if self.writer.is_closing():
+            raise ClientDisconnected('connection closed')
+
+        self.writer.write(data)
+        self.bytes_out += len(data)
+
+        await self.writer.drain()
+
+    def close_if_done(self):
+        '''
+        FCGI_KEEP_CONN でない場合は、応答と FCGI_STDIN の受信が終われば閉じる
+        (FCGI_STDIN を読み残したまま閉じると Web サーバ側で切断のエラーになるため)
+        '''
+        for req in list(self.requests.values()):
+            if req.finished and req.stdin_done:
+                del self.requests[req.requestId]
+
+                if not req.keep_conn:
+                    self.closing = True
+
+        if self.closing and not self.requests:
+            self.writer.close()
+
+    async def run(self):
+        try:
+            while not self.writer.is_closing():
+                timeout = None if self.requests else self.server.context.so_timeout
+
+                try:
+                    recordType, requestId, data = await asyncio.wait_for(read_record(self.reader), timeout)
+
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    break
+
+                self.bytes_in += protocol.FCGI_HEADER_LEN + len(data)
+                await self.dispatch(recordType, requestId, data)
+                self.close_if_done()
+
+        finally:
+            for req in self.requests.values():
+                req.disconnect()
+
+            tasks = [ req.task for req in self.requests.values() if not req.task is None ]
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+            self.writer.close()
+
+    async def dispatch(self, recordType:int, requestId:int, data:bytes):
+        if requestId == protocol.FCGI_NULL_REQUEST_ID:
+            rtype, rdata = listener.management_record(self.server.context, recordType, data)
+            await self.write(protocol.make_record(rtype, requestId, contentData=rdata).dump())
+            return
+
+        if recordType == protocol.FCGI_BEGIN_REQUEST:
+            role, flags, _ = struct.unpack('>HB5s', data)
+            req = _Request(self, requestId, bool(flags & protocol.FCGI_KEEP_CONN))
+            self.requests[requestId] = req
+
+            if role != protocol.FCGI_RESPONDER:
+                protocolStatus = protocol.FCGI_UNKNOWN_ROLE
+
+            elif self.server.overloaded():
+                protocolStatus = protocol.FCGI_OVERLOADED
+
+            else:
+                return
+
+            req.stdin_done = req.finished = True
+            endreq = protocol.FCGI_EndRequestBody(0, protocolStatus)
+            await self.write(protocol.make_record(protocol.FCGI_END_REQUEST, requestId, contentData=endreq.dump()).dump())
+
+            return
+
+        req = self.requests.get(requestId)
+        if req is None or (req.finished and recordType != protocol.FCGI_STDIN):
+            return
+
+        if recordType == protocol.FCGI_PARAMS:
+            if data:
+                req.params_data += data
+
+            elif req.task is None:
+                req.task = asyncio.get_running_loop().create_task(self.server.handle(req))
+
+        elif recordType == protocol.FCGI_STDIN:
+            await req.push_stdin(data)
+
+        elif recordType == protocol.FCGI_ABORT_REQUEST:
+            req.abort()
+
+            if req.task is None:
+                # アプリケーションを開始する前
+                await req.finish(1)
+
+
+@dataclass(eq=False)
+class _Server:
+    context:pyfastcgi.Context
+    app:callable
+    state:dict = dataclasses.field(default_factory=dict)
+    connections:set = dataclasses.field(default_factory=set)
+    lifespan_queue:asyncio.Queue = None
+    lifespan_reply:asyncio.Future = None
+    lifespan_supported:bool = True
+    lifespan_task:asyncio.Task = None
+    active:int = 0
+
+    def overloaded(self) -> bool:
+        return self.context.asgi_max_reqs > 0 and self.active >= self.context.asgi_max_reqs
+
+    async def handle(self, req:_Request):
+        context = self.context
+
+        with memoryview(req.params_data) as mem:
+            params = protocol.make_params(mem)
+
+        ok = False
+        self.active += 1
+
+        try:
+            await self.app(make_scope(params, req.connection.client, self.state), req.receive, req.send)
+
+            if not req.started:
+                raise RuntimeError('application returned without http.response.start')
+
+            ok = True
+
+        except ClientDisconnected:
+            log.listener.debug('client disconnected requestId=%d', req.requestId)
+
+        except Exception:
+            log.listener.exception('asgi application failed: %s', params.get('REQUEST_URI'))
+
+            if not req.started and not req.disconnected:
+                try:
+                    await req.send_error(http.HTTPStatus.INTERNAL_SERVER_ERROR)
+
+                except ClientDisconnected:
+                    pass
+
+        finally:
+            self.active -= 1
+            listener.count_response(context, ok)
+
+            if not req.disconnected or req.aborted:
+                try:
+                    # 応答の途中で終わった場合も FCGI_END_REQUEST で終える
+                    await req.finish(0 if ok else 1)
+
+                except ClientDisconnected:
+                    pass
+
+            req.connection.close_if_done()
+
+    async def on_connected(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        context = self.context
+        sock = writer.get_extra_info('socket')
+        peer = writer.get_extra_info('peername')
+
+        listener.count_accepted(context)
+        context.handler(pyfastcgi.Event('ACCEPT', { 'ssock': None, 'executor': None, 'conn': sock }))
+
+        if not context.worker is None:
+            context.worker.begin_request()
+
+        if not sock is None and sock.family != socket.AF_UNIX:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        connection = _Connection(self, reader, writer, peer if type(peer) == tuple else ('', 0))
+        self.connections.add(connection)
+
+        try:
+            await connection.run()
+
+        finally:
+            self.connections.discard(connection)
+
+            if not context.worker is None:
+                context.worker.end_request(connection.bytes_in, connection.bytes_out)
+
+    async def lifespan(self, event:str) -> bool:
+        '''
+        lifespan.startup / lifespan.shutdown を送信する
+        (対応していないアプリケーションは例外で終わるので無視する)
+        '''
+        if self.lifespan_queue is None:
+            self.lifespan_queue = asyncio.Queue()
+
+            async def receive():
+                return await self.lifespan_queue.get()
+
+            async def send(message:dict):
+                self.lifespan_reply.set_result(message)
+
+            async def run():
+                try:
+                    await self.app({ 'type': 'lifespan', 'asgi': ASGI_VERSION, 'state': self.state }, receive, send)
+
+                except Exception:
+                    log.listener.debug('lifespan not supported', exc_info=True)
+
+                finally:
+                    self.lifespan_supported = False
+
+                    if not self.lifespan_reply is None and not self.lifespan_reply.done():
+                        self.lifespan_reply.set_result(None)
+
+            self.lifespan_task = asyncio.get_running_loop().create_task(run())
+
+        if not self.lifespan_supported:
+            return True
+
+        self.lifespan_reply = asyncio.get_running_loop().create_future()
+        await self.lifespan_queue.put({ 'type': f'lifespan.{event}' })
+
+        reply = await self.lifespan_reply
+
+        if not reply is None and reply['type'].endswith('.failed'):
+            log.listener.error('lifespan.%s failed: %s', event, reply.get('message', ''))
+            return False
+
+        return True
+
+    async def serve(self, ssock:socket.socket):
+        context = self.context
+
+        if not await self.lifespan('startup'):
+            return
+
+        ssock.setblocking(False)
+
+        if ssock.family == socket.AF_UNIX:
+            server = await asyncio.start_unix_server(self.on_connected, sock=ssock)
+
+        else:
+            server = await asyncio.start_server(self.on_connected, sock=ssock)
+
+        log.listener.info('asgi %s', context.asgi_app)
+
+        try:
+            while context.loop:
+                await asyncio.sleep(context.so_timeout)
+
+                if context.loop:
+                    if not context.worker is None:
+                        context.worker.publish()
+
+                    context.handler(pyfastcgi.Event('IDLE'))
+
+        finally:
+            server.close()
+
+            '''
+            処理中のリクエストは終わるまで待つ (待機中の FCGI_KEEP_CONN の接続は --so-timeout で閉じられる)
+            '''
+            while self.connections:
+                await asyncio.sleep(0.1)
+
+            await self.lifespan('shutdown')
+
+
+def serve(context:pyfastcgi.Context, ssock:socket.socket):
+    '''
+    prefork の場合は子プロセスで実行される (アプリケーションもここで読み込む)
+    '''
+    server = _Server(context, load_app(context.asgi_app))
+
+    asyncio.run(server.serve(ssock))
+
+
+# EOF
@@ -0,0 +1,435 @@
+import collections
+import dataclasses
+import re
+import struct
+import threading
+import time
+import pyfastcgi
+import pyfastcgi.log as log
+import pyfastcgi.metrics as metrics
+import pyfastcgi.protocol as protocol
+from dataclasses import dataclass
+
+
+'''
+応答のキャッシュ (--cache-max-bytes)
+
+BufferingResponder.make_response() の応答を、送信する FCGI_STDOUT のレコード (ヘッダを含む)
+のまま子プロセス毎のメモリに保存し、同じリクエストには responder を実行せずにそのまま送信する
+
+    python prefork.py --cache-max-bytes=67108864 --cache-ttl=5 --cache-vary=HTTP_HOST,HTTP_ACCEPT_ENCODING
+
+キー
+
+    REQUEST_METHOD + REQUEST_URI + --cache-vary の params の値
+
+    * GET と HEAD のみ (FCGI_STDIN があるもの、Authorization があるものは対象外)
+    * リクエストの Cache-Control: no-cache (Pragma: no-cache) は保存済の応答を使わない
+      (応答は保存する)
+
+保存する応答
+
+    * Status が CACHEABLE_STATUS のいずれか (Status が無い場合は 200)
+    * 有効期間は Cache-Control の s-maxage, max-age (無い場合は --cache-ttl, 0 であれば保存しない)
+    * Cache-Control の no-store, no-cache, private, Set-Cookie があるものは保存しない
+    * Vary は、全て --cache-vary に含まれている場合のみ保存する (Vary: * は保存しない)
+    * 大きさが --cache-max-bytes / MAX_ENTRY_FRACTION を超えるもの、一時ファイル (ファイル) の
+      応答は保存しない
+    * 保存したバイト列をそのまま返すので、Age は付加しない
+
+stale-while-revalidate
+
+    Cache-Control の stale-while-revalidate (無い場合は --cache-stale) の間は、期限切れの応答を
+    返しながら最初の一つのリクエストだけが responder を実行して更新する
+    (更新が REVALIDATE_TIMEOUT 秒を過ぎても終わらない場合は次のリクエストも更新する)
+
+* 上限 (--cache-max-bytes) を超えた分は最も長く使われていないもの (LRU) から削除する
+* prefork で --cache-shared を指定した場合は子プロセス間で共有する (pyfastcgi.util.shmcache)
+* ヒット率などは status-path の cache_* に出力する
+* --asgi-app, --proxy-backends では使われない
+'''
+
+RESULT_HIT = 'hit'
+RESULT_STALE = 'stale'
+RESULT_MISS = 'miss'
+
+STAT_CACHE_HIT      = metrics.counter('cache-hit')
+STAT_CACHE_STALE    = metrics.counter('cache-stale')
+STAT_CACHE_MISS     = metrics.counter('cache-miss')
+
+CACHEABLE_METHODS = ('GET', 'HEAD')
+CACHEABLE_STATUS = (200, 203, 204, 300, 301, 404, 405, 410, 414, 501)
+
+# 一つの応答の大きさの上限 (--cache-max-bytes に対する割合)
+MAX_ENTRY_FRACTION = 8
+
+# stale-while-revalidate で更新中の応答を、更新が失敗したとみなすまでの秒数
+REVALIDATE_TIMEOUT = 10.0
+
+_CACHE_CONTROL_ITEM = re.compile(r'\s*([\w-]+)\s*(?:=\s*"?([^",]*)"?)?\s*(?:,|$)')
+
+
+def parse_cache_control(value:str) -> dict:
+    '''
+    'max-age=60, public' --> { 'max-age': '60', 'public': None }
+    '''
+    return { m.group(1).lower(): m.group(2) for m in _CACHE_CONTROL_ITEM.finditer(value or '') if m.group(1) }
+
+
+def bypass_request(params:dict) -> bool:
+    '''
+    Cache-Control: no-cache (Pragma: no-cache) のリクエストは保存済の応答を使わない
+    '''
+    request_cc = parse_cache_control(params.get('HTTP_CACHE_CONTROL'))
+
+    return 'no-cache' in request_cc or 'no-cache' in params.get('HTTP_PRAGMA', '').lower()
+
+
+def _seconds(directives:dict, name:str) -> float:
+    try:
+        return max(float(directives[name]), 0.0)
+
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def vary_param(header:str) -> str:
+    '''
+    'Accept-Encoding' --> 'HTTP_ACCEPT_ENCODING'
+    '''
+    return 'HTTP_' + header.strip().upper().replace('-', '_')
+
+
+def split_headers(payload:bytes) -> dict:
+    '''
+    FCGI_STDOUT の先頭のヘッダ部分 (名前は小文字、同じ名前は ', ' で連結)
+    '''
+    head = payload.split(b'\r\n\r\n', 1)[0] if b'\r\n\r\n' in payload else payload.split(b'\n\n', 1)[0]
+    headers = {}
+
+    for line in head.decode('latin-1').splitlines():
+        name, sep, value = line.partition(':')
+
+        if sep:
+            name = name.strip().lower()
+            headers[name] = f'{headers[name]}, {value.strip()}' if name in headers else value.strip()
+
+    return headers
+
+
+def strip_header(payload:bytes, name:str) -> bytes:
+    '''
+    FCGI_STDOUT の先頭のヘッダ部分から {name} のヘッダを除く (無ければ {payload} をそのまま返す)
+    '''
+    sep = b'\r\n\r\n' if b'\r\n\r\n' in payload else b'\n\n'
+    head, found, body = payload.partition(sep)
+
+    if not found:
+        return payload
+
+    # 最後の行には改行が無いので、区切りと同じ改行で分ける
+    eol = sep[:len(sep) // 2]
+    bname = name.lower().encode('latin-1')
+    lines = head.split(eol)
+    kept = [ line for line in lines if line.split(b':', 1)[0].strip().lower() != bname ]
+
+    if len(kept) == len(lines):
+        return payload
+
+    return eol.join(kept) + found + body
+
+
+def request_key(params:dict, vary:tuple) -> str:
+    '''
+    キャッシュ (と pyfastcgi.coalesce) の対象でないリクエストは None
+    '''
+    method = params.get('REQUEST_METHOD', 'GET')
+
+    if not method in CACHEABLE_METHODS or params.get('HTTP_AUTHORIZATION'):
+        return None
+
+    if (params.get(protocol.FCGI_PARAMSKEY_CONTENT_LENGTH) or '0') != '0':
+        return None
+
+    return '\0'.join([ method, params.get('REQUEST_URI', '') ] + [ params.get(name, '') for name in vary ])
+
+
+def shareable(headers:dict, vary:tuple) -> bool:
+    '''
+    他のリクエストに返してよい応答か (有効期間は見ない)
+    '''
+    try:
+        code = int(headers.get('status', '200').split(None, 1)[0])
+
+    except (IndexError, ValueError):
+        return False
+
+    if not code in CACHEABLE_STATUS or 'set-cookie' in headers:
+        return False
+
+    names = [ name.strip() for name in headers.get('vary', '').split(',') if name.strip() ]
+
+    if '*' in names or any(( not vary_param(name) in vary for name in names )):
+        return False
+
+    cc = parse_cache_control(headers.get('cache-control'))
+
+    return not ('no-store' in cc or 'no-cache' in cc or 'private' in cc)
+
+
+def response_payload(stdout_data) -> bytes:
+    '''
+    保存できる応答 (メモリ上のもの) であれば FCGI_STDOUT の content を返す
+    '''
+    cdtype = pyfastcgi.stdio_type(stdout_data)
+
+    if cdtype == pyfastcgi.StdioType.MEMORY:
+        return bytes(stdout_data)
+
+    if cdtype == pyfastcgi.StdioType.STRING:
+        return stdout_data.encode('utf-8')
+
+    if cdtype == pyfastcgi.StdioType.RESPONSE:
+        rbtype = pyfastcgi.stdio_type(stdout_data.body)
+
+        if rbtype in (pyfastcgi.StdioType.NONE, pyfastcgi.StdioType.MEMORY):
+            return bytes(stdout_data.dump())
+
+        if rbtype == pyfastcgi.StdioType.STRING:
+            return pyfastcgi.Response(stdout_data.headers, stdout_data.body.encode('utf-8')).dump()
+
+    return None
+
+
+def relabel_records(data:bytes, requestId:int) -> bytes:
+    '''
+    レコードの列の requestId を書き換える (保存した時と requestId が異なる場合)
+    '''
+    buff = bytearray(data)
+    pos = 0
+
+    while pos < len(buff):
+        _, _, _, contentLength, paddingLength, _ = struct.unpack_from('>2B2H2B', buff, pos)
+        struct.pack_into('>H', buff, pos + 2, requestId)
+
+        pos += protocol.FCGI_HEADER_LEN + contentLength + paddingLength
+
+    return bytes(buff)
+
+
+@dataclass(eq=False)
+class Entry:
+    requestId:int
+    data:bytes
+    expires:float           # time.monotonic()
+    stale_until:float
+    revalidating:float = 0.0
+
+    def records(self, requestId:int) -> bytes:
+        return self.data if requestId == self.requestId else relabel_records(self.data, requestId)
+
+    def status(self) -> int:
+        '''
+        保存した応答の Status (アクセスログ用、最初の FCGI_STDOUT のヘッダから)
+        '''
+        contentLength, = struct.unpack_from('>H', self.data, 4)
+        headers = split_headers(self.data[protocol.FCGI_HEADER_LEN:protocol.FCGI_HEADER_LEN + contentLength])
+
+        try:
+            return int(headers.get('status', '200').split(None, 1)[0])
+
+        except (IndexError, ValueError):
+            return None
+
+
+@dataclass
+class ResponseCache:
+    max_bytes:int
+    ttl:float = 0.0
+    stale:float = 0.0
+    vary:tuple = ()
+    entries:collections.OrderedDict = dataclasses.field(init=False, default_factory=collections.OrderedDict)
+    nbytes:int = dataclasses.field(init=False, default=0)
+    lock:any = dataclasses.field(init=False, default_factory=threading.Lock)
+
+    @property
+    def max_entry_bytes(self) -> int:
+        return self.max_bytes // MAX_ENTRY_FRACTION
+
+    def make_key(self, params:dict) -> str:
+        return request_key(params, self.vary)
+
+    def lookup(self, key:str, params:dict) -> tuple:
+        '''
+        (RESULT_*, Entry)
+
+        RESULT_MISS の場合は responder を実行して store() すること
+        (stale-while-revalidate で更新を任された場合も RESULT_MISS)
+        '''
+        if bypass_request(params):
+            return RESULT_MISS, None
+
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                return RESULT_MISS, None
+
+            if now < entry.expires:
+                self.entries.move_to_end(key)
+                return RESULT_HIT, entry
+
+            if now < entry.stale_until:
+                if now - entry.revalidating < REVALIDATE_TIMEOUT:
+                    # 他のリクエストが更新中
+                    self.entries.move_to_end(key)
+                    return RESULT_STALE, entry
+
+                entry.revalidating = now
+                return RESULT_MISS, None
+
+            self._remove(key)
+
+        return RESULT_MISS, None
+
+    def freshness(self, params:dict, payload:bytes) -> tuple:
+        '''
+        保存できる応答であれば (有効期間, stale-while-revalidate の期間)、できなければ None
+        '''
+        if len(payload) > self.max_entry_bytes:
+            return None
+
+        headers = split_headers(payload)
+
+        if not shareable(headers, self.vary):
+            return None
+
+        cc = parse_cache_control(headers.get('cache-control'))
+
+        ttl = _seconds(cc, 's-maxage')
+        if ttl is None:
+            ttl = _seconds(cc, 'max-age')
+
+        if ttl is None:
+            ttl = self.ttl
+
+        if ttl <= 0:
+            return None
+
+        stale = _seconds(cc, 'stale-while-revalidate')
+
+        return ttl, self.stale if stale is None else stale
+
+    def store(self, key:str, requestId:int, data:bytes, ttl:float, stale:float):
+        now = time.monotonic()
+        entry = Entry(requestId, data, now + ttl, now + ttl + stale)
+
+        with self.lock:
+            self._remove(key)
+
+            self.entries[key] = entry
+            self.nbytes += len(data)
+
+            while self.nbytes > self.max_bytes and self.entries:
+                evicted, _ = next(iter(self.entries.items()))
+                self._remove(evicted)
+
+    def _remove(self, key:str):
+        entry = self.entries.pop(key, None)
+
+        if not entry is None:
+            self.nbytes -= len(entry.data)
+
+    def state(self) -> dict:
+        with self.lock:
+            return { 'entries': len(self.entries), 'bytes': self.nbytes, 'max_bytes': self.max_bytes }
+
+    def report_usage(self, context:pyfastcgi.Context):
+        if not context.worker is None:
+            context.worker.cache_usage(self.nbytes)
+
+
+def count_result(context:pyfastcgi.Context, result:str):
+    context.metrics.add({ RESULT_HIT: STAT_CACHE_HIT, RESULT_STALE: STAT_CACHE_STALE, RESULT_MISS: STAT_CACHE_MISS }[result])
+
+    if not context.worker is None:
+        context.worker.count_cache(result)
+
+
+def lookup_response(context:pyfastcgi.Context, params:dict) -> Entry:
+    '''
+    保存済の応答があれば返す (無ければ None)
+    '''
+    cache = context.cache
+    if cache is None:
+        return None
+
+    key = cache.make_key(params)
+    if key is None:
+        return None
+
+    result, entry = cache.lookup(key, params)
+    count_result(context, result)
+
+    return entry
+
+
+def store_response(context:pyfastcgi.Context, conn, requestId:int, params:dict, stdout_data, flight=None) -> bool:
+    '''
+    保存できる応答であれば、レコードにして送信して保存する (送信しなかった場合は False)
+
+    {flight} (pyfastcgi.coalesce.Flight) があれば、他のリクエストに返せる応答を渡す
+    '''
+    cache = context.cache
+    key = cache.make_key(params) if not cache is None else None
+
+    if key is None and flight is None:
+        return False
+
+    payload = response_payload(stdout_data)
+    if payload is None:
+        return False
+
+    freshness = cache.freshness(params, payload) if not key is None else None
+    shared = not flight is None and shareable(split_headers(payload), flight.vary)
+
+    if freshness is None and not shared:
+        return False
+
+    data = protocol.dump_records(protocol.FCGI_STDOUT, requestId, payload)
+    conn.sendall(data)
+
+    # Server-Timing (--server-timing) はこのリクエストの処理時間なので、他のリクエストに返す応答には含めない
+    stored = strip_header(payload, pyfastcgi.CONST_SERVER_TIMING)
+    if not stored is payload:
+        data = protocol.dump_records(protocol.FCGI_STDOUT, requestId, stored)
+
+    if not freshness is None:
+        cache.store(key, requestId, data, *freshness)
+        cache.report_usage(context)
+
+    if shared:
+        flight.publish(requestId, data)
+
+    return True
+
+
+def start_cache(context:pyfastcgi.Context) -> ResponseCache:
+    '''
+    prefork の場合は子プロセスで作成される (子プロセス毎のキャッシュ)
+    '''
+    if context.cache_max_bytes <= 0 or context.asgi_app or context.proxy_backends:
+        return None
+
+    if not context.cache is None:
+        # fork 前に親プロセスが確保した共有のキャッシュ (--cache-shared)
+        return context.cache
+
+    log.listener.info('response cache max_bytes=%d ttl=%.1f vary=%s', context.cache_max_bytes, context.cache_ttl, ','.join(context.cache_vary))
+
+    return ResponseCache(context.cache_max_bytes, context.cache_ttl, context.cache_stale, context.cache_vary)
+
+
+# EOF
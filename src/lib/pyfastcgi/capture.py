@@ -0,0 +1,260 @@
+import os
+import dataclasses
+import itertools
+import random
+import struct
+import threading
+import time
+import pyfastcgi
+import pyfastcgi.log as log
+import pyfastcgi.protocol as protocol
+from dataclasses import dataclass
+
+
+'''
+受信したレコードの記録 (fcgi-replay.py で再送する)
+
+--capture-path に指定したファイル名に .{pid} を付けて、子プロセス毎に書き込む
+(--capture-sample の割合の接続のみ)
+
+ファイルの形式
+
+    CAPTURE_MAGIC
+    エントリ (ENTRY) + データ, ...
+
+        kind            ENTRY_RECORD    ... 受信したレコード (padding は含まない)
+                                            FCGI_STDIN の content は 1 リクエストで --capture-max-body まで
+                                            (contentLength は元の長さ、データは切り詰めた長さ)
+                        ENTRY_END       ... 送信した FCGI_END_REQUEST (元の処理時間の比較用)
+                        ENTRY_CLOSE     ... 接続の終了
+        connId          pid << 32 | 連番
+        time            time.time()
+
+* params (Cookie など) もそのまま記録するので、ファイルの扱いに注意すること
+'''
+
+CAPTURE_MAGIC = b'PYFCGI-CAPTURE-1\n'
+
+ENTRY_RECORD = 1
+ENTRY_END = 2
+ENTRY_CLOSE = 3
+
+# kind, connId, time, recordType, requestId, contentLength, capturedLength
+ENTRY = struct.Struct('>BQdBHHH')
+
+
+@dataclass(frozen=True)
+class Entry:
+    kind:int
+    connId:int
+    time:float
+    recordType:int = 0
+    requestId:int = 0
+    contentLength:int = 0
+    contentData:bytes = b''
+
+    @property
+    def truncated(self) -> bool:
+        return len(self.contentData) < self.contentLength
+
+
+@dataclass
+class _RecordScanner:
+    '''
+    受信 (送信) したバイト列をレコードに区切る
+
+    content は {keep}(recordType, requestId, contentLength) が返す長さまでしか保持しない
+    '''
+    on_record:callable
+    keep:callable
+    header:bytearray = dataclasses.field(default_factory=bytearray)
+    content:bytearray = dataclasses.field(default_factory=bytearray)
+    remaining:int = -1
+    limit:int = 0
+    fields:tuple = None
+
+    def feed(self, data):
+        pos = 0
+        ndata = len(data)
+
+        while pos < ndata:
+            if self.remaining < 0:
+                '''
+                ヘッダ
+                '''
+                advance = min(protocol.FCGI_HEADER_LEN - len(self.header), ndata - pos)
+                self.header += data[pos:pos+advance]
+                pos += advance
+
+                if len(self.header) < protocol.FCGI_HEADER_LEN:
+                    break
+
+                _, recordType, requestId, contentLength, paddingLength, _ = struct.unpack('>2B2H2B', self.header)
+                self.header.clear()
+
+                self.fields = (recordType, requestId, contentLength)
+                self.limit = min(contentLength, self.keep(recordType, requestId, contentLength))
+                self.remaining = contentLength + paddingLength
+
+            '''
+            content + padding
+            '''
+            # limit <= contentLength なので、保持するのは content の先頭のみ
+            advance = min(self.remaining, ndata - pos)
+            kept = min(max(self.limit - len(self.content), 0), advance)
+
+            if kept:
+                self.content += data[pos:pos+kept]
+
+            pos += advance
+            self.remaining -= advance
+
+            if self.remaining == 0:
+                self._complete()
+
+    def skip(self, nbytes:int):
+        '''
+        レコードの content の途中の {nbytes} をデータ無しで進める (sendfile で送信した分)
+        '''
+        assert 0 <= nbytes <= self.remaining
+
+        kept = min(max(self.limit - len(self.content), 0), nbytes)
+        if kept:
+            self.content += bytes(kept)
+
+        self.remaining -= nbytes
+
+        if self.remaining == 0:
+            self._complete()
+
+    def _complete(self):
+        self.remaining = -1
+        self.on_record(*self.fields, bytes(self.content))
+        self.content.clear()
+
+
+@dataclass
+class Recorder:
+    '''
+    接続毎の記録 (_MeteredConnection の送受信から呼ばれる)
+    '''
+    capture:'Capture'
+    connId:int
+    stdin_kept:dict = dataclasses.field(init=False, default_factory=dict)
+
+    def __post_init__(self):
+        self.inbound = _RecordScanner(self._on_inbound, self._keep_inbound)
+        self.outbound = _RecordScanner(self._on_outbound, self._keep_outbound)
+
+    def _keep_inbound(self, recordType:int, requestId:int, contentLength:int) -> int:
+        if recordType == protocol.FCGI_BEGIN_REQUEST:
+            # FCGI_KEEP_CONN の接続では同じ requestId が次のリクエストに使われる
+            self.stdin_kept.pop(requestId, None)
+
+        if recordType != protocol.FCGI_STDIN or self.capture.max_body < 0:
+            return contentLength
+
+        kept = self.stdin_kept.get(requestId, 0)
+        n = min(contentLength, max(self.capture.max_body - kept, 0))
+        self.stdin_kept[requestId] = kept + n
+
+        return n
+
+    def _keep_outbound(self, recordType:int, requestId:int, contentLength:int) -> int:
+        return contentLength if recordType == protocol.FCGI_END_REQUEST else 0
+
+    def _on_inbound(self, recordType:int, requestId:int, contentLength:int, contentData:bytes):
+        self.capture.write(Entry(ENTRY_RECORD, self.connId, time.time(), recordType, requestId, contentLength, contentData))
+
+    def _on_outbound(self, recordType:int, requestId:int, contentLength:int, contentData:bytes):
+        if recordType == protocol.FCGI_END_REQUEST:
+            self.capture.write(Entry(ENTRY_END, self.connId, time.time(), recordType, requestId, contentLength, contentData))
+
+    def received(self, data):
+        self.inbound.feed(data)
+
+    def sent(self, data):
+        self.outbound.feed(data)
+
+    def skipped(self, nbytes:int):
+        self.outbound.skip(nbytes)
+
+    def close(self):
+        self.capture.write(Entry(ENTRY_CLOSE, self.connId, time.time()))
+        self.capture.flush()
+
+
+@dataclass
+class Capture:
+    context:pyfastcgi.Context
+    path:str
+    sample:float
+    max_body:int
+    lock:any = dataclasses.field(init=False, default_factory=threading.Lock)
+    file:any = dataclasses.field(init=False, default=None)
+    sequence:any = dataclasses.field(init=False, default_factory=itertools.count)
+
+    def open(self):
+        path = f'{self.path}.{os.getpid()}'
+
+        self.file = open(path, 'ab')
+
+        if self.file.tell() == 0:
+            self.file.write(CAPTURE_MAGIC)
+
+        log.listener.info('capture to %s sample=%.3f max_body=%d', path, self.sample, self.max_body)
+
+    def recorder(self) -> Recorder:
+        '''
+        記録する接続であれば Recorder を返す
+        '''
+        if random.random() >= self.sample:
+            return None
+
+        return Recorder(self, os.getpid() << 32 | next(self.sequence) & 0xffffffff)
+
+    def write(self, entry:Entry):
+        data = ENTRY.pack(entry.kind, entry.connId, entry.time, entry.recordType, entry.requestId, entry.contentLength, len(entry.contentData))
+
+        with self.lock:
+            self.file.write(data + entry.contentData)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+
+def start_capture(context:pyfastcgi.Context) -> Capture:
+    '''
+    prefork の場合は子プロセスで開始すること (ファイルは子プロセス毎)
+    '''
+    if not context.capture_path:
+        return None
+
+    capture = Capture(context, context.capture_path, context.capture_sample, context.capture_max_body)
+    capture.open()
+
+    return capture
+
+
+def read_entries(path:str):
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f'not a capture file: {path}')
+
+        while True:
+            data = f.read(ENTRY.size)
+            if len(data) < ENTRY.size:
+                # 書き込み途中で終了した場合は最後のエントリが欠ける
+                break
+
+            kind, connId, etime, recordType, requestId, contentLength, capturedLength = ENTRY.unpack(data)
+            contentData = f.read(capturedLength)
+
+            if len(contentData) < capturedLength:
+                break
+
+            yield Entry(kind, connId, etime, recordType, requestId, contentLength, contentData)
+
+
+# EOF
@@ -0,0 +1,616 @@
+import collections
+import contextlib
+import dataclasses
+import select
+import socket
+import struct
+import threading
+import time
+import pyfastcgi.log as log
+import pyfastcgi.protocol as protocol
+from dataclasses import dataclass
+
+
+'''
+FastCGI クライアント (php-fpm などの FastCGI のサービスを呼び出す)
+
+    pool = client.Pool(('127.0.0.1', 9000))
+
+    result = pool.request({ 'REQUEST_METHOD': 'GET', 'SCRIPT_FILENAME': '/var/www/index.php', ... })
+    status, headers, body = result.split()
+
+    # stdin, stdout を逐次に送受信する場合
+    with pool.call(params) as call:
+        call.write(data)
+        call.close_stdin()
+
+        for data in call.stdout():
+            ...
+
+Pool
+
+    * 接続は FCGI_KEEP_CONN で再利用し、最大 {max_connections} まで
+    * 相手が FCGI_MPXS_CONNS=1 (FCGI_GET_VALUES で確認) であれば、一つの接続で
+      FCGI_MAX_REQS まで並行してリクエストを送信する (多重化)
+    * 一定時間使われていない接続は、再利用の前に切断されていないか確認して破棄する
+      (idle_timeout を超えたものは使わずに閉じる)
+    * 再利用した接続が切断されていて何も受信できなかった場合は、新しい接続で一度だけ再送する
+      (stdin がメモリ上のデータの場合のみ)
+
+受信はスレッドを使わず、受信待ちのスレッドのうち一つが代表してレコードを読み、
+requestId 毎の受信箱に振り分ける (多重化しない場合は常に自分のレコード)
+'''
+
+DEFAULT_TIMEOUT = 30.0
+DEFAULT_MAX_CONNECTIONS = 16
+DEFAULT_IDLE_TIMEOUT = 60.0
+
+# 前回の使用からこの秒数を超えた接続は、再利用の前に切断されていないか確認する
+DEFAULT_CHECK_INTERVAL = 1.0
+
+# 多重化する場合に FCGI_MAX_REQS が返されなかったときの接続毎の最大
+DEFAULT_MPX_REQS = 16
+
+# request() でこれを超える stdin は別のスレッドで送信する
+# (受信しながら応答する相手に、大きな body を送信し続けて止まらないように)
+STDIN_INLINE_MAX = 65536
+
+
+class ClientError(Exception): ...
+class PoolTimeoutError(ClientError): ...
+class PoolClosedError(ClientError): ...
+class ConnectionBrokenError(ClientError, ConnectionError): ...
+
+class RequestRejectedError(ClientError):
+    '''
+    protocolStatus が FCGI_REQUEST_COMPLETE 以外 (FCGI_OVERLOADED など)
+    '''
+    def __init__(self, result:'Result'):
+        super().__init__(f'rejected protocolStatus={result.protocolStatus}')
+        self.result = result
+
+
+def connect(target, timeout:float) -> socket.socket:
+    '''
+    {target} は (addr, port) または unix-domain-socket のパス
+    '''
+    if type(target) == str:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        sock.connect(target)
+
+    else:
+        sock = socket.create_connection(target, timeout=timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    return sock
+
+
+def record_bytes(recordType:int, requestId:int, contentData=b'') -> bytes:
+    return protocol.make_record(recordType, requestId, contentData=contentData).dump()
+
+
+def stream_bytes(recordType:int, requestId:int, data) -> bytes:
+    '''
+    {data} を PACKET_IO_LEN 毎のレコードにする (終端の空のレコードは含まない)
+    '''
+    return protocol.dump_records(recordType, requestId, data) if data else b''
+
+
+def begin_bytes(requestId:int, params:dict, keep_conn:bool, role:int=protocol.FCGI_RESPONDER) -> bytes:
+    '''
+    FCGI_BEGIN_REQUEST と FCGI_PARAMS (終端を含む)
+    '''
+    body = protocol.FCGI_BeginRequestBody(role, protocol.FCGI_KEEP_CONN if keep_conn else 0)
+
+    return record_bytes(protocol.FCGI_BEGIN_REQUEST, requestId, body.dump()) \
+        + stream_bytes(protocol.FCGI_PARAMS, requestId, protocol.dump_params(params)) \
+        + record_bytes(protocol.FCGI_PARAMS, requestId)
+
+
+def get_values(sock:socket.socket, names=(protocol.FCGI_MAX_CONNS, protocol.FCGI_MAX_REQS, protocol.FCGI_MPXS_CONNS)) -> dict:
+    '''
+    FCGI_GET_VALUES (アプリケーションの管理レコード) で相手の設定を問い合わせる
+    '''
+    query = protocol.dump_params({ name: '' for name in names })
+    sock.sendall(record_bytes(protocol.FCGI_GET_VALUES, protocol.FCGI_NULL_REQUEST_ID, query))
+
+    while True:
+        record = protocol.read_record(sock)
+
+        if record.header.recordType == protocol.FCGI_GET_VALUES_RESULT:
+            return protocol.make_params(memoryview(record.contentData or bytearray()))
+
+
+def split_response(stdout:bytes) -> tuple:
+    '''
+    CGI の応答を (status, [ (name, value), ... ], body) にする (Status が無ければ 200)
+    '''
+    head, sep, body = stdout.partition(b'\r\n\r\n')
+
+    if not sep:
+        head, sep, body = stdout.partition(b'\n\n')
+
+    status = 200
+    headers = []
+
+    for line in head.decode('latin-1').splitlines():
+        name, _, value = line.partition(':')
+        name, value = name.strip(), value.strip()
+
+        if name.lower() == 'status':
+            with contextlib.suppress(ValueError, IndexError):
+                status = int(value.split()[0])
+
+        elif name:
+            headers.append((name, value))
+
+    return status, headers, body
+
+
+@dataclass(frozen=True)
+class Result:
+    stdout:bytes
+    stderr:bytes
+    appStatus:int
+    protocolStatus:int
+
+    def split(self) -> tuple:
+        return split_response(self.stdout)
+
+
+@dataclass(eq=False)
+class Connection:
+    sock:socket.socket
+    max_reqs:int = 1
+    created:float = dataclasses.field(init=False, default_factory=time.monotonic)
+    last_used:float = dataclasses.field(init=False, default_factory=time.monotonic)
+    requests:int = dataclasses.field(init=False, default=0)
+    active:set = dataclasses.field(init=False, default_factory=set)
+    broken:bool = dataclasses.field(init=False, default=False)
+    send_lock:any = dataclasses.field(init=False, default_factory=threading.Lock)
+    cond:any = dataclasses.field(init=False, default_factory=threading.Condition)
+    inbox:dict = dataclasses.field(init=False, default_factory=dict)
+    reading:bool = dataclasses.field(init=False, default=False)
+    error:BaseException = dataclasses.field(init=False, default=None)
+
+    def alloc_request_id(self) -> int:
+        for requestId in range(1, self.max_reqs + 1):
+            if not requestId in self.active:
+                self.active.add(requestId)
+                self.requests += 1
+
+                return requestId
+
+        assert False, 'no free requestId'
+
+    def is_alive(self) -> bool:
+        '''
+        待機中の接続が相手から切断されていないか (受信できるデータがあれば切断または不正)
+        '''
+        try:
+            readable, _, _ = select.select([ self.sock ], [], [], 0)
+
+            return not readable
+
+        except (OSError, ValueError):
+            return False
+
+    def send(self, data):
+        '''
+        レコード単位で送信する (多重化している他のリクエストと混ざらないように)
+        '''
+        with self.send_lock:
+            try:
+                self.sock.sendall(data)
+
+            except OSError:
+                self.broken = True
+                raise
+
+    def next_record(self, requestId:int, timeout:float) -> protocol.FCGI_Record:
+        deadline = time.monotonic() + timeout
+
+        while True:
+            with self.cond:
+                while True:
+                    box = self.inbox.get(requestId)
+                    if box:
+                        return box.popleft()
+
+                    if not self.error is None:
+                        raise ConnectionBrokenError(f'connection failed: {self.error!r}') from self.error
+
+                    if not self.reading:
+                        # 代表して受信する
+                        self.reading = True
+                        break
+
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not self.cond.wait(remaining):
+                        raise socket.timeout('fastcgi client: receive timeout')
+
+            try:
+                record = protocol.read_record(self.sock)
+
+            except Exception as e:
+                with self.cond:
+                    self.reading = False
+                    self.broken = True
+                    self.error = e
+                    self.cond.notify_all()
+
+                raise
+
+            with self.cond:
+                self.reading = False
+                rid = record.header.requestId
+
+                if rid != requestId:
+                    if rid in self.active:
+                        self.inbox.setdefault(rid, collections.deque()).append(record)
+
+                    else:
+                        log.client.debug('drop record type=%d requestId=%d', record.header.recordType, rid)
+
+                self.cond.notify_all()
+
+            if rid == requestId:
+                return record
+
+    def close(self):
+        with contextlib.suppress(OSError):
+            self.sock.close()
+
+
+@dataclass(eq=False)
+class Call:
+    '''
+    一つのリクエスト (Pool.call() で作成する)
+    '''
+    conn:Connection
+    requestId:int
+    timeout:float
+    reused:bool
+    stdin_closed:bool = dataclasses.field(init=False, default=False)
+    received:bool = dataclasses.field(init=False, default=False)
+    end:protocol.FCGI_EndRequestBody = dataclasses.field(init=False, default=None)
+    stderr_data:bytearray = dataclasses.field(init=False, default_factory=bytearray)
+
+    def write(self, data):
+        if type(data) == str:
+            data = data.encode('utf-8')
+
+        if data:
+            self.conn.send(stream_bytes(protocol.FCGI_STDIN, self.requestId, data))
+
+    def close_stdin(self):
+        if not self.stdin_closed:
+            self.stdin_closed = True
+            self.conn.send(record_bytes(protocol.FCGI_STDIN, self.requestId))
+
+    def abort(self):
+        '''
+        送受信を中断して接続を破棄する (受信待ちのスレッドも失敗する)
+
+        * 多重化している場合は同じ接続の他のリクエストも失敗する
+        '''
+        self.conn.broken = True
+
+        with contextlib.suppress(OSError):
+            self.conn.sock.shutdown(socket.SHUT_RDWR)
+
+    def records(self):
+        '''
+        FCGI_STDOUT, FCGI_STDERR を (recordType, data) で返す (FCGI_END_REQUEST まで)
+        '''
+        while self.end is None:
+            record = self.conn.next_record(self.requestId, self.timeout)
+            self.received = True
+
+            recordType = record.header.recordType
+            data = bytes(record.contentData) if record.contentData else b''
+
+            if recordType == protocol.FCGI_END_REQUEST:
+                appStatus, protocolStatus = struct.unpack('>IB', data[:5])
+                self.end = protocol.FCGI_EndRequestBody(appStatus, protocolStatus)
+
+            elif recordType in (protocol.FCGI_STDOUT, protocol.FCGI_STDERR) and data:
+                yield recordType, data
+
+    def stdout(self):
+        '''
+        FCGI_STDOUT のみ (FCGI_STDERR は stderr_data に溜める)
+        '''
+        for recordType, data in self.records():
+            if recordType == protocol.FCGI_STDOUT:
+                yield data
+
+            else:
+                self.stderr_data += data
+
+
+def iter_stdin(stdin):
+    if isinstance(stdin, (bytes, bytearray, memoryview)):
+        yield stdin
+
+    elif hasattr(stdin, 'read'):
+        while True:
+            data = stdin.read(protocol.PACKET_IO_LEN)
+            if not data:
+                break
+
+            yield data
+
+    else:
+        yield from stdin
+
+
+@dataclass(eq=False)
+class Pool:
+    target:any
+    max_connections:int = DEFAULT_MAX_CONNECTIONS
+    keep_conn:bool = True
+    multiplex:bool = None       # None: FCGI_GET_VALUES で確認する
+    max_reqs:int = 0            # 多重化する場合の接続毎の最大 (0: FCGI_MAX_REQS)
+    timeout:float = DEFAULT_TIMEOUT
+    idle_timeout:float = DEFAULT_IDLE_TIMEOUT
+    check_interval:float = DEFAULT_CHECK_INTERVAL
+    max_requests:int = 0        # 接続毎のリクエスト数の上限 (0: 無制限)
+    cond:any = dataclasses.field(init=False, default_factory=threading.Condition)
+    conns:list = dataclasses.field(init=False, default_factory=list)
+    connecting:int = dataclasses.field(init=False, default=0)
+    detected:bool = dataclasses.field(init=False, default=False)
+    closed:bool = dataclasses.field(init=False, default=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def probe(self, timeout:float=None) -> dict:
+        '''
+        FCGI_GET_VALUES を問い合わせる (ヘルスチェック用)
+
+        待機中の接続 (多重化していないもの) があればそれを使い、無ければ新しく接続する
+        (相手の同時接続数に空きが無い場合でも確認できるように)
+
+        {timeout} は確認のみのタイムアウト (None の場合は {self.timeout})
+        '''
+        timeout = self.timeout if timeout is None else timeout
+        conn = None
+
+        with self.cond:
+            for a in self.conns:
+                if not a.active and not a.broken and a.max_reqs == 1:
+                    # requestId=0 で使用中にする
+                    conn = a
+                    conn.active.add(protocol.FCGI_NULL_REQUEST_ID)
+                    break
+
+        if not conn is None:
+            try:
+                conn.sock.settimeout(timeout)
+                values = get_values(conn.sock)
+                conn.sock.settimeout(self.timeout)
+                self.checkin(conn, protocol.FCGI_NULL_REQUEST_ID, True)
+
+                return values
+
+            except (OSError, AssertionError, ValueError):
+                # 相手から閉じられていた場合など、新しい接続で確認する
+                self.checkin(conn, protocol.FCGI_NULL_REQUEST_ID, False)
+
+        with contextlib.closing(connect(self.target, timeout)) as sock:
+            return get_values(sock)
+
+    def _detect(self):
+        if self.detected:
+            return
+
+        mpx_reqs = 1
+
+        if self.multiplex is None and self.keep_conn:
+            try:
+                values = self.probe()
+
+                if values.get(protocol.FCGI_MPXS_CONNS) == '1':
+                    mpx_reqs = int(values.get(protocol.FCGI_MAX_REQS) or DEFAULT_MPX_REQS)
+
+            except (OSError, AssertionError, ValueError):
+                # FCGI_GET_VALUES に対応していない
+                log.client.debug('FCGI_GET_VALUES not supported by %s', self.target, exc_info=True)
+
+        elif self.multiplex:
+            mpx_reqs = DEFAULT_MPX_REQS
+
+        with self.cond:
+            if not self.detected:
+                self.max_reqs = self.max_reqs or mpx_reqs
+                self.detected = True
+
+    def _discard(self, conn:Connection):
+        # self.cond を取得済であること
+        if conn in self.conns:
+            self.conns.remove(conn)
+
+        conn.close()
+        self.cond.notify_all()
+
+    def checkout(self) -> tuple:
+        '''
+        空きのある接続と requestId を返す (無ければ接続する)
+        '''
+        self._detect()
+
+        deadline = time.monotonic() + self.timeout
+
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise PoolClosedError()
+
+                now = time.monotonic()
+
+                for conn in list(self.conns):
+                    if not conn.active and (conn.broken or now - conn.last_used > self.idle_timeout):
+                        self._discard(conn)
+
+                # 処理中が多い接続を優先する (多重化しても接続数を増やさないように)
+                candidates = sorted(( conn for conn in self.conns if not conn.broken and len(conn.active) < conn.max_reqs ),
+                    key=lambda conn: (len(conn.active), conn.last_used), reverse=True)
+
+                for conn in candidates:
+                    if not conn.active and now - conn.last_used > self.check_interval and not conn.is_alive():
+                        log.client.debug('evict closed connection %s', conn.sock)
+                        self._discard(conn)
+                        continue
+
+                    return conn, conn.alloc_request_id()
+
+                if len(self.conns) + self.connecting < self.max_connections:
+                    self.connecting += 1
+                    break
+
+                remaining = deadline - now
+                if remaining <= 0 or not self.cond.wait(remaining):
+                    raise PoolTimeoutError(f'no connection available to {self.target}')
+
+        try:
+            sock = connect(self.target, self.timeout)
+
+        except:
+            with self.cond:
+                self.connecting -= 1
+                self.cond.notify_all()
+
+            raise
+
+        with self.cond:
+            self.connecting -= 1
+
+            conn = Connection(sock, self.max_reqs)
+            self.conns.append(conn)
+
+            return conn, conn.alloc_request_id()
+
+    def checkin(self, conn:Connection, requestId:int, reusable:bool):
+        with self.cond:
+            conn.active.discard(requestId)
+            conn.inbox.pop(requestId, None)
+            conn.last_used = time.monotonic()
+
+            if not reusable or not self.keep_conn or (self.max_requests and conn.requests >= self.max_requests):
+                # 多重化している他のリクエストが終わるまでは閉じない
+                conn.broken = True
+
+            if conn.broken and not conn.active:
+                self._discard(conn)
+
+            self.cond.notify_all()
+
+    @contextlib.contextmanager
+    def call(self, params:dict, role:int=protocol.FCGI_RESPONDER):
+        conn, requestId = self.checkout()
+        call = Call(conn, requestId, self.timeout, conn.requests > 1)
+
+        try:
+            conn.send(begin_bytes(requestId, params, self.keep_conn, role))
+
+            yield call
+
+        finally:
+            # FCGI_END_REQUEST を受信していなければ、接続の状態が不明なので再利用しない
+            self.checkin(conn, requestId, not call.end is None)
+
+    def request(self, params:dict, stdin=b'', role:int=protocol.FCGI_RESPONDER) -> Result:
+        replayable = isinstance(stdin, (bytes, bytearray, memoryview))
+
+        for attempt in range(2):
+            try:
+                return self._request(params, stdin, role)
+
+            except ConnectionError as e:
+                call = getattr(e, 'call', None)
+
+                if attempt == 0 and replayable and not call is None and call.reused and not call.received:
+                    log.client.debug('retry on new connection: %r', e)
+                    continue
+
+                raise
+
+    def _request(self, params:dict, stdin, role:int) -> Result:
+        with self.call(params, role) as call:
+            sender = None
+            failure = []
+
+            try:
+                if isinstance(stdin, (bytes, bytearray, memoryview)) and len(stdin) <= STDIN_INLINE_MAX:
+                    call.write(stdin)
+                    call.close_stdin()
+
+                else:
+                    def send_stdin():
+                        try:
+                            for data in iter_stdin(stdin):
+                                call.write(data)
+
+                            call.close_stdin()
+
+                        except Exception as e:
+                            failure.append(e)
+
+                    sender = threading.Thread(target=send_stdin, name='pyfastcgi-client-stdin', daemon=True)
+                    sender.start()
+
+                stdout = bytearray()
+
+                for data in call.stdout():
+                    stdout += data
+
+            except ConnectionError as e:
+                # request() で再送するか判断する
+                e.call = call
+                raise
+
+            finally:
+                if not sender is None:
+                    sender.join()
+
+            if failure:
+                raise failure[0]
+
+        result = Result(bytes(stdout), bytes(call.stderr_data), call.end.appStatus, call.end.protocolStatus)
+
+        if result.protocolStatus != protocol.FCGI_REQUEST_COMPLETE:
+            raise RequestRejectedError(result)
+
+        return result
+
+    def stats(self) -> dict:
+        with self.cond:
+            return {
+                'connections':  len(self.conns),
+                'active':       sum(( len(conn.active) for conn in self.conns )),
+                'idle':         sum(( 1 for conn in self.conns if not conn.active )),
+                'max_reqs':     self.max_reqs,
+            }
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+
+            for conn in list(self.conns):
+                self._discard(conn)
+
+
+def request(target, params:dict, stdin=b'', *, timeout:float=DEFAULT_TIMEOUT) -> Result:
+    '''
+    接続を再利用しない一回のみのリクエスト
+    '''
+    with Pool(target, max_connections=1, keep_conn=False, multiplex=False, timeout=timeout) as pool:
+        return pool.request(params, stdin)
+
+
+# EOF
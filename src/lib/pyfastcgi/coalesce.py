@@ -0,0 +1,158 @@
+import dataclasses
+import threading
+import pyfastcgi
+import pyfastcgi.cache as cache
+import pyfastcgi.log as log
+import pyfastcgi.metrics as metrics
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+
+'''
+同じリクエストの同時実行をまとめる (--coalesce)
+
+キャッシュ (pyfastcgi.cache) と同じキーのリクエストを処理中であれば、後から来たリクエストは
+responder を実行せずに待ち、最初のリクエストが送信したレコードを自分の接続に送信する
+
+    python prefork.py --coalesce=1 --coalesce-timeout=5 --cache-max-bytes=67108864
+
+    * 対象は BufferingResponder で、キャッシュのキーを作れる (GET, HEAD の) リクエスト
+    * 渡すのは他のリクエストに返してよい応答のみ (cache.shareable())、有効期間は問わない
+    * 最初のリクエストが --coalesce-timeout 秒以内に終わらない場合や、渡せる応答が無かった
+      (失敗した、Set-Cookie があるなど) 場合は、待っていたリクエストがそれぞれ responder を実行する
+    * 待っている間もスレッドを一つ使う
+    * 子プロセス毎にまとめる (プロセス間は --cache-shared で共有したキャッシュの期限切れ時のみ重複する)
+
+待って応答したリクエスト数は status-path の coalesced、待った後に自分で実行した数は
+coalesce_fallback に出力する
+'''
+
+STAT_COALESCED          = metrics.counter('coalesced')
+STAT_COALESCE_FALLBACK  = metrics.counter('coalesce-fallback')
+
+_local = threading.local()
+
+
+@dataclass(eq=False)
+class Flight:
+    key:str
+    vary:tuple
+    done:threading.Event = dataclasses.field(default_factory=threading.Event)
+    requestId:int = 0
+    data:bytes = None
+    waiters:int = 0
+
+    def publish(self, requestId:int, data:bytes):
+        self.requestId = requestId
+        self.data = data
+
+
+@dataclass
+class Coalescer:
+    vary:tuple = ()
+    timeout:float = 5.0
+    flights:dict = dataclasses.field(init=False, default_factory=dict)
+    lock:any = dataclasses.field(init=False, default_factory=threading.Lock)
+
+    def join(self, key:str) -> tuple:
+        '''
+        (Flight, 最初のリクエストか)
+        '''
+        with self.lock:
+            flight = self.flights.get(key)
+
+            if flight is None:
+                flight = Flight(key, self.vary)
+                self.flights[key] = flight
+
+                return flight, True
+
+            flight.waiters += 1
+
+            return flight, False
+
+    def land(self, flight:Flight):
+        with self.lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+
+        flight.done.set()
+
+        if flight.waiters:
+            log.listener.debug('coalesced %d requests (shared=%s)', flight.waiters, not flight.data is None)
+
+    def state(self) -> dict:
+        with self.lock:
+            return { 'flights': len(self.flights), 'waiters': sum(( flight.waiters for flight in self.flights.values() )) }
+
+
+def current() -> Flight:
+    '''
+    このスレッドが最初のリクエストとして処理中の Flight (無ければ None)
+    '''
+    return getattr(_local, 'flight', None)
+
+
+def join(context:pyfastcgi.Context, params:dict) -> tuple:
+    '''
+    (Flight, 最初のリクエストか)、対象でなければ (None, False)
+    '''
+    coalescer = context.coalescer
+    if coalescer is None:
+        return None, False
+
+    key = cache.request_key(params, coalescer.vary)
+    if key is None:
+        return None, False
+
+    return coalescer.join(key)
+
+
+@contextmanager
+def leading(context:pyfastcgi.Context, flight:Flight):
+    '''
+    最初のリクエストの responder を実行する間 (終われば待っているリクエストを起こす)
+    '''
+    if flight is None:
+        yield
+        return
+
+    _local.flight = flight
+
+    try:
+        yield
+
+    finally:
+        _local.flight = None
+        context.coalescer.land(flight)
+
+
+def wait(context:pyfastcgi.Context, flight:Flight) -> cache.Entry:
+    '''
+    最初のリクエストの応答を待つ (渡せる応答が無ければ None)
+    '''
+    done = flight.done.wait(context.coalescer.timeout)
+    served = done and not flight.data is None
+
+    context.metrics.add(STAT_COALESCED if served else STAT_COALESCE_FALLBACK)
+
+    if not context.worker is None:
+        context.worker.count_coalesced(served)
+
+    if not served:
+        return None
+
+    return cache.Entry(flight.requestId, flight.data, 0.0, 0.0)
+
+
+def start_coalescer(context:pyfastcgi.Context) -> Coalescer:
+    '''
+    prefork の場合は子プロセスで作成される
+    '''
+    if not context.coalesce or context.asgi_app or context.proxy_backends:
+        return None
+
+    return Coalescer(context.cache_vary, context.coalesce_timeout)
+
+
+# EOF
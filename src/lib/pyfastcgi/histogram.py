@@ -0,0 +1,153 @@
+import contextlib
+import dataclasses
+import threading
+import time
+from dataclasses import dataclass
+
+
+'''
+処理時間のヒストグラム
+
+HDR Histogram と同様の対数-線形の固定バケット (単位はマイクロ秒)
+
+    * 2 のべき乗の区間を SUB_BUCKETS 個に等分する (誤差は最大 1/SUB_BUCKETS = 12.5%)
+    * 0 - 15 usec は 1 usec 単位
+    * 上限 (約 67 秒) を超える値は最後のバケットに入れる
+
+バケットの数と境界が固定なので、共有メモリ上の配列に置いて単純な加算で集計できる
+'''
+
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+MAX_VALUE_BITS = 26
+
+NBUCKETS = SUB_BUCKETS * (MAX_VALUE_BITS - SUB_BUCKET_BITS + 1)
+
+# リクエストの処理段階
+PHASE_QUEUE     = 'queue'       # accept から処理を開始するまで (AdmissionQueue での待ち、接続の最初のリクエストのみ)
+PHASE_PARAMS    = 'params'      # FCGI_PARAMS の受信
+PHASE_STDIN     = 'stdin'       # FCGI_STDIN の受信
+PHASE_APP       = 'app'         # responder の処理 (stdin, stdout を除く)
+PHASE_STDOUT    = 'stdout'      # FCGI_STDOUT (と FCGI_END_REQUEST) の送信
+PHASE_CLOSE     = 'close'       # close (reaper に渡すまで、reaper が無ければ読み残しの破棄を含む)
+
+PHASES = (PHASE_QUEUE, PHASE_PARAMS, PHASE_STDIN, PHASE_APP, PHASE_STDOUT, PHASE_CLOSE)
+
+# 集計時に分類できなかった route の名前
+ROUTE_OTHER = '(other)'
+
+# 全 route の合計
+ROUTE_ALL = '*'
+
+
+def bucket_index(usec:int) -> int:
+    if usec < SUB_BUCKETS * 2:
+        return max(usec, 0)
+
+    exponent = usec.bit_length() - SUB_BUCKET_BITS - 1
+
+    return min(SUB_BUCKETS * exponent + (usec >> exponent), NBUCKETS - 1)
+
+
+def bucket_upper(index:int) -> int:
+    '''
+    バケットに入る値の上限 (この値は含まない)
+    '''
+    if index < SUB_BUCKETS * 2:
+        return index + 1
+
+    exponent = index // SUB_BUCKETS - 1
+
+    return (index - SUB_BUCKETS * exponent + 1) << exponent
+
+
+def percentile(counts, ratio:float) -> int:
+    total = sum(counts)
+    if not total:
+        return 0
+
+    rank = total * ratio
+
+    for index, count in enumerate(counts):
+        rank -= count
+
+        if rank <= 0:
+            return bucket_upper(index)
+
+    return bucket_upper(len(counts) - 1)
+
+
+def summarize(counts, usec_sum:int) -> dict:
+    total = sum(counts)
+    last = max(( index for index, count in enumerate(counts) if count ), default=0)
+
+    return {
+        'count':    total,
+        'mean_ms':  usec_sum / total / 1000 if total else 0,
+        'p50_ms':   percentile(counts, 0.50) / 1000,
+        'p90_ms':   percentile(counts, 0.90) / 1000,
+        'p99_ms':   percentile(counts, 0.99) / 1000,
+        'max_ms':   bucket_upper(last) / 1000 if total else 0,
+    }
+
+
+@dataclass
+class Timing:
+    '''
+    1 リクエスト (FCGI_BEGIN_REQUEST から FCGI_END_REQUEST まで) の処理段階毎の時間 (秒)
+
+    処理中のスレッドに結び付けておき、各段階で加算する
+    (アクセスログ用にリクエストの情報も持つ)
+    '''
+    route:str = ROUTE_OTHER
+    server_timing:bool = False
+    phases:dict = dataclasses.field(default_factory=dict)
+    method:str = None
+    uri:str = None
+    status:int = None
+
+    def add(self, phase:str, seconds:float):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextlib.contextmanager
+    def measure(self, phase:str):
+        started = time.perf_counter()
+
+        try:
+            yield self
+
+        finally:
+            self.add(phase, time.perf_counter() - started)
+
+    def usecs(self) -> dict:
+        return { phase: int(seconds * 1000000) for phase, seconds in self.phases.items() }
+
+    def header_value(self) -> str:
+        '''
+        Server-Timing ヘッダの値 (ヘッダを送信する時点までに終わった段階のみ)
+        '''
+        return ', '.join(( f'{phase};dur={seconds * 1000:.3f}' for phase, seconds in self.phases.items() ))
+
+
+_local = threading.local()
+
+
+def begin() -> Timing:
+    timing = Timing()
+    _local.timing = timing
+
+    return timing
+
+
+def current() -> Timing:
+    return getattr(_local, 'timing', None)
+
+
+def end() -> Timing:
+    timing = current()
+    _local.timing = None
+
+    return timing
+
+
+# EOF
@@ -8,12 +8,51 @@ import http.client
 import selectors
 import socket
 import struct
+import time
 import traceback
 import uuid
+import dataclasses
 import pyfastcgi
+import pyfastcgi.admission as admission
+import pyfastcgi.asgi as asgi
+import pyfastcgi.cache as cache
+import pyfastcgi.coalesce as coalesce
+import pyfastcgi.capture as capture
+import pyfastcgi.histogram as histogram
+import pyfastcgi.log as log
+import pyfastcgi.metrics as metrics
+import pyfastcgi.profiler as profiler
 import pyfastcgi.protocol as protocol
+import pyfastcgi.proxy as proxy
+import pyfastcgi.reaper as reaper
 import pyfastcgi.responders
+import pyfastcgi.responders.buffering as buffering
+import pyfastcgi.responders.cache as cache_responder
 import pyfastcgi.responders.errors as errors
+import pyfastcgi.responders.profile as profile
+import pyfastcgi.responders.proxy as proxy_responder
+import pyfastcgi.responders.status as status
+import pyfastcgi.watchdog as watchdog
+import pyfastcgi.util.netstat as netstat
+import pyfastcgi.util.scoreboard as scoreboard
+from dataclasses import dataclass
+
+
+STAT_RESPONSE_OK        = metrics.counter('response-ok')
+STAT_RESPONSE_NG        = metrics.counter('response-ng')
+STAT_SOCKET_ACCEPTED    = metrics.counter('socket-accepted')
+STAT_SOCKET_CLOSED      = metrics.counter('socket-closed')
+STAT_SOCKET_BLOCKERR    = metrics.counter('socket-blockerr')
+STAT_SOCKET_TIMEOUT     = metrics.counter('socket-timeout')
+STAT_ACCEPT_MUTEX_BUSY  = metrics.counter('accept-mutex-busy')
+STAT_SELECT_TIMEOUT     = metrics.counter('select-timeout')
+STAT_NONBLOCKING_LOOP   = metrics.counter('nonblocking-loop')
+STAT_BLOCKING_LOOP      = metrics.counter('bloking-loop')
+STAT_ACCEPT_BATCHED     = metrics.counter('accept-batched')
+STAT_ACCEPT_BUDGET_SPENT = metrics.counter('accept-budget-spent')
+
+# accept キューの長さと、スレッド毎に数えた値の合計を scoreboard に書き込む間隔 (秒)
+LISTEN_SAMPLE_INTERVAL = 1.0
 
 
 def send_fatal_error(conn:socket.socket, requestId:int, errmsg:str, exinfo:tuple, http_code:int=http.client.INTERNAL_SERVER_ERROR):
@@ -29,6 +68,7 @@ def send_fatal_error(conn:socket.socket, requestId:int, errmsg:str, exinfo:tuple
         textmsg = f'error-code={errcode}'
         htmlmsg = f'<html><body>{textmsg}</body></html>'
         hresp = pyfastcgi.Response(headers, htmlmsg)
+        log.listener.error('%s; %s', textmsg, errmsg)
 
         pyfastcgi.send_record(conn, protocol.FCGI_STDOUT, requestId, contentData=hresp)
         pyfastcgi.send_record(conn, protocol.FCGI_STDOUT, requestId)
@@ -44,30 +84,177 @@ def send_fatal_error(conn:socket.socket, requestId:int, errmsg:str, exinfo:tuple
         pass
 
 
+@dataclass
+class _MeteredConnection:
+    '''
+    送受信したバイト数と時間を数える socket のラッパ
+
+        * バイト数は scoreboard の bytes_in/out 用
+        * 時間は {timing} の処理段階 (受信は {recv_phase}, 送信は stdout) に加算する
+          ({timing} はリクエスト毎に替え、FCGI_KEEP_CONN で次のリクエストを待つ間は None)
+        * 最後に送受信した時刻は watchdog の heartbeat とする
+        * {recorder} があれば送受信したデータを記録する (--capture-path)
+    '''
+    conn:socket.socket
+    timing:histogram.Timing = None
+    recv_phase:str = histogram.PHASE_PARAMS
+    recorder:capture.Recorder = None
+    route:str = histogram.ROUTE_OTHER
+    bytes_in:int = dataclasses.field(init=False, default=0)
+    bytes_out:int = dataclasses.field(init=False, default=0)
+    marked_in:int = dataclasses.field(init=False, default=0)
+    marked_out:int = dataclasses.field(init=False, default=0)
+    heartbeat:float = dataclasses.field(init=False, default_factory=time.monotonic)
+
+    def __getattr__(self, name:str):
+        return getattr(self.conn, name)
+
+    def take_request_bytes(self) -> tuple:
+        '''
+        前回の呼び出しから送受信したバイト数 (in, out) (リクエスト毎のアクセスログ用)
+        '''
+        nbytes = (self.bytes_in - self.marked_in, self.bytes_out - self.marked_out)
+        self.marked_in, self.marked_out = self.bytes_in, self.bytes_out
+
+        return nbytes
+
+    def recv_into(self, buffer, nbytes:int=0, flags:int=0) -> int:
+        started = time.perf_counter()
+        nread = self.conn.recv_into(buffer, nbytes, flags)
+        self.bytes_in += nread
+        self.heartbeat = time.monotonic()
+
+        if not self.timing is None:
+            self.timing.add(self.recv_phase, time.perf_counter() - started)
+
+        if not self.recorder is None and nread > 0:
+            with memoryview(buffer) as mem:
+                self.recorder.received(mem[:nread])
+
+        return nread
+
+    def sendall(self, data, flags:int=0):
+        started = time.perf_counter()
+        self.conn.sendall(data, flags)
+        self.bytes_out += len(data)
+        self.heartbeat = time.monotonic()
+
+        if not self.timing is None:
+            self.timing.add(histogram.PHASE_STDOUT, time.perf_counter() - started)
+
+        if not self.recorder is None:
+            self.recorder.sent(data)
+
+    def sendfile(self, file, offset:int=0, count:int=None) -> int:
+        started = time.perf_counter()
+        nsend = self.conn.sendfile(file, offset, count)
+        self.bytes_out += nsend
+        self.heartbeat = time.monotonic()
+
+        if not self.timing is None:
+            self.timing.add(histogram.PHASE_STDOUT, time.perf_counter() - started)
+
+        if not self.recorder is None:
+            self.recorder.skipped(nsend)
+
+        return nsend
+
+
+def count_response(context:pyfastcgi.Context, ok:bool):
+    context.metrics.add(STAT_RESPONSE_OK if ok else STAT_RESPONSE_NG)
+
+    if not context.worker is None:
+        context.worker.count_response(ok)
+
+
+def begin_timing(context:pyfastcgi.Context, conn:socket.socket) -> histogram.Timing:
+    '''
+    FCGI_BEGIN_REQUEST 毎の Timing (接続の最初のリクエストは admission での待ち時間を含む)
+    '''
+    timing = histogram.current() or histogram.begin()
+    timing.server_timing = context.server_timing
+
+    if isinstance(conn, _MeteredConnection):
+        conn.timing = timing
+        conn.recv_phase = histogram.PHASE_PARAMS
+
+    return timing
+
+
+def end_timing(conn:socket.socket, timing:histogram.Timing, started:float):
+    '''
+    受信 (params, stdin) と送信 (stdout) 以外の時間を responder の処理時間とする
+    '''
+    elapsed = time.perf_counter() - started
+    io_time = sum(( timing.phases.get(phase, 0.0) for phase in (histogram.PHASE_PARAMS, histogram.PHASE_STDIN, histogram.PHASE_STDOUT) ))
+    timing.add(histogram.PHASE_APP, max(elapsed - io_time, 0.0))
+
+    if isinstance(conn, _MeteredConnection):
+        # 次の FCGI_BEGIN_REQUEST を待つ時間は含めない
+        conn.timing = None
+        conn.route = timing.route
+
+
+def finish_request(context:pyfastcgi.Context, conn:socket.socket, client:tuple, timing:histogram.Timing):
+    '''
+    リクエスト毎の記録 (ヒストグラムとアクセスログ)
+    '''
+    # 次のリクエストの FCGI_BEGIN_REQUEST からは次のリクエストの分とする
+    nbytes = conn.take_request_bytes() if isinstance(conn, _MeteredConnection) else (0, 0)
+
+    if not context.worker is None:
+        context.worker.record_timing(timing.route, timing.usecs())
+
+    if log.access_enabled():
+        write_access_log(client, nbytes, timing)
+
+
 @pyfastcgi.report_exception
 def process_request(context:pyfastcgi.Context, conn:socket.socket, client:tuple):
     conn.settimeout(context.so_timeout)
 
     keep_conn = True
+    served = False
+
     while keep_conn:
-        record = protocol.read_record(conn)
+        try:
+            record = protocol.read_record(conn)
+
+        except (ConnectionError, socket.timeout):
+            if not served:
+                raise
+
+            '''
+            FCGI_KEEP_CONN で次のリクエストを待っている間に閉じられた (または --so-timeout を過ぎた)
+            '''
+            log.listener.debug('keep connection closed')
+            break
+
+        if record.header.requestId == protocol.FCGI_NULL_REQUEST_ID:
+            send_management_record(context, conn, record)
+            served = True
+            continue
 
         if record.header.recordType != protocol.FCGI_BEGIN_REQUEST:
+            # 前のリクエストの読み残し (FCGI_STDIN など)
             continue
 
+        served = True
+
         requestId = record.header.requestId
         appStatus = 0
 
+        started = time.perf_counter()
+        timing = begin_timing(context, conn)
+
         try:
             try:
                 a = struct.unpack('>HB5s', record.contentData)
                 begreq = protocol.FCGI_BeginRequestBody(*a)
 
                 keep_conn = begreq.flags & protocol.FCGI_KEEP_CONN
-                if keep_conn:
+                if keep_conn and type(context.bind_addr) != str:
                     conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
-                    print('enable keep connection', file=sys.stderr)
-                    assert False, 'un-expected keep=enabled, tracking'
 
                 params = {}
 
@@ -88,21 +275,58 @@ def process_request(context:pyfastcgi.Context, conn:socket.socket, client:tuple)
                         # <3.9
                         params.update(a)
 
+                if isinstance(conn, _MeteredConnection):
+                    # 以降の受信は FCGI_STDIN
+                    conn.recv_phase = histogram.PHASE_STDIN
+
                 responder = None
-                if context.responder_factory:
-                    responder = context.responder_factory(context, conn, client, requestId, params)
+                flight = None
+
+                if context.status_path and status.is_status_request(context, params):
+                    responder = status.StatusResponder(context, conn, client, requestId, params)
+
+                elif context.profile_path and not context.profiler is None and profile.is_profile_request(context, params):
+                    responder = profile.ProfileResponder(context, conn, client, requestId, params)
+
+                elif not context.proxy is None:
+                    responder = proxy_responder.ProxyResponder(context, conn, client, requestId, params)
+
+                elif context.responder_factory:
+                    cached = cache.lookup_response(context, params)
+
+                    if cached is None:
+                        responder = context.responder_factory(context, conn, client, requestId, params)
+
+                        if isinstance(responder, buffering.BufferingResponder):
+                            # 同じリクエストを処理中であれば、その応答を待つ (--coalesce)
+                            flight, leader = coalesce.join(context, params)
+
+                            if not leader and not flight is None:
+                                cached = coalesce.wait(context, flight)
+                                flight = None
+
+                    if not cached is None:
+                        responder = cache_responder.CachedResponder(context, conn, client, requestId, params)
+                        responder.entry = cached
 
                 if not a:
                     responder = pyfastcgi.responders.NotImplementedResponder(context, conn, client, requestId, params)
 
-                with contextlib.closing(responder):
+                timing.route = type(responder).__name__
+                timing.method = params.get('REQUEST_METHOD')
+                timing.uri = params.get('REQUEST_URI')
+
+                with watchdog.watch(context, conn, requestId, params), \
+                     profiler.profile(context, type(responder).__name__, params), \
+                     coalesce.leading(context, flight), \
+                     contextlib.closing(responder):
                     appStatus = responder.do_response() or 0
 
-                context.incr_stats('response-ok')
+                count_response(context, True)
 
             except:
-                context.incr_stats('response-ng')
-                traceback.print_exception(*sys.exc_info(), file=sys.stderr)
+                count_response(context, False)
+                log.listener.exception('request failed')
                 raise
 
         except ConnectionError:
@@ -121,54 +345,286 @@ def process_request(context:pyfastcgi.Context, conn:socket.socket, client:tuple)
         endreq = protocol.FCGI_EndRequestBody(appStatus, protocol.FCGI_REQUEST_COMPLETE)
         pyfastcgi.send_record(conn, protocol.FCGI_END_REQUEST, requestId, contentData=endreq.dump())
 
+        end_timing(conn, timing, started)
+
+        if keep_conn:
+            finish_request(context, conn, client, histogram.end())
+
+        # 接続を閉じるリクエストは close の時間を加えて on_accepted() で記録する
+
     # end while True
 
 
+def management_record(context:pyfastcgi.Context, recordType:int, contentData) -> tuple:
+    '''
+    requestId=0 の管理レコードへの応答 (recordType, contentData)
+
+    FCGI_GET_VALUES には問い合わせられた変数のうち知っているものだけを返す
+    (多重化はしないので FCGI_MPXS_CONNS=0, 同時に処理できるのはプロセス数 x スレッド数まで)
+    それ以外は FCGI_UNKNOWN_TYPE を返す
+
+    * --asgi-app の場合は一つの接続で多重化できる (FCGI_MPXS_CONNS=1)
+      スレッドを使わないので、FCGI_MAX_REQS は子プロセス毎の --asgi-max-reqs (0 なら返さない)、
+      接続数の上限 (FCGI_MAX_CONNS) は無いので返さない
+
+    * FCGI_KEEP_CONN の接続は待機中もスレッドを占有するので、プロキシなどはこれを超えて
+      接続を保持しないこと
+    '''
+    if recordType == protocol.FCGI_GET_VALUES:
+        if context.asgi_app:
+            values = {
+                protocol.FCGI_MPXS_CONNS:   1,
+            }
+
+            if context.asgi_max_reqs > 0:
+                values[protocol.FCGI_MAX_REQS] = context.asgi_max_reqs
+
+        else:
+            capacity = context.threads * context.extra.get('procs', 1)
+
+            values = {
+                protocol.FCGI_MAX_CONNS:    capacity,
+                protocol.FCGI_MAX_REQS:     capacity,
+                protocol.FCGI_MPXS_CONNS:   0,
+            }
+
+        with memoryview(bytearray(contentData)) as mem:
+            names = protocol.make_params(mem)
+
+        result = { name: values[name] for name in names if name in values }
+
+        return protocol.FCGI_GET_VALUES_RESULT, protocol.dump_params(result)
+
+    # FCGI_UnknownTypeBody { type, reserved[7] }
+    return protocol.FCGI_UNKNOWN_TYPE, struct.pack('>B7x', recordType)
+
+
+def send_management_record(context:pyfastcgi.Context, conn:socket.socket, record:protocol.FCGI_Record):
+    recordType, contentData = management_record(context, record.header.recordType, record.contentData)
+
+    pyfastcgi.send_record(conn, recordType, protocol.FCGI_NULL_REQUEST_ID, contentData=contentData)
+
+
 def on_accepted(context:pyfastcgi.Context, conn:socket.socket, client:tuple):
+    worker = context.worker
+
+    if not worker is None:
+        worker.begin_request()
+
+    conn = _MeteredConnection(conn)
+
+    if not context.capture is None:
+        conn.recorder = context.capture.recorder()
+
     try:
-        print(f'accepted {conn=}', file=sys.stderr)
+        log.listener.debug('accepted %s', conn)
 
         process_request(context, conn, client)
 
     finally:
-        print(f'terminate {conn=}', file=sys.stderr)
+        log.listener.debug('terminate %s', conn)
 
         '''
         [FCGI_KEEP_CONN]
             ゼロの場合、アプリケーションはこの要求に応答した後に接続を閉じます。
             ゼロでない場合、アプリケーションはこの要求に応答した後、接続を閉じません。Webサーバーは接続の責任を保持します。
         '''
-        if protocol.close_socket(conn):
-            context.incr_stats('socket-closed')
-            print(conn, file=sys.stderr)
+        # 読み残しの破棄は close の時間とする (reaper に渡した場合は渡すまで)
+        conn.timing = None
+
+        # 記録していない最後のリクエスト (FCGI_KEEP_CONN で全て記録済みなら close のみ記録する)
+        pending = histogram.end()
+        timing = pending or histogram.Timing(route=conn.route)
+
+        with timing.measure(histogram.PHASE_CLOSE):
+            closed = reaper.close(context, conn.conn)
+
+        if closed:
+            context.metrics.add(STAT_SOCKET_CLOSED)
+
+        if not conn.recorder is None:
+            conn.recorder.close()
+
+        log.listener.debug('request done. from %s', client)
+
+        if not worker is None:
+            worker.end_request(conn.bytes_in, conn.bytes_out)
+
+        if not pending is None:
+            finish_request(context, conn, client, pending)
+
+        elif not worker is None:
+            worker.record_timing(timing.route, timing.usecs())
+
+
+def write_access_log(client:tuple, nbytes:tuple, timing:histogram.Timing):
+    entry = {
+        'client':       client,
+        'method':       timing.method,
+        'uri':          timing.uri,
+        'status':       timing.status,
+        'route':        timing.route,
+        'bytes_in':     nbytes[0],
+        'bytes_out':    nbytes[1],
+        'ms':           { phase: round(seconds * 1000, 3) for phase, seconds in timing.phases.items() },
+    }
+
+    log.write_access(entry)
+
+
+def count_accepted(context:pyfastcgi.Context):
+    context.metrics.add(STAT_SOCKET_ACCEPTED)
+
+    if not context.worker is None:
+        # accept は待ち受けのスレッドのみで行うので排他しない
+        context.worker.slot.accepted += 1
+
+
+def accept(context:pyfastcgi.Context, ssock:socket.socket) -> list:
+    '''
+    待っている接続を --accept-budget まで受け付ける [(conn, address), ...]
+
+    最初の一つは {ssock} の設定 (blocking, timeout) のまま待ち、続きは待たずに受け付ける
+    (同時に届いた接続を一度の wakeup でまとめて受け付け、accept キューを溢れさせない)
+
+    * socket.accept() は accept4(SOCK_CLOEXEC) で受け付ける (Linux)
+    '''
+    lock = context.accept_lock
+
+    if not lock is None:
+        '''
+        accept mutex
+
+        SO_REUSEPORT が使えない (unix-domain-socket) 場合に、共有された待ち受けソケットで
+        複数プロセスが同時に accept して競合 (thundering herd) しないよう排他する
+        '''
+        if ssock.getblocking():
+            acquired = lock.acquire(timeout=ssock.gettimeout())
+        else:
+            acquired = lock.acquire(False)
+
+        if not acquired:
+            if ssock.getblocking():
+                raise socket.timeout('accept mutex timed out')
+
+            # 他のプロセスが accept 中
+            return []
+
+    try:
+        accepted = [ ssock.accept() ]
+
+        if context.accept_budget > 1:
+            timeout = ssock.gettimeout()
+
+            if timeout != 0.0:
+                ssock.setblocking(False)
+
+            try:
+                while len(accepted) < context.accept_budget:
+                    accepted.append(ssock.accept())
+
+            except (BlockingIOError, InterruptedError):
+                pass
+
+            finally:
+                if timeout != 0.0:
+                    ssock.settimeout(timeout)
+
+        return accepted
+
+    finally:
+        if not lock is None:
+            lock.release()
 
-        print(f'request done. from {client=}', file=sys.stderr)
 
+def sample_listen_queue(context:pyfastcgi.Context, ssock:socket.socket):
+    '''
+    accept キューの長さと、スレッド毎に数えた値の合計 (scoreboard.Worker.publish()) を
+    LISTEN_SAMPLE_INTERVAL 秒毎に scoreboard に書き込む (status-path と prefork の親プロセス用)
+    '''
+    worker = context.worker
+    if worker is None:
+        return
 
-def accept_submit(context:pyfastcgi.Context, executor:concurrent.futures.ThreadPoolExecutor, ssock:socket.socket):
+    now = time.monotonic()
+    if now - worker.listen_sampled < LISTEN_SAMPLE_INTERVAL:
+        return
+
+    worker.listen_sampled = now
+    worker.publish()
+
+    queue = netstat.listen_queue(ssock)
+    if not queue is None:
+        worker.listen_queue(*queue)
+
+
+def accept_submit(context:pyfastcgi.Context, queue:admission.AdmissionQueue, ssock:socket.socket):
     try:
-        conn, address = ssock.accept()
+        accepted = accept(context, ssock)
+
+        if not accepted:
+            context.metrics.add(STAT_ACCEPT_MUTEX_BUSY)
+            return
 
-        if context.loop:
-            context.incr_stats('socket-accepted')
+        if len(accepted) > 1:
+            context.metrics.add(STAT_ACCEPT_BATCHED, len(accepted) - 1)
+
+        if len(accepted) >= context.accept_budget:
+            # まだ残っている可能性がある
+            context.metrics.add(STAT_ACCEPT_BUDGET_SPENT)
+
+        for conn, address in accepted:
+            '''
+            loop=OFF (終了中) であっても accept 済みの接続は処理する
+            (捨てると Web サーバ側ではエラー (502) になる)
+            '''
+            count_accepted(context)
 
             ainfo = {
                 'ssock': ssock,
-                'executor': executor,
+                'executor': queue.executor,
                 'conn': conn,
             }
             context.handler(pyfastcgi.Event('ACCEPT', ainfo))
-            executor.submit(on_accepted, context, conn, address)
+            queue.submit(on_accepted, conn, address)
+
+        sample_listen_queue(context, ssock)
 
     except BlockingIOError as e:
-        context.incr_stats('socket-blockerr')
-        print(f'{os.getpid()=} {str(e)}, ignore', file=sys.stderr)
+        context.metrics.add(STAT_SOCKET_BLOCKERR)
+        log.listener.debug('%s, ignore', e)
 
     except socket.timeout as e:
-        context.incr_stats('socket-timeout')
+        context.metrics.add(STAT_SOCKET_TIMEOUT)
+        sample_listen_queue(context, ssock)
         context.handler(pyfastcgi.Event('IDLE'))
 
 
+def drain_backlog(context:pyfastcgi.Context, queue:admission.AdmissionQueue, ssock:socket.socket):
+    '''
+    SO_REUSEPORT のソケットはプロセス毎に accept キューを持つため、close 時に残っていた
+    接続はリセットされてしまう
+    --> 終了前にキューに残っている接続を全て受け付ける
+
+    * drain から close までの間に届いた接続は救えないので、Linux 5.14 以降であれば
+      sysctl net.ipv4.tcp_migrate_req=1 で他のソケットへ移すこと
+    '''
+    if not use_reuseport(context):
+        return
+
+    ssock.setblocking(False)
+
+    while True:
+        try:
+            conn, address = ssock.accept()
+
+        except (BlockingIOError, socket.timeout):
+            break
+
+        count_accepted(context)
+        queue.submit(on_accepted, conn, address)
+
+
 def nonblocking_loop(context:pyfastcgi.Context, ssock:socket.socket):
     with concurrent.futures.ThreadPoolExecutor(max_workers=context.threads) as executor, \
          selectors.DefaultSelector() as selector:
@@ -182,11 +638,15 @@ def nonblocking_loop(context:pyfastcgi.Context, ssock:socket.socket):
 
         # https://docs.python.org/ja/3/library/selectors.html
 
-        a = functools.partial(accept_submit, context, executor)
+        queue = admission.AdmissionQueue(context, executor)
+
+        a = functools.partial(accept_submit, context, queue)
         selector.register(ssock, selectors.EVENT_READ, a)
 
         while context.loop:
-            context.incr_stats('nonblocking-loop')
+            if context.loop_stats:
+                context.metrics.add(STAT_NONBLOCKING_LOOP)
+
             readies = selector.select(context.so_timeout)
 
             if readies:
@@ -195,9 +655,12 @@ def nonblocking_loop(context:pyfastcgi.Context, ssock:socket.socket):
                     callback(ssock)
 
             else:
-                context.incr_stats('select-timeout')
+                context.metrics.add(STAT_SELECT_TIMEOUT)
+                sample_listen_queue(context, ssock)
                 context.handler(pyfastcgi.Event('IDLE'))
 
+        drain_backlog(context, queue, ssock)
+
 
 def blocking_loop(context:pyfastcgi.Context, ssock:socket.socket):
     with concurrent.futures.ThreadPoolExecutor(max_workers=context.threads) as executor, \
@@ -205,28 +668,38 @@ def blocking_loop(context:pyfastcgi.Context, ssock:socket.socket):
 
         ssock.settimeout(context.so_timeout)
 
+        queue = admission.AdmissionQueue(context, executor)
+
         while context.loop:
-            context.incr_stats('bloking-loop')
-            accept_submit(context, executor, ssock)
+            if context.loop_stats:
+                context.metrics.add(STAT_BLOCKING_LOOP)
+
+            accept_submit(context, queue, ssock)
+
+        drain_backlog(context, queue, ssock)
 
 
 def unlink_bind_file(bind_path:str):
     if os.path.exists(bind_path):
-        print(f'unlink {bind_path=}', file=sys.stderr)
+        log.listener.info('unlink %s', bind_path)
         os.unlink(bind_path)
 
 
-@pyfastcgi.report_exception
-def start(context:pyfastcgi.Context):
-    context.handler(pyfastcgi.Event('START-LISTENER'))
+def use_reuseport(context:pyfastcgi.Context) -> bool:
+    '''
+    unix-domain-socket は SO_REUSEPORT による分散ができないので tcp/ip の場合のみ
+    '''
+    return context.reuseport and type(context.bind_addr) != str and hasattr(socket, 'SO_REUSEPORT')
 
+
+def make_server_socket(context:pyfastcgi.Context) -> socket.socket:
     oldmask = None
 
     if type(context.bind_addr) == str:
         family = socket.AF_UNIX
 
         if os.path.exists(context.bind_addr):
-            print(f'unlink {context.bind_addr=}', file=sys.stderr)
+            log.listener.info('unlink %s', context.bind_addr)
             os.unlink(context.bind_addr)
 
         oldmask = os.umask(0o111)
@@ -236,21 +709,89 @@ def start(context:pyfastcgi.Context):
     else:
         family = socket.AF_INET
 
-    with socket.socket(family, socket.SOCK_STREAM) as ssock:
+    ssock = socket.socket(family, socket.SOCK_STREAM)
+
+    try:
         ssock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        if use_reuseport(context):
+            ssock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
         ssock.bind(context.bind_addr)
-        ssock.listen()
 
+    except:
+        ssock.close()
+        raise
+
+    finally:
         if not oldmask is None:
             os.umask(oldmask)
 
-        context.handler(pyfastcgi.Event('LISTEN'))
+    return ssock
+
+
+@pyfastcgi.report_exception
+def start(context:pyfastcgi.Context):
+    context.handler(pyfastcgi.Event('START-LISTENER'))
+
+    if context.scoreboard is None:
+        '''
+        prefork でない場合も status-path で同じ形式の状態を返せるよう、自プロセスのみの表を作る
+        '''
+        context.scoreboard = scoreboard.make_scoreboard(1)
 
-        if context.nonblocking:
-            nonblocking_loop(context, ssock)
+        slot = context.scoreboard.slots[context.scoreboard.alloc()]
+        slot.pid = os.getpid()
+        slot.state = scoreboard.STATE_READY
+
+        context.worker = scoreboard.Worker(slot)
+
+    ssock = make_server_socket(context)
+    linfo = {
+        'ssock': ssock,
+    }
+
+    try:
+        if not use_reuseport(context):
+            ssock.listen(context.backlog)
+
+        '''
+        prefork の場合は LISTEN イベントで fork され、SO_REUSEPORT を使う子プロセスでは
+        プロセス毎に bind したソケットに差し替えられる
+        --> 親プロセスのソケットは bind のみで listen しない (接続が割り振られないように)
+        '''
+        context.handler(pyfastcgi.Event('LISTEN', linfo))
+
+        if use_reuseport(context):
+            linfo['ssock'].listen(context.backlog)
+
+        # prefork の場合は子プロセスで開始される
+        context.watchdog = watchdog.start_watchdog(context)
+        context.profiler = profiler.start_profiler(context)
+        context.capture = capture.start_capture(context)
+        context.proxy = proxy.start_proxy(context)
+        context.cache = cache.start_cache(context)
+        context.coalescer = coalesce.start_coalescer(context)
+        context.reaper = reaper.start_reaper(context)
+
+        if context.asgi_app:
+            asgi.serve(context, linfo['ssock'])
+
+        elif context.nonblocking:
+            nonblocking_loop(context, linfo['ssock'])
 
         else:
-            blocking_loop(context, ssock)
+            blocking_loop(context, linfo['ssock'])
+
+    finally:
+        reaper.stop_reaper(context)
+
+        if not context.worker is None:
+            # 親プロセスが終了した子プロセスの値を retired_* に加算するので、最後の値を書き込む
+            context.worker.publish()
+
+        linfo['ssock'].close()
+        ssock.close()
 
     context.handler(pyfastcgi.Event('STOP-LISTENER'))
 
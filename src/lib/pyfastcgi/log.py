@@ -0,0 +1,235 @@
+import os
+import sys
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+
+
+'''
+ログ出力
+
+標準の logging を使い、カテゴリ毎に logger を分ける
+
+    pyfastcgi.listener   ... accept, close など (接続毎の出力は DEBUG)
+    pyfastcgi.admission  ... 過負荷による拒否
+    pyfastcgi.prefork    ... 子プロセスの管理
+    pyfastcgi.responder  ... responder 共通の処理
+    pyfastcgi.slowlog    ... 処理の遅いリクエストのスタック
+    pyfastcgi.app        ... アプリケーション (サンプル) 用
+    pyfastcgi.access     ... アクセスログ (JSON, 1 リクエスト 1 行)
+    pyfastcgi.client     ... FastCGI クライアント (接続の破棄、再送)
+
+出力は呼び出し元のスレッドでは行わず、キューに入れてバックグラウンドのスレッドが
+まとめて書き込む (stderr への書き込みとそのロックで処理中のスレッドを待たせない)
+
+* 無効なレベルの出力は logging の isEnabledFor() (キャッシュされる) だけで戻るので、
+  頻繁に通る箇所では f-string ではなく引数を渡す形式 (log.debug('%s', a)) で書くこと
+'''
+
+ROOT_NAME = 'pyfastcgi'
+
+CATEGORIES = ('listener', 'admission', 'prefork', 'responder', 'slowlog', 'app', 'access', 'client')
+
+DEFAULT_FORMAT = '%(asctime)s %(process)d %(name)s %(levelname)s %(message)s'
+
+# 一度に書き込む最大のレコード数
+BATCH_MAX = 256
+
+
+def get(category:str) -> logging.Logger:
+    return logging.getLogger(f'{ROOT_NAME}.{category}')
+
+
+root = logging.getLogger(ROOT_NAME)
+listener = get('listener')
+admission = get('admission')
+prefork = get('prefork')
+responder = get('responder')
+slowlog = get('slowlog')
+app = get('app')
+access = get('access')
+client = get('client')
+
+
+class _BatchWriter:
+    '''
+    キューに入ったレコードを出力先 (handler) 毎にまとめて書き込むスレッド
+    '''
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def put(self, target:logging.Handler, record:logging.LogRecord):
+        if self.thread is None:
+            self.start()
+
+        self.queue.put((target, record))
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='pyfastcgi-log', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+
+            batch = [ item ]
+
+            while len(batch) < BATCH_MAX:
+                try:
+                    item = self.queue.get_nowait()
+
+                except queue.Empty:
+                    break
+
+                if item is None:
+                    self._write(batch)
+                    return
+
+                batch.append(item)
+
+            self._write(batch)
+
+    def _write(self, batch:list):
+        lines = {}
+
+        for target, record in batch:
+            try:
+                lines.setdefault(target, []).append(target.format(record))
+
+            except Exception:
+                target.handleError(record)
+
+        for target, a in lines.items():
+            try:
+                target.stream.write(target.terminator.join(a) + target.terminator)
+                target.flush()
+
+            except Exception:
+                pass
+
+    def stop(self, timeout:float=1.0):
+        if self.thread is None:
+            return
+
+        self.queue.put(None)
+        self.thread.join(timeout)
+        self.thread = None
+
+    def after_fork(self):
+        '''
+        fork した子プロセスにはスレッドが存在しないので作り直す
+        (親プロセスで未出力だったレコードは親プロセスが出力するので捨てる)
+        '''
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+
+_writer = _BatchWriter()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_writer.after_fork)
+
+atexit.register(_writer.stop)
+
+
+class QueueingHandler(logging.Handler):
+    '''
+    {target} への出力をバックグラウンドのスレッドに任せる
+    '''
+    def __init__(self, target:logging.StreamHandler):
+        super().__init__()
+        self.target = target
+
+    def emit(self, record:logging.LogRecord):
+        try:
+            # 引数は呼び出し元のスレッドで文字列にしておく (出力時には変更されている可能性がある)
+            record.msg = record.getMessage()
+            record.args = None
+
+            _writer.put(self.target, record)
+
+        except Exception:
+            self.handleError(record)
+
+
+def _stream_handler(path:str) -> logging.StreamHandler:
+    if path is None or path == '-':
+        return logging.StreamHandler(sys.stderr)
+
+    return logging.FileHandler(path, encoding='utf-8')
+
+
+def parse_levels(specs:list) -> dict:
+    '''
+    "listener=debug,prefork=warning" の形式をカテゴリ毎のレベルにする
+    '''
+    levels = {}
+
+    for spec in specs or []:
+        for a in spec.split(','):
+            if not a.strip():
+                continue
+
+            category, _, level = a.partition('=')
+            levels[category.strip()] = logging.getLevelName(level.strip().upper() or 'DEBUG')
+
+    return levels
+
+
+def setup(level:str='INFO', categories:dict=None, log_path:str=None, access_log:str=None):
+    stream = _stream_handler(log_path)
+    stream.setFormatter(logging.Formatter(DEFAULT_FORMAT))
+
+    handler = QueueingHandler(stream)
+
+    root.handlers[:] = [ handler ]
+    root.setLevel(logging.getLevelName(level.upper()))
+    root.propagate = False
+
+    for category, a in (categories or {}).items():
+        get(category).setLevel(a)
+
+    # アクセスログは通常のログとは別の出力先 (無指定なら出力しない)
+    access.propagate = False
+
+    if access_log:
+        astream = _stream_handler(access_log)
+        astream.setFormatter(logging.Formatter('%(message)s'))
+
+        access.handlers[:] = [ QueueingHandler(astream) ]
+        access.setLevel(logging.INFO)
+
+    else:
+        access.handlers[:] = []
+        access.setLevel(logging.CRITICAL + 1)
+
+
+def flush(timeout:float=1.0):
+    '''
+    未出力のレコードを書き込んでスレッドを停止する (os._exit() の前などに)
+    '''
+    _writer.stop(timeout)
+
+
+def access_enabled() -> bool:
+    return access.isEnabledFor(logging.INFO)
+
+
+def write_access(entry:dict):
+    entry.setdefault('time', time.time())
+    entry.setdefault('pid', os.getpid())
+
+    access.info(json.dumps(entry, separators=(',', ':'), default=str))
+
+
+# EOF
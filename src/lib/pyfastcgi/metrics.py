@@ -0,0 +1,111 @@
+import os
+import dataclasses
+import threading
+from dataclasses import dataclass
+
+
+'''
+カウンタ
+
+名前は事前に登録 (counter()) して添字 (Counter) を得ておき、加算はスレッド毎の配列
+(shard) に対して行う。
+shard は自スレッドしか書き込まないので加算時の排他は不要で、全スレッドの合計は
+参照 (Metrics.snapshot()) の際にだけ計算する。
+
+    STAT_ACCEPTED = metrics.counter('socket-accepted')
+    ...
+    context.metrics.add(STAT_ACCEPTED)
+'''
+
+_registry_lock = threading.Lock()
+_names = []
+_counters = {}
+
+
+@dataclass(frozen=True)
+class Counter:
+    name:str
+    index:int
+
+
+def counter(name:str) -> Counter:
+    '''
+    名前に対応する Counter を返す (未登録なら登録する)
+    '''
+    a = _counters.get(name)
+    if not a is None:
+        return a
+
+    with _registry_lock:
+        a = _counters.get(name)
+
+        if a is None:
+            a = Counter(name, len(_names))
+            _names.append(name)
+            _counters[name] = a
+
+    return a
+
+
+@dataclass
+class Metrics:
+    _lock:any = dataclasses.field(init=False, repr=False, default_factory=threading.Lock)
+    _local:any = dataclasses.field(init=False, repr=False, default_factory=threading.local)
+    _shards:list = dataclasses.field(init=False, repr=False, default_factory=list)
+
+    def __post_init__(self):
+        if hasattr(os, 'register_at_fork'):
+            # fork の時点で他のスレッドが保持していたロックを子プロセスで解放する
+            os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def add(self, counter:Counter, value:int=1):
+        try:
+            self._local.values[counter.index] += value
+
+        except (AttributeError, IndexError):
+            self._add_slow(counter, value)
+
+    def _add_slow(self, counter:Counter, value:int):
+        '''
+        初回 (shard の作成) と、shard の作成後に登録されたカウンタの場合
+        '''
+        values = getattr(self._local, 'values', None)
+
+        if values is None:
+            values = []
+            self._local.values = values
+
+            with self._lock:
+                self._shards.append(values)
+
+        if counter.index >= len(values):
+            values.extend([0] * (len(_names) - len(values)))
+
+        values[counter.index] += value
+
+    def get(self, counter:Counter) -> int:
+        with self._lock:
+            shards = list(self._shards)
+
+        return sum(( values[counter.index] for values in shards if counter.index < len(values) ))
+
+    def snapshot(self) -> dict:
+        '''
+        全スレッドの合計 (一度も加算されていないカウンタは含まない)
+        '''
+        with self._lock:
+            shards = list(self._shards)
+
+        totals = [0] * len(_names)
+
+        for values in shards:
+            for index, value in enumerate(list(values)):
+                totals[index] += value
+
+        return { _names[index]: value for index, value in enumerate(totals) if value }
+
+
+# EOF
@@ -0,0 +1,206 @@
+import os
+import contextlib
+import cProfile
+import dataclasses
+import random
+import re
+import signal
+import threading
+import time
+import tracemalloc
+import pyfastcgi
+import pyfastcgi.log as log
+from dataclasses import dataclass
+
+
+'''
+実行中の子プロセスでのプロファイリング
+
+SIGUSR2 (または --profile-path へのリクエスト) を受けた子プロセスだけが、以降の
+--profile-requests 件のリクエストを cProfile で計測し、終わったら結果を temp_dir に出力する
+
+    pyfastcgi-profile-{pid}-{日時}-{連番}.pstats       ... python -m pstats で読める
+    pyfastcgi-profile-{pid}-{日時}-{連番}.tracemalloc  ... --profile-tracemalloc の場合のみ
+                                                           (tracemalloc.Snapshot.load() で読める)
+
+* --profile-sample の割合のリクエストだけを計測する (計測した件数で数える)
+* --profile-route の正規表現に route (responder のクラス名) か SCRIPT_NAME が一致するリクエストだけを計測する
+* cProfile はスレッド毎に有効になるので、同時に計測するのは一つのスレッドのみ
+  (計測中に他のスレッドで始まったリクエストは計測しない)
+* 計測していない間は profile() で判定するだけなので、他のリクエストや子プロセスは遅くならない
+'''
+
+PROFILE_PREFIX = 'pyfastcgi-profile-'
+
+
+@dataclass
+class Session:
+    sequence:int
+    requests:int
+    sample:float
+    tracemalloc:bool
+    profile:cProfile.Profile = dataclasses.field(init=False, default_factory=cProfile.Profile)
+    profiled:int = dataclasses.field(init=False, default=0)
+    started:float = dataclasses.field(init=False, default_factory=time.time)
+
+
+@dataclass
+class Profiler:
+    context:pyfastcgi.Context
+    lock:any = dataclasses.field(init=False, default_factory=threading.Lock)
+    route:re.Pattern = dataclasses.field(init=False, default=None)
+    session:Session = dataclasses.field(init=False, default=None)
+    signaled:bool = dataclasses.field(init=False, default=False)
+    busy:bool = dataclasses.field(init=False, default=False)
+    sessions:int = dataclasses.field(init=False, default=0)
+    dumps:list = dataclasses.field(init=False, default_factory=list)
+
+    def __post_init__(self):
+        if self.context.profile_route:
+            self.route = re.compile(self.context.profile_route)
+
+    def on_signal(self, signum, frame):
+        '''
+        シグナルハンドラではロックを取らず、次のリクエストで開始する
+        '''
+        self.signaled = True
+
+    def arm(self, requests:int=0, sample:float=None, use_tracemalloc:bool=None) -> bool:
+        '''
+        計測を開始する (既に計測中なら何もせずに False)
+        '''
+        with self.lock:
+            if not self.session is None:
+                return False
+
+            self.sessions += 1
+
+            session = Session(
+                self.sessions,
+                requests or self.context.profile_requests,
+                self.context.profile_sample if sample is None else sample,
+                self.context.profile_tracemalloc if use_tracemalloc is None else use_tracemalloc)
+
+            if session.tracemalloc and not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+            self.session = session
+
+        log.root.info('profile start requests=%d sample=%.3f tracemalloc=%s', session.requests, session.sample, session.tracemalloc)
+
+        return True
+
+    def match(self, route:str, params:dict) -> bool:
+        if self.route is None:
+            return True
+
+        return bool(self.route.search(route) or self.route.search(params.get('SCRIPT_NAME') or ''))
+
+    @contextlib.contextmanager
+    def profile(self, route:str, params:dict):
+        if self.signaled:
+            self.signaled = False
+            self.arm()
+
+        session = self.session
+
+        if session is None or not self.match(route, params):
+            yield None
+            return
+
+        with self.lock:
+            if self.busy or self.session is not session or random.random() >= session.sample:
+                session = None
+
+            else:
+                self.busy = True
+
+        if session is None:
+            yield None
+            return
+
+        try:
+            session.profile.enable()
+
+            try:
+                yield session
+
+            finally:
+                session.profile.disable()
+
+        finally:
+            with self.lock:
+                self.busy = False
+                session.profiled += 1
+
+                finished = session.profiled >= session.requests
+                if finished:
+                    self.session = None
+
+            if finished:
+                self.dump(session)
+
+    def dump(self, session:Session):
+        name = f'{PROFILE_PREFIX}{os.getpid()}-{time.strftime("%Y%m%d%H%M%S", time.localtime(session.started))}-{session.sequence}'
+        base = os.path.join(self.context.temp_dir, name)
+        paths = []
+
+        try:
+            session.profile.dump_stats(base + '.pstats')
+            paths.append(base + '.pstats')
+
+            if session.tracemalloc and tracemalloc.is_tracing():
+                tracemalloc.take_snapshot().dump(base + '.tracemalloc')
+                paths.append(base + '.tracemalloc')
+
+        except OSError:
+            log.root.exception('profile dump failed')
+
+        finally:
+            if session.tracemalloc:
+                tracemalloc.stop()
+
+        self.dumps.extend(paths)
+
+        log.root.info('profile done requests=%d %s', session.profiled, ' '.join(paths))
+
+    def state(self) -> dict:
+        session = self.session
+
+        return {
+            'pid':          os.getpid(),
+            'profiling':    not session is None,
+            'requests':     session.requests if session else 0,
+            'profiled':     session.profiled if session else 0,
+            'sample':       session.sample if session else self.context.profile_sample,
+            'tracemalloc':  session.tracemalloc if session else self.context.profile_tracemalloc,
+            'route':        self.context.profile_route,
+            'dumps':        list(self.dumps),
+        }
+
+
+def start_profiler(context:pyfastcgi.Context) -> Profiler:
+    '''
+    メインスレッドから呼ぶこと (シグナルハンドラを登録する)
+
+    prefork の場合は子プロセスで呼ばれるので、SIGUSR2 は子プロセスの pid に送る
+    '''
+    if not context.profile_requests:
+        return None
+
+    profiler = Profiler(context)
+
+    if hasattr(signal, 'SIGUSR2'):
+        signal.signal(signal.SIGUSR2, profiler.on_signal)
+
+    return profiler
+
+
+def profile(context:pyfastcgi.Context, route:str, params:dict):
+    if context.profiler is None:
+        return contextlib.nullcontext()
+
+    return context.profiler.profile(route, params)
+
+
+# EOF
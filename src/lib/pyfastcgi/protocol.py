@@ -1,15 +1,21 @@
-import sys
 import collections
+import collections.abc
 import socket
 import struct
-import traceback
+import logging
+import dataclasses
 from dataclasses import dataclass
 
 
+# protocol は pyfastcgi.log に依存させない (名前は log.listener と同じ)
+_log = logging.getLogger('pyfastcgi.listener')
+
+
 FCGI_HEADER_LEN         = 8
 FCGI_VERSION_1          = 1
 FCGI_MAX_LENGTH         = 0xffff
 FCGI_KEEP_CONN          = 1
+FCGI_NULL_REQUEST_ID    = 0
 
 FCGI_BEGIN_REQUEST		=  1 # [in]                              */
 FCGI_ABORT_REQUEST		=  2 # [in]  (not supported)             */
@@ -21,16 +27,26 @@ FCGI_STDERR				=  7 # [out] errors                      */
 FCGI_DATA				=  8 # [in]  filter data (not supported) */
 FCGI_GET_VALUES			=  9 # [in]                              */
 FCGI_GET_VALUES_RESULT	= 10 # [out]                             */
+FCGI_UNKNOWN_TYPE		= 11 # [out]                             */
 
 FCGI_REQUEST_COMPLETE	= 0
 FCGI_CANT_MPX_CONN		= 1
 FCGI_OVERLOADED			= 2
 FCGI_UNKNOWN_ROLE		= 3
 
+FCGI_RESPONDER          = 1
+FCGI_AUTHORIZER         = 2
+FCGI_FILTER             = 3
+
+# FCGI_GET_VALUES の変数名
+FCGI_MAX_CONNS          = 'FCGI_MAX_CONNS'
+FCGI_MAX_REQS           = 'FCGI_MAX_REQS'
+FCGI_MPXS_CONNS         = 'FCGI_MPXS_CONNS'
+
 FCGI_ROLE_NAMES = {
-    1: 'RESPONDER',
-    2: 'AUTHORIZER',
-    3: 'FILTER',
+    FCGI_RESPONDER:  'RESPONDER',
+    FCGI_AUTHORIZER: 'AUTHORIZER',
+    FCGI_FILTER:     'FILTER',
 }
 
 #PACKET_IO_LEN = FCGI_MAX_LENGTH
@@ -40,6 +56,9 @@ PACKET_IO_CONTENT_LEN = PACKET_IO_LEN - FCGI_HEADER_LEN
 assert PACKET_IO_LEN >= FCGI_HEADER_LEN
 assert PACKET_IO_LEN <= FCGI_MAX_LENGTH
 
+# send_file() のレコード毎の content の長さ (8 の倍数にして padding を不要にする)
+SENDFILE_CONTENT_LEN = FCGI_MAX_LENGTH & ~7
+
 #
 FCGI_PARAMSKEY_CONTENT_TYPE     = 'CONTENT_TYPE'
 FCGI_PARAMSKEY_CONTENT_LENGTH   = 'CONTENT_LENGTH'
@@ -87,6 +106,15 @@ class FCGI_BeginRequestBody:
     flags:int
     reserved:bytes = b'\0\0\0\0\0'
 
+    def dump(self) -> bytes:
+        hdata = (
+            self.role,
+            self.flags,
+            self.reserved,
+        )
+
+        return struct.pack('>HB5s', *hdata)
+
 @dataclass(frozen=True)
 class FCGI_EndRequestBody:
     appStatus:int
@@ -103,6 +131,20 @@ class FCGI_EndRequestBody:
         return struct.pack('>IB3s', *hdata)
 
 
+@dataclass
+class MemorySocket:
+    '''
+    send_record() の送信先をメモリにするための socket 代替
+    '''
+    buff:bytearray = dataclasses.field(default_factory=bytearray)
+
+    def getblocking(self) -> bool:
+        return True
+
+    def sendall(self, data):
+        self.buff += data
+
+
 def recv_bytes(conn:socket.socket, nrecv:int) -> bytearray:
     remaining = nrecv
     buff = bytearray(nrecv)
@@ -243,6 +285,47 @@ def make_params(mem:memoryview) -> collections.Mapping:
     return params
 
 
+def _dump_length(length:int) -> bytes:
+    if length >> 7 == 0:
+        return struct.pack('B', length)
+
+    return struct.pack('>I', length | 0x80000000)
+
+
+def dump_params(params:collections.abc.Mapping) -> bytes:
+    '''
+    make_params() の逆 (クライアント側で FCGI_PARAMS の contentData を作成する)
+    '''
+    buff = bytearray()
+
+    for name, value in params.items():
+        nameData = str(name).encode('utf-8')
+        valueData = str(value).encode('utf-8')
+
+        buff += _dump_length(len(nameData))
+        buff += _dump_length(len(valueData))
+        buff += nameData
+        buff += valueData
+
+    return bytes(buff)
+
+
+def dump_records(recordType:int, requestId:int, data) -> bytes:
+    '''
+    {data} を PACKET_IO_LEN 毎のレコードのバイト列にする (空であれば終端のレコード)
+    '''
+    if not data:
+        return make_record(recordType, requestId, contentData=b'').dump()
+
+    buff = bytearray()
+
+    with memoryview(data) as mem:
+        for pos in range(0, len(mem), PACKET_IO_LEN):
+            buff += make_record(recordType, requestId, contentData=bytes(mem[pos:pos+PACKET_IO_LEN])).dump()
+
+    return bytes(buff)
+
+
 def send_record(conn:socket.socket, recordType:int, requestId:int, *, contentData=b'', contentLength=-1) -> int:
     assert conn.getblocking()
 
@@ -281,6 +364,55 @@ def send_record(conn:socket.socket, recordType:int, requestId:int, *, contentDat
     return sum_send
 
 
+def send_file(conn:socket.socket, recordType:int, requestId:int, f, offset:int, count:int) -> int:
+    '''
+    ファイルの {offset} から {count} バイトを sendfile で送信する (content をユーザ空間にコピーしない)
+
+    レコードのヘッダ (と padding) のみ sendall で送信し、続く content を socket.sendfile() に任せる
+    (sendfile が使えない場合は socket.sendfile() 内で send にフォールバックする)
+
+    * {f} はバイナリモードの通常ファイルであること
+    * sendfile を持たない送信先 (MemorySocket など) は読み込んで送信する
+    '''
+    sum_send = 0
+
+    if not hasattr(conn, 'sendfile'):
+        f.seek(offset)
+
+        while count > 0:
+            contentData = f.read(min(count, PACKET_IO_LEN))
+            if not contentData:
+                raise EOFError(f'file is shorter than expected: {count} bytes left')
+
+            sum_send += send_record(conn, recordType, requestId, contentData=contentData)
+            count -= len(contentData)
+
+        return sum_send
+
+    # ヘッダと content を一つのパケットにまとめられるよう、続きがあることをカーネルに伝える
+    more = getattr(socket, 'MSG_MORE', 0)
+
+    while count > 0:
+        ncontent = min(count, SENDFILE_CONTENT_LEN)
+        header = make_record_header(recordType, requestId, contentLength=ncontent)
+
+        conn.sendall(header.dump(), more)
+
+        nsend = conn.sendfile(f, offset, ncontent)
+        if nsend < ncontent:
+            # レコードのヘッダを送信済なので、続きを送信できない
+            raise EOFError(f'file is shorter than expected: {ncontent - nsend} bytes left')
+
+        if header.paddingLength:
+            conn.sendall(bytes(header.paddingLength))
+
+        sum_send += FCGI_HEADER_LEN + ncontent + header.paddingLength
+        offset += ncontent
+        count -= ncontent
+
+    return sum_send
+
+
 def close_socket(conn:socket.socket):
     if conn.fileno() <= 0:
         return False
@@ -305,8 +437,8 @@ def close_socket(conn:socket.socket):
             nread = conn.recv_into(buff)
 
     except:
-        # ignore
-        traceback.print_exception(*sys.exc_info(), file=sys.stderr)
+        # ignore (読み飛ばし中のタイムアウトなど)
+        _log.debug('drain before close', exc_info=True)
 
     finally:
         try:
@@ -314,7 +446,7 @@ def close_socket(conn:socket.socket):
                 conn.close()
         except:
             # ignore
-            traceback.print_exception(*sys.exc_info(), file=sys.stderr)
+            _log.warning('close', exc_info=True)
 
     return True
 
@@ -0,0 +1,258 @@
+import bisect
+import contextlib
+import dataclasses
+import hashlib
+import random
+import threading
+import time
+import pyfastcgi
+import pyfastcgi.client as client
+import pyfastcgi.log as log
+import pyfastcgi.protocol as protocol
+from dataclasses import dataclass
+
+
+'''
+プロキシ (--proxy-backends)
+
+受け付けたリクエストを、接続を再利用 (pyfastcgi.client.Pool) して他の FastCGI サーバ
+(pyfastcgi や php-fpm) に転送する
+
+    python prefork.py --proxy-backends=10.0.0.1:9000,10.0.0.2:9000 --proxy-balance=least
+
+振り分け (--proxy-balance)
+
+    least   ... 処理中のリクエストが最も少ないバックエンド (同数であればランダム)
+    hash    ... --proxy-hash-param の値による consistent hash (同じ値は同じバックエンドへ)
+                値が無い場合は least と同じ
+
+接続数
+
+    * バックエンドごとの接続の最大は --proxy-max-connections (0 の場合はスレッド数) と、
+      バックエンドの FCGI_MAX_CONNS を自身のプロセス数で割った値の小さい方
+      (pyfastcgi は FCGI_KEEP_CONN の接続が待機中もスレッドを占有するため)
+
+切り離し
+
+    * --proxy-health-interval 毎に FCGI_GET_VALUES を送信し、応答しないバックエンドは切り離す
+      (応答すれば戻す)
+    * ヘルスチェックは HEALTH_TIMEOUT 秒 (--proxy-timeout が短ければそちら) で打ち切り、
+      全てのバックエンドを並列に確認する (応答しないバックエンドが他の切り離しや復帰を遅らせないように)
+    * 最初の確認もヘルスチェックのスレッドで行い、子プロセスの起動はその終了を
+      最大で HEALTH_TIMEOUT の 2 倍 (接続と応答) まで待つ
+    * 転送の失敗 (接続できない、応答の前に切断された) が --proxy-eject-failures 回続いた場合も
+      次のヘルスチェックで応答するまで切り離す
+    * 全て切り離されている場合は、切り離されていないものとして振り分ける
+      (ヘルスチェックの誤判定で全て止まらないように)
+
+* 処理中のリクエスト数は子プロセス毎に数える (プロセス間では共有しない)
+* 接続のプールとヘルスチェックのスレッドは子プロセス毎に作る (fork 後に開始すること)
+'''
+
+BALANCE_LEAST = 'least'
+BALANCE_HASH = 'hash'
+
+# consistent hash のバックエンド毎の仮想ノード数
+VIRTUAL_NODES = 64
+
+# ヘルスチェックの接続と応答のタイムアウト (秒)
+HEALTH_TIMEOUT = 1.0
+
+
+def hash_key(value:str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+def target_name(target) -> str:
+    return target if type(target) == str else f'{target[0]}:{target[1]}'
+
+
+@dataclass(eq=False)
+class Backend:
+    target:any
+    pool:client.Pool
+    outstanding:int = 0
+    failures:int = 0
+    ejected:bool = False
+    ejected_at:float = 0.0
+    values:dict = dataclasses.field(default_factory=dict)
+
+    @property
+    def name(self) -> str:
+        return target_name(self.target)
+
+    def state(self) -> dict:
+        return {
+            'backend':      self.name,
+            'outstanding':  self.outstanding,
+            'failures':     self.failures,
+            'ejected':      self.ejected,
+            'values':       self.values,
+            **self.pool.stats(),
+        }
+
+
+@dataclass
+class Balancer:
+    backends:list
+    balance:str = BALANCE_LEAST
+    hash_param:str = 'REMOTE_ADDR'
+    eject_failures:int = 3
+    health_interval:float = 2.0
+    health_timeout:float = HEALTH_TIMEOUT
+    max_connections:int = 0
+    procs:int = 1
+    lock:any = dataclasses.field(init=False, default_factory=threading.Lock)
+    ring:list = dataclasses.field(init=False, default_factory=list)
+    closed:any = dataclasses.field(init=False, default_factory=threading.Event)
+    checked:any = dataclasses.field(init=False, default_factory=threading.Event)
+
+    def __post_init__(self):
+        # バックエンドの順序によらず同じ配置になるよう、名前から仮想ノードを作る
+        self.ring = sorted(( (hash_key(f'{backend.name}#{i}'), index) for index, backend in enumerate(self.backends) for i in range(VIRTUAL_NODES) ))
+        self.ring_keys = [ key for key, _ in self.ring ]
+
+    def _least(self) -> Backend:
+        candidates = [ backend for backend in self.backends if not backend.ejected ] or self.backends
+
+        least = min(( backend.outstanding for backend in candidates ))
+
+        return random.choice([ backend for backend in candidates if backend.outstanding == least ])
+
+    def _hashed(self, value:str) -> Backend:
+        '''
+        リング上で値のハッシュ以降の最初の (切り離されていない) バックエンド
+        (切り離されている間は次のバックエンドへ移り、戻れば元に戻る)
+        '''
+        start = bisect.bisect(self.ring_keys, hash_key(value))
+
+        for offset in range(len(self.ring)):
+            _, index = self.ring[(start + offset) % len(self.ring)]
+            backend = self.backends[index]
+
+            if not backend.ejected:
+                return backend
+
+        return self._least()
+
+    def acquire(self, params:dict) -> Backend:
+        with self.lock:
+            value = params.get(self.hash_param) if self.balance == BALANCE_HASH else None
+            backend = self._hashed(value) if value else self._least()
+
+            backend.outstanding += 1
+
+            return backend
+
+    def release(self, backend:Backend, ok:bool):
+        '''
+        ok=False は転送の失敗 (バックエンドの応答のエラーは含まない)
+        '''
+        with self.lock:
+            backend.outstanding -= 1
+
+            if ok:
+                backend.failures = 0
+                return
+
+            backend.failures += 1
+
+            if not backend.ejected and backend.failures >= self.eject_failures:
+                self._eject(backend, f'{backend.failures} consecutive failures')
+
+    def _eject(self, backend:Backend, reason:str):
+        backend.ejected = True
+        backend.ejected_at = time.monotonic()
+
+        log.client.warning('eject backend %s: %s', backend.name, reason)
+
+    def check(self, backend:Backend):
+        try:
+            values = backend.pool.probe(self.health_timeout)
+
+        except (OSError, AssertionError, ValueError) as e:
+            with self.lock:
+                if not backend.ejected:
+                    self._eject(backend, f'health check failed: {e!r}')
+
+            return
+
+        with self.lock:
+            backend.values = values
+
+            with contextlib.suppress(KeyError, ValueError):
+                share = max(int(values[protocol.FCGI_MAX_CONNS]) // self.procs, 1)
+                backend.pool.max_connections = min(self.max_connections, share)
+
+            if backend.ejected:
+                backend.ejected = False
+                backend.failures = 0
+
+                log.client.info('restore backend %s after %.1fs', backend.name, time.monotonic() - backend.ejected_at)
+
+    def check_all(self):
+        threads = [ threading.Thread(target=self.check, args=(backend,), name='pyfastcgi-proxy-check', daemon=True) for backend in self.backends ]
+
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+    def run_health_check(self):
+        '''
+        最初の確認の後、--proxy-health-interval 毎に確認する (0 の場合は最初のみ)
+        '''
+        self.check_all()
+        self.checked.set()
+
+        if self.health_interval <= 0:
+            return
+
+        while not self.closed.wait(self.health_interval):
+            self.check_all()
+
+    def state(self) -> list:
+        with self.lock:
+            return [ backend.state() for backend in self.backends ]
+
+    def close(self):
+        self.closed.set()
+
+        for backend in self.backends:
+            backend.pool.close()
+
+
+def start_proxy(context:pyfastcgi.Context) -> Balancer:
+    '''
+    prefork の場合は子プロセスで開始すること
+    '''
+    if not context.proxy_backends:
+        return None
+
+    '''
+    バックエンドが同じ設定 (--so-timeout) であれば、待機中の接続はそれより前に閉じられるので
+    その半分を過ぎた接続は再利用しない
+    '''
+    max_connections = context.proxy_max_connections or context.threads
+
+    backends = [
+        Backend(target, client.Pool(target, max_connections=max_connections,
+            timeout=context.proxy_timeout, idle_timeout=context.so_timeout / 2, check_interval=min(client.DEFAULT_CHECK_INTERVAL, context.so_timeout / 4)))
+        for target in context.proxy_backends
+    ]
+
+    balancer = Balancer(backends, context.proxy_balance, context.proxy_hash_param, context.proxy_eject_failures, context.proxy_health_interval,
+        min(HEALTH_TIMEOUT, context.proxy_timeout), max_connections, context.extra.get('procs', 1))
+
+    threading.Thread(target=balancer.run_health_check, name='pyfastcgi-proxy-health', daemon=True).start()
+
+    # 最初の確認を待つ (応答しないバックエンドに振り分けないように)
+    balancer.checked.wait(balancer.health_timeout * 2)
+
+    log.listener.info('proxy to %s balance=%s', ', '.join(( backend.name for backend in backends )), context.proxy_balance)
+
+    return balancer
+
+
+# EOF
@@ -0,0 +1,244 @@
+import dataclasses
+import selectors
+import socket
+import threading
+import time
+import pyfastcgi
+import pyfastcgi.log as log
+import pyfastcgi.metrics as metrics
+import pyfastcgi.protocol as protocol
+from dataclasses import dataclass
+
+
+'''
+接続の後始末 (読み残しの破棄と close) を処理スレッドから切り離す
+
+protocol.close_socket() は shutdown(SHUT_WR) の後、Web サーバが接続を閉じるまで (最大 0.1 秒)
+読み残しを読み飛ばしてから close するため、応答を送信し終えたスレッドがその間プールに戻れない。
+
+子プロセス毎に一つのスレッド (reaper) が閉じる途中の接続を selector で待ち
+
+    * 処理スレッドは shutdown(SHUT_WR) と待たずに読める分の読み飛ばしだけを行い、
+      EOF まで読めなければ reaper に渡してすぐにプールに戻る
+    * reaper は EOF (Web サーバ側の close) を読んだら close する
+    * --close-linger 秒以内に EOF が来なければ読み残しがあっても close する
+    * 閉じる途中の接続が MAX_CLOSING を超える場合は待たずに close する
+
+--close-linger=0 の場合は reaper を使わず、従来どおり処理スレッドで protocol.close_socket() を行う
+'''
+
+# reaper が同時に保持する接続の上限
+MAX_CLOSING = 4096
+
+STAT_CLOSE_DEFERRED     = metrics.counter('close-deferred')
+STAT_CLOSE_LINGER_EXPIRED = metrics.counter('close-linger-expired')
+STAT_CLOSE_OVERFLOW     = metrics.counter('close-overflow')
+
+
+def drain(conn:socket.socket, buff:bytearray) -> bool:
+    '''
+    待たずに読める分を読み飛ばす (EOF またはエラーで閉じてよければ True)
+    '''
+    try:
+        while True:
+            if conn.recv_into(buff) <= 0:
+                return True
+
+    except (BlockingIOError, InterruptedError):
+        return False
+
+    except OSError:
+        # reset など
+        return True
+
+
+def close_quietly(conn:socket.socket):
+    try:
+        conn.close()
+
+    except:
+        # ignore
+        log.listener.warning('close', exc_info=True)
+
+
+@dataclass
+class Reaper:
+    context:pyfastcgi.Context
+    linger:float
+    selector:any = dataclasses.field(init=False, default_factory=selectors.DefaultSelector)
+    lock:any = dataclasses.field(init=False, default_factory=threading.Lock)
+    pending:list = dataclasses.field(init=False, default_factory=list)
+    closing:int = dataclasses.field(init=False, default=0)
+    running:bool = dataclasses.field(init=False, default=True)
+    thread:any = dataclasses.field(init=False, default=None)
+
+    def __post_init__(self):
+        # 処理スレッドから select() 中の reaper を起こす
+        self.waker, self.wakee = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakee.setblocking(False)
+
+        self.selector.register(self.wakee, selectors.EVENT_READ)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='pyfastcgi-reaper', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        '''
+        残っている接続を全て close して終了する
+        '''
+        self.running = False
+        self._wakeup()
+
+        if not self.thread is None:
+            self.thread.join()
+
+    def close(self, conn:socket.socket) -> bool:
+        '''
+        {conn} を閉じる (既に閉じられていれば False)
+        '''
+        if conn.fileno() <= 0:
+            return False
+
+        try:
+            '''
+            php-src-master/main/fastcgi.c
+            void fcgi_close(fcgi_request *req, int force, int destroy)
+            '''
+            conn.shutdown(socket.SHUT_WR)
+            conn.setblocking(False)
+
+            if drain(conn, bytearray(protocol.PACKET_IO_LEN)):
+                close_quietly(conn)
+                return True
+
+        except OSError:
+            close_quietly(conn)
+            return True
+
+        with self.lock:
+            if not self.running or self.closing + len(self.pending) >= MAX_CLOSING:
+                deferred = False
+
+            else:
+                self.pending.append((conn, time.monotonic() + self.linger))
+                deferred = True
+
+        if not deferred:
+            self.context.metrics.add(STAT_CLOSE_OVERFLOW)
+            close_quietly(conn)
+            return True
+
+        self.context.metrics.add(STAT_CLOSE_DEFERRED)
+        self._wakeup()
+
+        return True
+
+    def _wakeup(self):
+        try:
+            self.waker.send(b'\0')
+
+        except (BlockingIOError, InterruptedError):
+            # 既に起こしている
+            pass
+
+        except OSError:
+            # 終了済み
+            pass
+
+    def _take_pending(self):
+        try:
+            while self.wakee.recv(protocol.PACKET_IO_LEN):
+                pass
+
+        except (BlockingIOError, InterruptedError):
+            pass
+
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.closing += len(pending)
+
+        for conn, deadline in pending:
+            self.selector.register(conn, selectors.EVENT_READ, deadline)
+
+    def _release(self, conn:socket.socket):
+        self.selector.unregister(conn)
+        close_quietly(conn)
+
+        with self.lock:
+            self.closing -= 1
+
+    def _run(self):
+        buff = bytearray(protocol.PACKET_IO_LEN)
+
+        try:
+            while self.running:
+                keys = [ key for key in self.selector.get_map().values() if key.fileobj is not self.wakee ]
+                timeout = max(min(( key.data for key in keys ), default=time.monotonic() + self.context.so_timeout) - time.monotonic(), 0.0)
+
+                for key, _ in self.selector.select(timeout):
+                    if key.fileobj is self.wakee:
+                        self._take_pending()
+
+                    elif drain(key.fileobj, buff):
+                        self._release(key.fileobj)
+
+                now = time.monotonic()
+
+                for key in keys:
+                    # 同じ周回で close した fd が再利用されている場合があるので key で比べる
+                    if key.data <= now and self.selector.get_map().get(key.fd) is key:
+                        self.context.metrics.add(STAT_CLOSE_LINGER_EXPIRED)
+                        self._release(key.fileobj)
+
+        except:
+            log.listener.error('reaper', exc_info=True)
+
+        finally:
+            with self.lock:
+                self.running = False
+                pending, self.pending = self.pending, []
+
+            for conn, _ in pending:
+                close_quietly(conn)
+
+            for key in list(self.selector.get_map().values()):
+                if not key.fileobj is self.wakee:
+                    self._release(key.fileobj)
+
+            self.selector.close()
+            self.wakee.close()
+            self.waker.close()
+
+
+def close(context:pyfastcgi.Context, conn:socket.socket) -> bool:
+    '''
+    {conn} の後始末 (reaper が無ければこのスレッドで待って閉じる)
+    '''
+    if context.reaper is None:
+        return protocol.close_socket(conn)
+
+    return context.reaper.close(conn)
+
+
+def start_reaper(context:pyfastcgi.Context) -> Reaper:
+    '''
+    prefork の場合は fork 後の子プロセスで開始すること (スレッドは fork で引き継がれない)
+    '''
+    if context.close_linger <= 0 or context.asgi_app:
+        return None
+
+    reaper = Reaper(context, context.close_linger)
+    reaper.start()
+
+    return reaper
+
+
+def stop_reaper(context:pyfastcgi.Context):
+    if not context.reaper is None:
+        context.reaper.stop()
+        context.reaper = None
+
+
+# EOF
@@ -1,5 +1,6 @@
 import http.client
 import pyfastcgi
+import pyfastcgi.histogram as histogram
 import pyfastcgi.protocol as protocol
 
 
@@ -16,6 +17,10 @@ class _ErrorResponder(pyfastcgi._BaseResponder):
         mesg = http.client.responses[code]
         herr = f'{code} {mesg}'
 
+        timing = histogram.current()
+        if not timing is None:
+            timing.status = code
+
         body = f'<!doctype html><html><body>{herr}</body></html>'.encode('utf-8')
         nbody = len(body)
 
@@ -60,6 +65,12 @@ class NotImplementedResponder(_ErrorResponder):
     def http_code(self) -> int:
         return http.client.NOT_IMPLEMENTED
 
+# 502
+class BadGatewayResponder(_ErrorResponder):
+    @property
+    def http_code(self) -> int:
+        return http.client.BAD_GATEWAY
+
 # 503
 class ServiceUnavailableResponder(_ErrorResponder):
     @property
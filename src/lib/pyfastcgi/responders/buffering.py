@@ -1,10 +1,12 @@
 import os
-import sys
 import mmap
 import pathlib
 import shutil
 import tempfile
 import pyfastcgi
+import pyfastcgi.cache as cache
+import pyfastcgi.coalesce as coalesce
+import pyfastcgi.log as log
 import pyfastcgi.protocol as protocol
 import pyfastcgi.responders.errors as errors
 import pyfastcgi.responders.streaming as streaming
@@ -18,7 +20,7 @@ def _close_tempfile(tmpf):
         tmpf.close()
 
     if os.path.exists(tmpf.name):
-        print(f'unlink {tmpf.name=}', file=sys.stderr)
+        log.responder.debug('unlink %s', tmpf.name)
         os.unlink(tmpf.name)
 
 
@@ -44,7 +46,10 @@ class BufferingResponder(streaming.StreamingResponder):
                 if stdout_data is None:
                     raise errors.NoResponseError()
 
-                pyfastcgi.send_record(self.conn, protocol.FCGI_STDOUT, self.requestId, contentData=stdout_data)
+                # --cache-max-bytes で保存できる (--coalesce で待っているリクエストに渡せる) 応答は
+                # レコードにしたものを送信する
+                if not cache.store_response(self.context, self.conn, self.requestId, self.params, stdout_data, coalesce.current()):
+                    pyfastcgi.send_record(self.conn, protocol.FCGI_STDOUT, self.requestId, contentData=stdout_data)
 
         finally:
             if not stdout_data is None:
@@ -193,7 +198,7 @@ class BufferingResponder(streaming.StreamingResponder):
 
         elif tstdin == pyfastcgi.StdioType.TMPFILE:
             if os.path.exists(wpath):
-                print(f'unlink {wpath=}', file=sys.stderr)
+                log.responder.debug('unlink %s', wpath)
                 os.unlink(wpath)
 
             assert self._stdin.closed
@@ -0,0 +1,22 @@
+import pyfastcgi
+import pyfastcgi.histogram as histogram
+import pyfastcgi.log as log
+
+
+'''
+CachedResponder
+
+保存済の FCGI_STDOUT のレコード (pyfastcgi.cache) をそのまま送信する
+'''
+class CachedResponder(pyfastcgi._BaseResponder):
+    entry = None
+
+    def do_response(self):
+        timing = histogram.current()
+        if not timing is None and log.access_enabled():
+            timing.status = self.entry.status()
+
+        self.conn.sendall(self.entry.records(self.requestId))
+
+
+# EOF
@@ -0,0 +1,56 @@
+import json
+import distutils.util
+import urllib.parse
+import pyfastcgi
+import pyfastcgi.protocol as protocol
+import pyfastcgi.responders.status as status
+
+
+ACTION_START = 'start'
+ACTION_STATE = 'state'
+
+
+def is_profile_request(context:pyfastcgi.Context, params:dict) -> bool:
+    return status.request_path(params) == context.profile_path
+
+
+'''
+ProfileResponder
+
+受け付けた子プロセスで計測を開始し、その子プロセスの状態を返す
+
+    ?action=start (既定)    ... requests, sample, tracemalloc で起動時の設定を上書きできる
+    ?action=state           ... 状態 (出力したファイル) のみ
+'''
+class ProfileResponder(pyfastcgi._BaseResponder):
+    def do_response(self):
+        query = { k: v[0] for k, v in urllib.parse.parse_qs(self.params.get('QUERY_STRING', '')).items() }
+        profiler = self.context.profiler
+
+        code = '200 OK'
+
+        try:
+            if query.get('action', ACTION_START) == ACTION_START:
+                requests = int(query.get('requests', 0))
+                sample = float(query['sample']) if 'sample' in query else None
+                use_tracemalloc = distutils.util.strtobool(query['tracemalloc']) != 0 if 'tracemalloc' in query else None
+
+                if not profiler.arm(requests, sample, use_tracemalloc):
+                    code = '409 Conflict'
+
+        except ValueError:
+            code = '400 Bad Request'
+
+        headers = {
+            pyfastcgi.CONST_STATUS: code,
+            pyfastcgi.CONST_CONTENT_TYPE: 'application/json; charset=utf-8',
+            'Cache-Control': 'no-store',
+        }
+
+        body = json.dumps(profiler.state(), indent=2)
+
+        pyfastcgi.send_record(self.conn, protocol.FCGI_STDOUT, self.requestId, contentData=pyfastcgi.Response(headers, body))
+        pyfastcgi.send_record(self.conn, protocol.FCGI_STDOUT, self.requestId)
+
+
+# EOF
@@ -0,0 +1,128 @@
+import threading
+import pyfastcgi
+import pyfastcgi.client as client
+import pyfastcgi.histogram as histogram
+import pyfastcgi.log as log
+import pyfastcgi.protocol as protocol
+import pyfastcgi.responders
+import pyfastcgi.responders.streaming as streaming
+
+
+'''
+ProxyResponder
+
+params はそのまま、FCGI_STDIN と FCGI_STDOUT, FCGI_STDERR はレコード毎にバックエンドとの間で
+中継する (body 全体をメモリに溜めない)
+
+    * FCGI_STDIN の転送は別のスレッドで行う (受信しながら応答するバックエンドで止まらないように)
+    * FCGI_STDOUT を返す前にバックエンドとの通信に失敗した場合は 502、
+      バックエンドが FCGI_OVERLOADED などで拒否した場合は 503 を返す
+    * FCGI_STDOUT を返した後の失敗は接続を閉じる (Web サーバ側では応答が途切れる)
+'''
+class ProxyResponder(streaming.StreamingResponder):
+    appStatus = 0
+
+    def do_response(self):
+        super().do_response()
+
+        return self.appStatus
+
+    def _error_response(self, responder_class:type):
+        responder = responder_class(self.context, self.conn, self.client, self.requestId, self.params)
+        self.appStatus = responder.do_response()
+
+    def on_request(self):
+        balancer = self.context.proxy
+        backend = balancer.acquire(self.params)
+
+        timing = histogram.current()
+        if not timing is None:
+            timing.route = f'{type(self).__name__}:{backend.name}'
+
+        self.backend_ok = True
+
+        try:
+            self._forward(backend)
+
+        except (OSError, client.ClientError) as e:
+            if self._stdout_sent or self.backend_ok:
+                # Web サーバとの通信の失敗 (または応答の途中)
+                raise
+
+            log.client.warning('proxy to %s failed: %r', backend.name, e)
+            self._error_response(pyfastcgi.responders.BadGatewayResponder)
+
+        finally:
+            balancer.release(backend, self.backend_ok)
+
+    def _forward(self, backend):
+        # 接続 (checkout) の失敗はバックエンドの失敗とする
+        self.backend_ok = False
+
+        with backend.pool.call(self.params) as call:
+            self.backend_ok = True
+            client_failure = []
+            streams = set()
+
+            def send_stdin():
+                try:
+                    for data in self.each_stdin():
+                        call.write(data)
+
+                    call.close_stdin()
+
+                except Exception as e:
+                    if not call.conn.broken:
+                        # Web サーバからの受信に失敗したので、バックエンドの応答も待たない
+                        client_failure.append(e)
+                        call.abort()
+
+            sender = threading.Thread(target=send_stdin, name='pyfastcgi-proxy-stdin', daemon=True)
+            sender.start()
+
+            try:
+                records = call.records()
+
+                while True:
+                    try:
+                        recordType, data = next(records)
+
+                    except StopIteration:
+                        break
+
+                    except:
+                        if not client_failure:
+                            self.backend_ok = False
+                        raise
+
+                    if recordType == protocol.FCGI_STDOUT:
+                        self._stdout_sent = True
+
+                    streams.add(recordType)
+                    protocol.send_record(self.conn, recordType, self.requestId, contentData=data)
+
+            except:
+                call.abort()
+                raise
+
+            finally:
+                sender.join()
+
+            if client_failure:
+                raise client_failure[0]
+
+        if call.end.protocolStatus != protocol.FCGI_REQUEST_COMPLETE:
+            log.client.warning('backend %s rejected protocolStatus=%d', backend.name, call.end.protocolStatus)
+
+            if not self._stdout_sent:
+                self._error_response(pyfastcgi.responders.ServiceUnavailableResponder)
+                return
+
+        for recordType in sorted(streams):
+            # 終端
+            protocol.send_record(self.conn, recordType, self.requestId)
+
+        self.appStatus = call.end.appStatus
+
+
+# EOF
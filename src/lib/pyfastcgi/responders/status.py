@@ -0,0 +1,170 @@
+import json
+import urllib.parse
+import pyfastcgi
+import pyfastcgi.histogram as histogram
+import pyfastcgi.protocol as protocol
+import pyfastcgi.util.netstat as netstat
+
+
+FORMAT_JSON = 'json'
+FORMAT_PROMETHEUS = 'prometheus'
+
+CONTENT_TYPES = {
+    FORMAT_JSON:        'application/json; charset=utf-8',
+    FORMAT_PROMETHEUS:  'text/plain; version=0.0.4; charset=utf-8',
+}
+
+# prometheus の metric 名の接頭辞
+METRIC_PREFIX = 'pyfastcgi_'
+
+# (snapshot のキー, metric 名, 種類, 説明)
+POOL_METRICS = (
+    ('uptime',              'uptime_seconds',           'gauge',   'seconds since the pool started'),
+    ('processes',           'processes',                'gauge',   'number of worker processes'),
+    ('ready',               'processes_ready',          'gauge',   'number of worker processes accepting connections'),
+    ('active',              'active_requests',          'gauge',   'number of requests in progress'),
+    ('queued',              'queued_requests',          'gauge',   'number of accepted connections waiting for a thread'),
+    ('retired_processes',   'retired_processes_total',  'counter', 'number of worker processes exited'),
+    ('accepted',            'accepted_total',           'counter', 'number of accepted connections'),
+    ('ok',                  'responses_ok_total',       'counter', 'number of requests completed'),
+    ('ng',                  'responses_ng_total',       'counter', 'number of requests failed'),
+    ('bytes_in',            'received_bytes_total',     'counter', 'bytes received from the web server'),
+    ('bytes_out',           'sent_bytes_total',         'counter', 'bytes sent to the web server'),
+    ('cache_hit',           'cache_hits_total',         'counter', 'number of responses sent from the response cache'),
+    ('cache_stale',         'cache_stale_hits_total',   'counter', 'number of stale responses sent while revalidating'),
+    ('cache_miss',          'cache_misses_total',       'counter', 'number of cacheable requests run by the responder'),
+    ('cache_bytes',         'cache_bytes',              'gauge',   'bytes of responses in the response cache'),
+    ('coalesced',           'coalesced_total',          'counter', 'number of requests answered with a concurrent identical request\'s response'),
+    ('coalesce_fallback',   'coalesce_fallback_total',  'counter', 'number of requests that waited for an identical request and ran the responder'),
+    ('listen_queue',        'listen_queue',             'gauge',   'connections waiting in the longest accept queue'),
+    ('listen_queue_max',    'listen_queue_max',         'gauge',   'max connections seen waiting in an accept queue'),
+    ('listen_backlog',      'listen_backlog',           'gauge',   'accept queue limit'),
+    ('listen_overflows',    'listen_overflows_total',   'counter', 'number of times an accept queue overflowed (host-wide, TcpExt ListenOverflows)'),
+    ('listen_drops',        'listen_drops_total',       'counter', 'number of SYNs dropped on listening sockets (host-wide, TcpExt ListenDrops)'),
+)
+
+PROCESS_METRICS = (
+    ('state',               'process_state',                        'gauge',   'process state (0: starting, 1: ready, 2: retiring)'),
+    ('uptime',              'process_uptime_seconds',               'gauge',   'seconds since the process started'),
+    ('active',              'process_active_requests',              'gauge',   'number of requests in progress'),
+    ('queued',              'process_queued_requests',              'gauge',   'number of accepted connections waiting for a thread'),
+    ('last_request',        'process_last_request_timestamp_seconds', 'gauge', 'time of the last request accepted'),
+    ('accepted',            'process_accepted_total',               'counter', 'number of accepted connections'),
+    ('ok',                  'process_responses_ok_total',           'counter', 'number of requests completed'),
+    ('ng',                  'process_responses_ng_total',           'counter', 'number of requests failed'),
+    ('bytes_in',            'process_received_bytes_total',         'counter', 'bytes received from the web server'),
+    ('bytes_out',           'process_sent_bytes_total',             'counter', 'bytes sent to the web server'),
+    ('cache_hit',           'process_cache_hits_total',             'counter', 'number of responses sent from the response cache'),
+    ('cache_miss',          'process_cache_misses_total',           'counter', 'number of cacheable requests run by the responder'),
+    ('cache_bytes',         'process_cache_bytes',                  'gauge',   'bytes of responses in the response cache'),
+    ('coalesced',           'process_coalesced_total',              'counter', 'number of requests answered with a concurrent identical request\'s response'),
+    ('listen_queue',        'process_listen_queue',                 'gauge',   'connections waiting in the accept queue seen by the process'),
+)
+
+
+def request_path(params:dict) -> str:
+    '''
+    php-fpm の pm.status_path と同じく SCRIPT_NAME で判定する
+    (SCRIPT_NAME が無い場合は REQUEST_URI のパス部分)
+    '''
+    return params.get('SCRIPT_NAME') or params.get('REQUEST_URI', '').split('?', 1)[0]
+
+
+def is_status_request(context:pyfastcgi.Context, params:dict) -> bool:
+    return request_path(params) == context.status_path
+
+
+def _latency_lines(latency:dict) -> list:
+    '''
+    処理段階毎のヒストグラム
+
+    le は histogram のバケット境界のうち 2 のべき乗 (usec) のものだけを出力する
+    (全 route の合計 (ROUTE_ALL) は prometheus 側で集計できるので出力しない)
+    '''
+    name = f'{METRIC_PREFIX}phase_duration_seconds'
+    lines = [
+        f'# HELP {name} time spent in each request phase',
+        f'# TYPE {name} histogram',
+    ]
+
+    for route, phases in latency.items():
+        if route == histogram.ROUTE_ALL:
+            continue
+
+        for phase, (counts, usec_sum) in phases.items():
+            labels = f'route="{route}",phase="{phase}"'
+            cumulative = 0
+
+            for index, count in enumerate(counts):
+                cumulative += count
+
+                if index % histogram.SUB_BUCKETS == histogram.SUB_BUCKETS - 1:
+                    lines.append(f'{name}_bucket{{{labels},le="{histogram.bucket_upper(index) / 1000000}"}} {cumulative}')
+
+            lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels}}} {usec_sum / 1000000}')
+            lines.append(f'{name}_count{{{labels}}} {cumulative}')
+
+    return lines
+
+
+def to_prometheus(snapshot:dict, latency:dict) -> str:
+    lines = []
+
+    for key, name, mtype, mhelp in POOL_METRICS:
+        lines.append(f'# HELP {METRIC_PREFIX}{name} {mhelp}')
+        lines.append(f'# TYPE {METRIC_PREFIX}{name} {mtype}')
+        lines.append(f'{METRIC_PREFIX}{name} {snapshot["pool"][key]}')
+
+    for key, name, mtype, mhelp in PROCESS_METRICS:
+        lines.append(f'# HELP {METRIC_PREFIX}{name} {mhelp}')
+        lines.append(f'# TYPE {METRIC_PREFIX}{name} {mtype}')
+
+        for proc in snapshot['processes']:
+            lines.append(f'{METRIC_PREFIX}{name}{{pid="{proc["pid"]}",generation="{proc["generation"]}"}} {proc[key]}')
+
+    lines.extend(_latency_lines(latency))
+
+    return '\n'.join(lines) + '\n'
+
+
+'''
+StatusResponder
+
+scoreboard (共有メモリ) の内容を返すので、どの子プロセスが受け付けてもプール全体の状態になる
+'''
+class StatusResponder(pyfastcgi._BaseResponder):
+    def do_response(self):
+        query = urllib.parse.parse_qs(self.params.get('QUERY_STRING', ''))
+        fmt = query.get('format', [FORMAT_JSON])[0]
+
+        if not fmt in CONTENT_TYPES:
+            fmt = FORMAT_JSON
+
+        if not self.context.worker is None:
+            # 自プロセスの値は最新にする
+            self.context.worker.publish()
+
+        snapshot = self.context.scoreboard.snapshot()
+
+        # カーネルの累計 (取得できない環境では 0)
+        snapshot['pool'].update({ key: 0 for key in netstat.NETSTAT_KEYS.values() })
+        snapshot['pool'].update(netstat.listen_overflows())
+
+        if fmt == FORMAT_PROMETHEUS:
+            body = to_prometheus(snapshot, self.context.scoreboard.latency())
+
+        else:
+            body = json.dumps(snapshot, indent=2)
+
+        headers = {
+            pyfastcgi.CONST_STATUS: '200 OK',
+            pyfastcgi.CONST_CONTENT_TYPE: CONTENT_TYPES[fmt],
+            'Cache-Control': 'no-store',
+        }
+
+        pyfastcgi.send_record(self.conn, protocol.FCGI_STDOUT, self.requestId, contentData=pyfastcgi.Response(headers, body))
+        pyfastcgi.send_record(self.conn, protocol.FCGI_STDOUT, self.requestId)
+
+
+# EOF
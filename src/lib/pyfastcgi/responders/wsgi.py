@@ -0,0 +1,346 @@
+import io
+import os
+import stat
+import urllib.parse
+import pyfastcgi
+import pyfastcgi.histogram as histogram
+import pyfastcgi.protocol as protocol
+import pyfastcgi.responders.streaming as streaming
+
+
+'''
+WSGI (PEP 3333) のアプリケーションを実行する responder
+
+    # app.py
+    import pyfastcgi.responders.wsgi as wsgi
+    from myservice import application
+
+    def event_handler(context, event):
+        ...
+
+    Responder = wsgi.make_factory(application)
+
+    python prefork.py --app-path=app.py --threads=8
+
+environ
+
+    * FCGI_PARAMS を復号した dict をそのまま environ とし、wsgi.* などを追加する (コピーしない)
+    * PATH_INFO が無い (空の) 場合は REQUEST_URI のパスを PATH_INFO、SCRIPT_NAME を空にする
+      (nginx の fastcgi_params は PATH_INFO を設定しないため)
+    * PEP 3333 に合わせ、ASCII 以外を含む値は latin-1 の文字列に変換する
+      (FCGI_PARAMS は UTF-8 として復号されているので、元のバイト列に戻す)
+
+wsgi.input       FCGI_STDIN を逐次に読み込む (全体をメモリに溜めない)
+wsgi.errors      FCGI_STDERR に送信する (Web サーバのエラーログに出力される)
+wsgi.file_wrapper
+                 通常ファイルであれば sendfile で送信する (protocol.send_file)
+
+応答
+
+    * ヘッダは最初の空でないデータ (または終了) まで送信しない
+    * Content-Length が無い場合は、長さが分かるもの (要素が一つ、または file_wrapper) には
+      付加し、それ以外はそのまま送信する (chunked にするかは Web サーバに任せる)
+    * 返されたデータはまとめずに、そのままレコードとして送信する
+'''
+
+# file_wrapper の既定の読み込みサイズ (sendfile が使えない場合)
+FILE_BLOCK_SIZE = 65536
+
+
+class FileWrapper:
+    '''
+    wsgi.file_wrapper
+    '''
+    def __init__(self, filelike, blksize:int=FILE_BLOCK_SIZE):
+        self.filelike = filelike
+        self.blksize = blksize
+
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        while True:
+            data = self.filelike.read(self.blksize)
+            if not data:
+                break
+
+            yield data
+
+    def regular_file(self) -> tuple:
+        '''
+        sendfile できる場合は (開始位置, 長さ) を返す
+        '''
+        try:
+            fileno = self.filelike.fileno()
+            st = os.fstat(fileno)
+
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+
+        if not stat.S_ISREG(st.st_mode) or 'b' not in getattr(self.filelike, 'mode', 'b'):
+            return None
+
+        offset = self.filelike.tell()
+
+        return offset, max(st.st_size - offset, 0)
+
+
+class _InputStream:
+    '''
+    wsgi.input (FCGI_STDIN を必要な分だけ受信する)
+    '''
+    def __init__(self, records):
+        self.records = records
+        self.buff = bytearray()
+        self.eof = False
+
+    def _fill(self, nbytes:int) -> bool:
+        while not self.eof and (nbytes < 0 or len(self.buff) < nbytes):
+            data = next(self.records, None)
+
+            if data is None:
+                self.eof = True
+                break
+
+            self.buff += data
+
+        return bool(self.buff)
+
+    def _take(self, nbytes:int) -> bytes:
+        data = bytes(self.buff[:nbytes])
+        del self.buff[:nbytes]
+
+        return data
+
+    def read(self, size:int=-1) -> bytes:
+        if size is None or size < 0:
+            self._fill(-1)
+            return self._take(len(self.buff))
+
+        self._fill(size)
+
+        return self._take(size)
+
+    def readline(self, size:int=-1) -> bytes:
+        limit = size if not size is None and size >= 0 else None
+
+        while self.buff.find(b'\n') < 0 and not self.eof and (limit is None or len(self.buff) < limit):
+            self._fill(len(self.buff) + 1)
+
+        pos = self.buff.find(b'\n')
+        end = pos + 1 if pos >= 0 else len(self.buff)
+
+        if not limit is None:
+            end = min(end, limit)
+
+        return self._take(end)
+
+    def readlines(self, hint:int=-1) -> list:
+        lines = []
+        total = 0
+
+        for line in self:
+            lines.append(line)
+            total += len(line)
+
+            if 0 < hint <= total:
+                break
+
+        return lines
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                break
+
+            yield line
+
+
+class _ErrorStream:
+    '''
+    wsgi.errors (FCGI_STDERR)
+    '''
+    def __init__(self, conn, requestId:int):
+        self.conn = conn
+        self.requestId = requestId
+        self.sent = False
+
+    def write(self, s:str):
+        if not s:
+            return
+
+        pyfastcgi.send_record(self.conn, protocol.FCGI_STDERR, self.requestId, contentData=s.encode('utf-8', 'replace'))
+        self.sent = True
+
+    def writelines(self, seq):
+        for s in seq:
+            self.write(s)
+
+    def flush(self):
+        ...
+
+    def close(self):
+        if self.sent:
+            pyfastcgi.send_record(self.conn, protocol.FCGI_STDERR, self.requestId)
+
+
+def _native(value:str) -> str:
+    # UTF-8 として復号された文字列を、元のバイト列の latin-1 の文字列にする
+    return value.encode('utf-8').decode('latin-1')
+
+
+class WSGIResponder(streaming.StreamingResponder):
+    application = None
+
+    _status = None
+    _headers = None
+    _headers_sent = False
+    _has_length = False
+
+    def make_environ(self) -> dict:
+        environ = self.params
+
+        for key, value in environ.items():
+            if not value.isascii():
+                environ[key] = _native(value)
+
+        if not environ.get('PATH_INFO'):
+            path = environ.get('REQUEST_URI', '').split('?', 1)[0] or environ.get('SCRIPT_NAME', '/')
+
+            environ['SCRIPT_NAME'] = ''
+            environ['PATH_INFO'] = urllib.parse.unquote_to_bytes(path).decode('latin-1')
+
+        environ.setdefault('QUERY_STRING', '')
+        environ.setdefault('SERVER_NAME', 'localhost')
+        environ.setdefault('SERVER_PORT', '80')
+        environ.setdefault('SERVER_PROTOCOL', 'HTTP/1.1')
+
+        https = environ.get('HTTPS', '').lower() in ('on', '1')
+        procs = self.context.extra.get('procs', 1)
+
+        environ.update({
+            'wsgi.version':         (1, 0),
+            'wsgi.url_scheme':      environ.get('REQUEST_SCHEME') or ('https' if https else 'http'),
+            'wsgi.input':           _InputStream(iter(self.each_stdin())),
+            'wsgi.errors':          self.errors,
+            'wsgi.multithread':     self.context.threads > 1,
+            'wsgi.multiprocess':    procs > 1,
+            'wsgi.run_once':        False,
+            'wsgi.file_wrapper':    FileWrapper,
+        })
+
+        return environ
+
+    def start_response(self, status:str, headers:list, exc_info=None):
+        if not exc_info is None:
+            try:
+                if self._headers_sent:
+                    raise exc_info[1].with_traceback(exc_info[2])
+
+            finally:
+                exc_info = None
+
+        elif not self._status is None:
+            raise AssertionError('start_response() was called twice without exc_info')
+
+        self._status = status
+        self._headers = headers
+        self._has_length = any(( name.lower() == 'content-length' for name, _ in headers ))
+
+        return self.write
+
+    def _dump_headers(self, content_length:int=None) -> bytes:
+        if self._status is None:
+            raise AssertionError('start_response() was not called')
+
+        lines = [ f'Status: {self._status}' ]
+        lines.extend(( f'{name}: {value}' for name, value in self._headers ))
+
+        if not self._has_length and not content_length is None:
+            lines.append(f'Content-Length: {content_length}')
+
+        timing = histogram.current()
+        if not timing is None:
+            timing.status = int(self._status.split(' ', 1)[0])
+
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    def _send_headers(self, data:bytes=b'', content_length:int=None):
+        '''
+        ヘッダと最初のデータを一つのレコードで送信する
+        '''
+        self._headers_sent = True
+        self._stdout_sent = True
+
+        pyfastcgi.send_record(self.conn, protocol.FCGI_STDOUT, self.requestId, contentData=self._dump_headers(content_length) + data)
+
+    def write(self, data:bytes):
+        if not data:
+            return
+
+        if not self._headers_sent:
+            self._send_headers(bytes(data))
+            return
+
+        pyfastcgi.send_record(self.conn, protocol.FCGI_STDOUT, self.requestId, contentData=bytes(data))
+
+    def _send_file(self, wrapper:FileWrapper) -> bool:
+        fileinfo = wrapper.regular_file()
+        if fileinfo is None:
+            return False
+
+        offset, count = fileinfo
+
+        if not self._headers_sent:
+            self._send_headers(content_length=count)
+
+        if count:
+            protocol.send_file(self.conn, protocol.FCGI_STDOUT, self.requestId, wrapper.filelike, offset, count)
+
+        return True
+
+    def on_request(self):
+        self.errors = _ErrorStream(self.conn, self.requestId)
+
+        result = self.application(self.make_environ(), self.start_response)
+
+        try:
+            if isinstance(result, FileWrapper) and self._send_file(result):
+                pass
+
+            else:
+                if not self._headers_sent and isinstance(result, (list, tuple)) and len(result) == 1:
+                    # 長さが分かるので Content-Length を付ける
+                    data = bytes(result[0])
+                    self._send_headers(data, len(data))
+
+                else:
+                    for data in result:
+                        self.write(data)
+
+            if not self._headers_sent:
+                self._send_headers(content_length=0)
+
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+        pyfastcgi.send_record(self.conn, protocol.FCGI_STDOUT, self.requestId)
+        self.errors.close()
+
+
+def make_factory(application:callable) -> callable:
+    '''
+    --app-path の Responder に設定する responder_factory を返す
+    '''
+    def factory(context:pyfastcgi.Context, conn, client:tuple, requestId:int, params:dict):
+        responder = WSGIResponder(context, conn, client, requestId, params)
+        responder.application = application
+
+        return responder
+
+    return factory
+
+
+# EOF
@@ -0,0 +1,108 @@
+import os
+import math
+
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# これ以上の値は制限なしとみなす (cgroup v1 の memory.limit_in_bytes の既定値は巨大な値)
+UNLIMITED_MEMORY = 1 << 60
+
+
+def _read(path:str) -> str:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+
+    except OSError:
+        return None
+
+
+def _controller_dirs(controller:str) -> list:
+    '''
+    /proc/self/cgroup から自プロセスの cgroup のディレクトリ候補を返す
+
+        cgroup v2 ... "0::/path"
+        cgroup v1 ... "4:memory:/path"
+
+    (コンテナ内では名前空間によりルートが自分の cgroup になっていることもあるので、ルートも候補とする)
+    '''
+    dirs = []
+    a = _read('/proc/self/cgroup') or ''
+
+    for line in a.splitlines():
+        hid, controllers, path = line.split(':', 2)
+
+        if hid == '0' and controllers == '':
+            dirs.append(CGROUP_ROOT + path)
+
+        elif controller in controllers.split(','):
+            dirs.append(os.path.join(CGROUP_ROOT, controllers) + path)
+            dirs.append(os.path.join(CGROUP_ROOT, controllers))
+
+    dirs.append(CGROUP_ROOT)
+
+    return dirs
+
+
+def cpu_limit() -> float:
+    for d in _controller_dirs('cpu'):
+        # cgroup v2
+        a = _read(os.path.join(d, 'cpu.max'))
+        if not a is None:
+            quota, period = a.split()
+            if quota == 'max':
+                return None
+
+            return int(quota) / int(period)
+
+        # cgroup v1
+        quota = _read(os.path.join(d, 'cpu.cfs_quota_us'))
+        period = _read(os.path.join(d, 'cpu.cfs_period_us'))
+        if not quota is None and not period is None:
+            if int(quota) < 0:
+                return None
+
+            return int(quota) / int(period)
+
+    return None
+
+
+def memory_limit() -> int:
+    for d in _controller_dirs('memory'):
+        # cgroup v2, v1
+        a = _read(os.path.join(d, 'memory.max')) or _read(os.path.join(d, 'memory.limit_in_bytes'))
+        if not a is None:
+            if a == 'max' or int(a) >= UNLIMITED_MEMORY:
+                return None
+
+            return int(a)
+
+    return None
+
+
+def available_cpus() -> float:
+    if hasattr(os, 'sched_getaffinity'):
+        ncpu = len(os.sched_getaffinity(0))
+
+    else:
+        ncpu = os.cpu_count() or 1
+
+    quota = cpu_limit()
+
+    return ncpu if quota is None else min(ncpu, quota)
+
+
+def default_procs(worker_memory:int) -> int:
+    '''
+    CPU 数 (cgroup の quota を考慮) を基本とし、メモリの制限があればその範囲に収まる数にする
+    '''
+    nprocs = max(1, math.ceil(available_cpus()))
+
+    mem = memory_limit()
+    if mem:
+        nprocs = max(1, min(nprocs, mem // worker_memory))
+
+    return nprocs
+
+
+# EOF
@@ -1,192 +1,661 @@
 import os
-import sys
 import argparse
 import atexit
 import functools
+import math
 import platform
+import random
+import resource
 import time
+import selectors
 import signal
-import socket
 import importlib.util
 import collections
+import dataclasses
+import multiprocessing
 import pyfastcgi
+import pyfastcgi.listener
+import pyfastcgi.log as log
+import pyfastcgi.util.cgroup as cgroup
+import pyfastcgi.util.scoreboard as scoreboard
+import pyfastcgi.util.shmcache as shmcache
+from dataclasses import dataclass
+
+
+PM_STATIC   = 'static'
+PM_DYNAMIC  = 'dynamic'
+PM_ONDEMAND = 'ondemand'
+
+# dynamic, ondemand の場合に子プロセスの状態を確認する間隔
+PM_MAINTENANCE_INTERVAL = 1.0
+
+RESPAWN_BACKOFF_MIN = 0.1
+RESPAWN_BACKOFF_MAX = 30.0
+
+# 起動からこの秒数以内に終了した子プロセスは異常終了 (crash) とみなす
+CRASH_UPTIME = 2.0
 
 
 def unlink_pid_file(pid_path):
     if os.path.exists(pid_path):
-        print(f'unlink {pid_path=}', file=sys.stderr)
+        log.prefork.info(f'unlink {pid_path=}')
         os.unlink(pid_path)
 
 
 def signal_hanlder(context:pyfastcgi.Context, signum, frame):
-    print(f'{os.getpid()=} catch signal {signum=}, set loop=OFF', file=sys.stderr)
+    log.prefork.info(f'{os.getpid()=} catch signal {signum=}, set loop=OFF')
 
     context.loop = False
     signal.signal(signum, signal.SIG_DFL)
 
 
-def gen_subprocess(context:pyfastcgi.Context):
-    reg_unlink = False
-    childs = set()
-    procs = context.extra['procs']
+def _wakeup_signal(signum, frame):
+    '''
+    何もしない (signal.set_wakeup_fd() で登録したパイプへの書き込みを発生させるため)
+    '''
+    ...
 
-    while context.loop:
-        nfork = procs - len(childs)
+
+def _reload_signal(supervisor, signum, frame):
+    log.prefork.info(f'{os.getpid()=} catch signal {signum=}, reload sub-processes')
+
+    supervisor.reload = True
+
+
+def notify_master():
+    '''
+    子プロセスの状態 (scoreboard) が変わったことを親プロセスに通知する
+    '''
+    os.kill(os.getppid(), signal.SIGUSR1)
+
+
+def _no_event_handler(context:pyfastcgi.Context, event:pyfastcgi.Event):
+    ...
+
+
+def load_app(app_path:str, event_handler:str, responder_factory:str) -> tuple:
+    if app_path is None:
+        # --proxy-backends のみ (アプリケーションを読み込まない)
+        return _no_event_handler, None
+
+    # https://www.delftstack.com/ja/howto/python/import-python-file-from-path/
+
+    app_name = os.path.splitext(os.path.basename(app_path))[0]
+    spec = importlib.util.spec_from_file_location(app_name, app_path)
+    app_mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app_mod)
+
+    return getattr(app_mod, event_handler), getattr(app_mod, responder_factory)
+
+
+def current_rss() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+
+    except OSError:
+        # Linux 以外 (ru_maxrss は最大値で、単位は Darwin が byte, その他は KB)
+        a = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return a if platform.system() == 'Darwin' else a * 1024
+
+
+@dataclass
+class Recycle:
+    '''
+    子プロセスを入れ替える条件
+
+    全ての子プロセスが同時に入れ替わらないよう、それぞれの上限値に子プロセス毎の
+    ランダムな値 (--recycle-jitter の割合まで) を加える
+    '''
+    max_request:int
+    max_age:float
+    max_rss_growth:int
+    started:float = dataclasses.field(init=False, default_factory=time.monotonic)
+    base_rss:int = dataclasses.field(init=False, default_factory=current_rss)
+    checked:float = dataclasses.field(init=False, default=0.0)
+
+    @classmethod
+    def make(cls, extra:dict):
+        # fork 後の子プロセスでは random の状態は初期化されている (os.register_at_fork)
+        jitter = lambda v: type(v)(v * (1 + random.uniform(0, extra['recycle_jitter'])))
+
+        return cls(jitter(extra['max_request']), jitter(extra['max_age']), jitter(extra['max_rss_growth']))
+
+    def exceeded(self, accepted:int) -> str:
+        if self.max_request and accepted >= self.max_request:
+            return f'max-request {accepted=}'
+
+        now = time.monotonic()
+        if now - self.checked < 1.0:
+            # 経過時間とメモリの確認は 1 秒に 1 回まで
+            return None
+
+        self.checked = now
+
+        if self.max_age and now - self.started >= self.max_age:
+            return f'max-age {now - self.started:.0f} sec'
+
+        if self.max_rss_growth:
+            growth = current_rss() - self.base_rss
+
+            if growth >= self.max_rss_growth:
+                return f'max-rss-growth {growth} bytes'
+
+        return None
+
+
+def init_subprocess(context:pyfastcgi.Context, slot_index:int, linfo:dict, generation:int):
+    slot = context.scoreboard.slots[slot_index]
+    slot.pid = os.getpid()
+    slot.generation = generation
+    slot.last_active = time.time()
+
+    context.worker = scoreboard.Worker(slot)
+
+    if generation > 0:
+        '''
+        reload (SIGHUP) 後の世代は --app-path を読み込み直す
+        (親プロセスは起動時に読み込んだままなので fork しただけでは古いコードのまま)
+        '''
+        orig_handler, responder_factory = load_app(context.extra['app_path'], context.extra['event_handler'], context.extra['responder_factory'])
+
+        context._handler = functools.partial(event_handler_hook, orig_handler)
+        context.responder_factory = responder_factory
+
+    if pyfastcgi.listener.use_reuseport(context):
+        '''
+        プロセス毎に SO_REUSEPORT のソケットを bind し、接続の振り分けをカーネルに任せる
+        '''
+        linfo['ssock'].close()
+        linfo['ssock'] = pyfastcgi.listener.make_server_socket(context)
+
+    slot.state = scoreboard.STATE_READY
+    notify_master()
+
+    # app の読み込み後のメモリ使用量を基準にする
+    context.worker.recycle = Recycle.make(context.extra)
+
+
+def check_recycle(context:pyfastcgi.Context):
+    worker = context.worker
+
+    if worker is None or worker.slot.state != scoreboard.STATE_READY:
+        return
+
+    reason = worker.recycle.exceeded(worker.slot.accepted)
+
+    if reason:
+        '''
+        すぐには終了せず、親プロセスが代わりの子プロセスを起動してから SIGTERM で終了させる
+        (それまでは accept を続けるので処理能力が落ちない)
+        '''
+        request_retire(context, reason)
+
+
+def request_retire(context:pyfastcgi.Context, reason:str):
+    log.prefork.info(f'request recycle by {reason}')
+
+    context.worker.slot.state = scoreboard.STATE_RETIRING
+    notify_master()
+
+
+@dataclass
+class Child:
+    pid:int
+    slot_index:int
+    generation:int
+    started:float = dataclasses.field(init=False, default_factory=time.monotonic)
+    retiring:bool = dataclasses.field(init=False, default=False)
+    terminated:float = dataclasses.field(init=False, default=None)
+    killed:bool = dataclasses.field(init=False, default=False)
+
+@dataclass
+class Supervisor:
+    context:pyfastcgi.Context
+    linfo:dict
+    childs:dict = dataclasses.field(init=False, default_factory=dict)
+    selector:any = dataclasses.field(init=False, default=None)
+    wakeup_fds:tuple = dataclasses.field(init=False, default=None)
+    crashes:int = dataclasses.field(init=False, default=0)
+    respawn_at:float = dataclasses.field(init=False, default=0.0)
+    generation:int = dataclasses.field(init=False, default=0)
+    reload:bool = dataclasses.field(init=False, default=False)
+    target:int = dataclasses.field(init=False, default=0)
+    listening:bool = dataclasses.field(init=False, default=False)
+    demand:bool = dataclasses.field(init=False, default=False)
+
+    def open(self):
+        '''
+        self-pipe
+
+        SIGCHLD (や SIGTERM) を受信するとパイプに書き込まれるので、select() で待機していれば
+        子プロセスの終了を即座に検知できる
+        '''
+        rfd, wfd = os.pipe()
+        os.set_blocking(rfd, False)
+        os.set_blocking(wfd, False)
+
+        self.wakeup_fds = (rfd, wfd)
+        signal.set_wakeup_fd(wfd)
+        signal.signal(signal.SIGCHLD, _wakeup_signal)
+        signal.signal(signal.SIGUSR1, _wakeup_signal)
+        signal.signal(signal.SIGHUP, functools.partial(_reload_signal, self))
+
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(rfd, selectors.EVENT_READ, 'wakeup')
+
+        self.target = self.context.extra['pm_start_servers']
+
+    def close(self):
+        signal.set_wakeup_fd(-1)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
+
+        # reload は親プロセスが行うので、子プロセスでは無視する
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+        self.selector.close()
+
+        for fd in self.wakeup_fds:
+            os.close(fd)
+
+    def spawn(self) -> bool:
+        '''
+        不足している子プロセスを生成する (子プロセスとして戻る場合は True)
+        '''
+        if time.monotonic() < self.respawn_at:
+            # crash-loop による待機中
+            return False
+
+        nfork = self.target - len(self.active_childs())
 
         for _ in range(nfork):
+            try:
+                slot_index = self.context.scoreboard.alloc()
+
+            except OverflowError:
+                log.prefork.warning('no more worker-slot, postpone to create new-process')
+                break
+
             pid = os.fork()
 
             if pid == 0:
                 # is child
-                return
+                '''
+                pid-file と unix-domain-socket の削除 (atexit) は親プロセスのもの
+                (子プロセスが例外で終了しても、稼働中の親プロセスのファイルを消さない)
+                '''
+                atexit.unregister(unlink_pid_file)
+                atexit.unregister(pyfastcgi.listener.unlink_bind_file)
+
+                self.close()
+
+                try:
+                    init_subprocess(self.context, slot_index, self.linfo, self.generation)
+
+                except BaseException:
+                    # reload で読み込んだ app が壊れている場合など (親プロセスが crash-loop として扱う)
+                    log.prefork.error('failed to initialize subprocess', exc_info=True)
+                    log.flush()
+                    os._exit(1)
+
+                return True
 
             # is parent
-            print(f'create new-process {pid=}', file=sys.stderr)
-            childs.add(pid)
+            log.prefork.info(f'create new-process {pid=} {slot_index=} generation={self.generation}')
+            self.context.scoreboard.slots[slot_index].pid = pid
+            self.childs[pid] = Child(pid, slot_index, self.generation)
+
+        return False
+
+    def active_childs(self) -> list:
+        return [ child for child in self.childs.values() if child.generation == self.generation and not child.retiring and child.terminated is None ]
+
+    def old_childs(self) -> list:
+        '''
+        reload 前の世代、または入れ替えを要求している子プロセス
+        '''
+        return [ child for child in self.childs.values() if (child.generation != self.generation or child.retiring) and child.terminated is None ]
+
+    def accept_retiring(self):
+        '''
+        入れ替えを要求している子プロセスを old_childs() に移す
+        --> spawn() で代わりが起動され、揃ったら retire_old() で終了させる
+        '''
+        for child in self.active_childs():
+            if self.context.scoreboard.slots[child.slot_index].state == scoreboard.STATE_RETIRING:
+                log.prefork.info(f'accept recycle request {child.pid=}')
+                child.retiring = True
+
+    def terminate(self, child:Child, reason:str):
+        log.prefork.info(f'{reason} {child.pid=} generation={child.generation}')
+
+        child.terminated = time.monotonic()
+        os.kill(child.pid, signal.SIGTERM)
+
+    def start_reload(self):
+        self.reload = False
+        self.generation += 1
+
+        log.prefork.info(f'* start reload, new generation={self.generation}')
+
+    def retire_old(self):
+        '''
+        新しい世代 (または代わり) の子プロセスが揃って accept を始めたら、古い世代に SIGTERM を送る
+        --> 古い世代は accept をやめ、処理中のリクエストを終えてから終了する (drain)
+        '''
+        active = self.active_childs()
+        ready = len(active) >= self.target and all((
+            self.context.scoreboard.slots[child.slot_index].state == scoreboard.STATE_READY for child in active
+        ))
+
+        if ready:
+            for child in self.old_childs():
+                self.terminate(child, 'drain old')
+
+        now = time.monotonic()
+        graceful_timeout = self.context.extra['graceful_timeout']
+
+        for child in self.childs.values():
+            if not child.terminated is None and not child.killed and now - child.terminated >= graceful_timeout:
+                log.prefork.warning(f'force kill {child.pid=}')
+                child.killed = True
+                os.kill(child.pid, signal.SIGKILL)
+
+    def spare(self) -> float:
+        '''
+        空いているスレッド数から処理待ちの数を引き、子プロセス数に換算した値
+        (起動中の子プロセスは空いているとみなす。処理待ちがあれば負の値になる)
+        '''
+        threads = self.context.threads
+        free = 0
+
+        for child in self.active_childs():
+            slot = self.context.scoreboard.slots[child.slot_index]
+            free += max(threads - slot.active, 0) - slot.queued
+
+        return free / threads
+
+    def idle_childs(self) -> list:
+        '''
+        処理中のリクエストが無い子プロセス (待機時間の長い順)
+        '''
+        a = []
+
+        for child in self.active_childs():
+            slot = self.context.scoreboard.slots[child.slot_index]
+
+            if slot.state == scoreboard.STATE_READY and slot.active == 0:
+                a.append((slot.last_active, child))
+
+        return [ child for _, child in sorted(a, key=lambda v: v[0]) ]
+
+    def maintain(self):
+        '''
+        php-fpm の pm (process manager) に倣い、子プロセスの状態により数を調整する
+
+            static   ... 常に --procs 個
+            dynamic  ... 空きを --pm-min-spare 以上 --pm-max-spare 以下に保つ
+            ondemand ... 接続が来たら生成し、--pm-idle-timeout 秒処理が無ければ終了させる
+        '''
+        extra = self.context.extra
+        pm = extra['pm']
+
+        if pm == PM_STATIC or self.old_childs():
+            # reload (入れ替え) 中は調整しない
+            return
+
+        active = self.active_childs()
+        spare = self.spare()
+
+        if pm == PM_DYNAMIC:
+            if spare < extra['pm_min_spare']:
+                self.target = min(len(active) + math.ceil(extra['pm_min_spare'] - spare), extra['procs'])
+
+            elif spare > extra['pm_max_spare']:
+                # php-fpm と同じく一度に一つずつ減らす
+                idle = self.idle_childs()
+                if idle:
+                    self.terminate(idle[0], 'reap idle')
+                    self.target = len(self.active_childs())
+
+        elif pm == PM_ONDEMAND:
+            now = time.time()
+            keep = extra['pm_start_servers']
+
+            for child in self.idle_childs():
+                if len(self.active_childs()) <= keep:
+                    break
+
+                slot = self.context.scoreboard.slots[child.slot_index]
+                if now - slot.last_active >= extra['pm_idle_timeout']:
+                    self.terminate(child, 'reap idle')
+
+            self.target = len(self.active_childs())
+
+            if (self.demand or spare < 0) and spare < 1:
+                self.target = min(self.target + 1, extra['procs'])
+
+            self.demand = False
+
+            '''
+            空きが無い場合のみ待ち受けソケットを監視し、接続が来たら子プロセスを追加する
+            (空きがある場合は子プロセスが accept するので監視しない)
+            '''
+            listen = spare < 1 and len(active) < extra['procs'] and not pyfastcgi.listener.use_reuseport(self.context)
+
+            if listen != self.listening:
+                self.listening = listen
+
+                if listen:
+                    self.selector.register(self.linfo['ssock'], selectors.EVENT_READ, 'listen')
 
-        else:
-            # parent
-            if not reg_unlink:
-                # regist once
-                reg_unlink = True
+                else:
+                    self.selector.unregister(self.linfo['ssock'])
 
-                if context.pid_path:
-                    atexit.register(unlink_pid_file, context.pid_path)
+    def next_timeout(self) -> float:
+        now = time.monotonic()
+        timeout = None
 
-            while context.loop:
-                # check alive
+        if len(self.active_childs()) < self.target:
+            timeout = max(self.respawn_at - now, 0)
+
+        graceful_timeout = self.context.extra['graceful_timeout']
+
+        for child in self.childs.values():
+            if not child.terminated is None and not child.killed:
+                a = max(child.terminated + graceful_timeout - now, 0)
+                timeout = a if timeout is None else min(timeout, a)
+
+        if self.context.extra['pm'] != PM_STATIC:
+            timeout = PM_MAINTENANCE_INTERVAL if timeout is None else min(timeout, PM_MAINTENANCE_INTERVAL)
+
+        return timeout
+
+    def reap(self):
+        while True:
+            try:
                 exit_pid, exit_rc = os.waitpid(-1, os.WNOHANG)
 
-                if exit_pid:
-                    print(f'sub-process dead {exit_pid=} {exit_rc // 256}', file=sys.stderr)
-                    childs.remove(exit_pid)
-                    # return big-loop and create sub-process
-                    break
+            except ChildProcessError:
+                break
+
+            if not exit_pid:
+                break
+
+            child = self.childs.pop(exit_pid, None)
+            if child is None:
+                continue
+
+            log.prefork.info(f'sub-process dead {exit_pid=} {exit_rc // 256}')
+            log.prefork.info(self.context.scoreboard.report())
+
+            self.context.scoreboard.free(child.slot_index)
+
+            if isinstance(self.context.cache, shmcache.SharedResponseCache):
+                # 共有の応答のキャッシュのロックを持ったまま終了していれば解放する
+                self.context.cache.recover(self.context, exit_pid)
+
+            now = time.monotonic()
+            uptime = now - child.started
+
+            if child.generation != self.generation or not child.terminated is None:
+                # reload や pm により終了させたもの
+                continue
+
+            if self.context.loop and uptime < CRASH_UPTIME:
+                '''
+                起動直後の終了が続く場合は、再生成までの待ち時間を倍々に増やす
+                '''
+                self.crashes += 1
 
-                #print('wait...')
-                time.sleep(1)
+                backoff = min(RESPAWN_BACKOFF_MIN * 2 ** (self.crashes - 1), RESPAWN_BACKOFF_MAX)
+                self.respawn_at = now + backoff
+
+                log.prefork.warning(f'crash-loop detected {self.crashes=}, respawn after {backoff} sec')
 
             else:
-                do_finalize(context, childs)
+                self.crashes = 0
 
-    # end while (bit-loop)
+    def wait(self, timeout:float):
+        for key, _ in self.selector.select(timeout):
+            if key.data == 'listen':
+                # 空きが無い状態で接続が来た (ondemand)
+                self.demand = True
+                continue
 
-    print('all done.', file=sys.stderr)
-    exit(0)
+            try:
+                while os.read(key.fd, 4096):
+                    pass
 
+            except BlockingIOError:
+                pass
 
-def do_finalize(context:pyfastcgi.Context, childs:set):
-    print('* detected terminate, start finalize', file=sys.stderr)
-    SLEEP_SEC = context.so_timeout / 2
+    def wait_exit(self, timeout:float) -> bool:
+        '''
+        全ての子プロセスが終了するか {timeout} 秒経過するまで待つ
+        '''
+        deadline = time.monotonic() + timeout
 
-    # first SIGTERM
-    print('* send SIGTERM to sub-processes', file=sys.stderr)
-    send_signal(signal.SIGTERM, childs)
+        while True:
+            self.reap()
 
-    print(f'wait {SLEEP_SEC} sec for receive signal...', file=sys.stderr)
-    time.sleep(SLEEP_SEC)
-    print(f'wake up', file=sys.stderr)
+            remaining = deadline - time.monotonic()
+            if not self.childs or remaining <= 0:
+                break
 
-    update_childs(childs, SLEEP_SEC)
+            self.wait(remaining)
 
-    if childs:
-        if not context.nonblocking:
-            print('* send NULL to sub-processes', file=sys.stderr)
+        return not self.childs
 
-            send_last_packet(context.bind_addr, len(childs))
+    def send_signal(self, signum:int):
+        for child_pid in self.childs:
+            log.prefork.info(f'send {signum=} to {child_pid=}')
+            os.kill(child_pid, signum)
 
-            print(f'wait {SLEEP_SEC} sec for terminate process...', file=sys.stderr)
-            time.sleep(SLEEP_SEC)
-            print(f'wake up', file=sys.stderr)
 
-            update_childs(childs, SLEEP_SEC)
+def gen_subprocess(context:pyfastcgi.Context, linfo:dict):
+    report_interval = context.extra['report_interval']
+    reported = time.monotonic()
 
-        if childs:
-            print('* force kill sub-processes', file=sys.stderr)
+    supervisor = Supervisor(context, linfo)
+    supervisor.open()
+
+    if context.pid_path:
+        atexit.register(unlink_pid_file, context.pid_path)
+
+    while context.loop:
+        if supervisor.reload:
+            supervisor.start_reload()
 
-            # second SIGKILL
-            send_signal(signal.SIGKILL, childs)
+        supervisor.accept_retiring()
+        supervisor.maintain()
 
-            print(f'wait {SLEEP_SEC} sec for receive signal...', file=sys.stderr)
-            time.sleep(SLEEP_SEC)
-            print(f'wake up', file=sys.stderr)
+        if supervisor.spawn():
+            # is child
+            return
 
-            update_childs(childs, SLEEP_SEC)
+        supervisor.retire_old()
 
-    else:
-        print('* detect all sub-processes exited', file=sys.stderr)
+        now = time.monotonic()
+        timeout = supervisor.next_timeout()
 
-    print('* end finalize', file=sys.stderr)
+        if report_interval:
+            a = max(reported + report_interval - now, 0)
+            timeout = a if timeout is None else min(timeout, a)
 
+        # シグナル (SIGCHLD, SIGTERM ...) を受信するか timeout まで待機
+        supervisor.wait(timeout)
+        supervisor.reap()
 
-def send_last_packet(bind_addr, nchilds:int):
-    if type(bind_addr) == str:
-        family = socket.AF_UNIX
-        conn_addr = bind_addr
+        if report_interval and time.monotonic() - reported >= report_interval:
+            reported = time.monotonic()
+            log.prefork.info(context.scoreboard.report())
 
-    else:
-        family = socket.AF_INET
-        conn_addr = (socket.gethostname(), bind_addr[1])
+    # end while (bit-loop)
 
-    for i in range(nchilds):
-        print(f'send null packet {i+1}/{nchilds}', file=sys.stderr)
+    do_finalize(supervisor)
+    supervisor.close()
 
-        conn = socket.socket(family, socket.SOCK_STREAM)
-        conn.connect(conn_addr)
-        conn.sendall(b'\x00')
-        conn.close()
+    log.prefork.info('all done.')
+    exit(0)
 
 
-def send_signal(signum:int, childs:set):
-    for child_pid in childs:
-        print(f'send {signum=} to {child_pid=}', file=sys.stderr)
-        os.kill(child_pid, signum)
+def do_finalize(supervisor:Supervisor):
+    context = supervisor.context
 
+    log.prefork.info('* detected terminate, start finalize')
+    log.prefork.info(context.scoreboard.report())
 
-def update_childs(childs:set, sleep_sec:float):
-    RETRY = 5
-    print(f'check alive {RETRY} times', file=sys.stderr)
+    # first SIGTERM
+    log.prefork.info('* send SIGTERM to sub-processes')
+    supervisor.send_signal(signal.SIGTERM)
 
-    for i in range(RETRY):
-        time.sleep(sleep_sec)
+    '''
+    子プロセスは so_timeout 以内に accept の待機から戻り、処理中のリクエストを終えて終了する
+    --> 終了すれば (SIGCHLD により) 即座に戻る
+    '''
+    graceful_timeout = context.extra['graceful_timeout']
+    log.prefork.info(f'wait {graceful_timeout} sec for terminate process...')
 
-        print(f'check sub-process is alive {i+1}/{RETRY}', file=sys.stderr)
+    if not supervisor.wait_exit(graceful_timeout):
+        log.prefork.warning('* force kill sub-processes')
 
-        nchilds = len(childs)
-        if not childs:
-            print('no more sub-process', file=sys.stderr)
-            break
+        # second SIGKILL
+        supervisor.send_signal(signal.SIGKILL)
+        supervisor.wait_exit(context.so_timeout)
 
-        for j in range(nchilds):
-            print(f'check sub-process {j+1}/{nchilds}', file=sys.stderr)
-            exit_pid, exit_rc = os.waitpid(-1, os.WNOHANG)
+    if not supervisor.childs:
+        log.prefork.info('* detect all sub-processes exited')
 
-            if exit_pid:
-                childs.remove(exit_pid)
-                print(f'detected terminate of {exit_pid=} {exit_rc=}', file=sys.stderr)
-    else:
-        print(f'give up !!', file=sys.stderr)
+    log.prefork.info('* end finalize')
 
 
 def event_handler_hook(orig_handler:callable, context:pyfastcgi.Context, event:pyfastcgi.Event):
     orig_handler(context, event)
 
     if event.name == 'ACCEPT':
-        accepted = context.get_stats('socket-accepted')
-        max_request = context.extra['max_request']
+        check_recycle(context)
+
+    elif event.name == 'IDLE':
+        check_recycle(context)
 
-        if accepted > max_request:
-            print('accept exceeded max-request', file=sys.stderr)
-            context.loop = False
+    elif event.name == 'WORKER-HUNG':
+        # watchdog により終了するので、先に代わりの子プロセスを起動してもらう
+        if not context.worker is None:
+            request_retire(context, 'request-terminate-timeout')
 
     elif event.name == 'LISTEN':
-        gen_subprocess(context)
+        gen_subprocess(context, event.data)
 
     elif event.name == 'STOP-LISTENER':
         pid = os.getpid()
 
         if context.pid != pid:
-            print(f'subprocess exit pid={pid}', file=sys.stderr)
+            log.prefork.info(f'subprocess exit pid={pid}')
+
+            # os._exit() では atexit が実行されないので、ここで出力しておく
+            log.flush()
             os._exit(0)
 
 
@@ -196,29 +665,76 @@ def make_context(config:collections.Mapping):
     parser.add_argument('--app-path', dest='app_path', default='app.py', help='load application full-path')
     parser.add_argument('--event-handler', dest='event_handler', default='event_handler', help='event_handler func name in app')
     parser.add_argument('--responder', dest='responder_factory', default='Responder', help='responder class name in app')
-    parser.add_argument('--procs', dest='procs', type=int, default=1, help='number of processes')
-    parser.add_argument('--max-request', dest='max_request', type=int, default=sys.maxsize, help='request-limit per process')
+    parser.add_argument('--procs', dest='procs', type=int, default=0, help='number of processes, max on dynamic/ondemand (0: by cpu and memory limit)')
+    parser.add_argument('--pm', dest='pm', choices=(PM_STATIC, PM_DYNAMIC, PM_ONDEMAND), default=PM_STATIC, help='process manager')
+    parser.add_argument('--pm-start-servers', dest='pm_start_servers', type=int, default=-1, help='number of processes at start (dynamic)')
+    parser.add_argument('--pm-min-spare', dest='pm_min_spare', type=int, default=-1, help='minimum number of idle processes (dynamic)')
+    parser.add_argument('--pm-max-spare', dest='pm_max_spare', type=int, default=-1, help='maximum number of idle processes (dynamic)')
+    parser.add_argument('--pm-idle-timeout', dest='pm_idle_timeout', type=float, default=10.0, help='seconds after which an idle process will be killed (ondemand)')
+    parser.add_argument('--pm-worker-memory', dest='pm_worker_memory', type=int, default=64, help='expected MB per process, to derive --procs from memory limit')
+    parser.add_argument('--max-request', dest='max_request', type=int, default=0, help='recycle process after this many requests (0: disable)')
+    parser.add_argument('--max-age', dest='max_age', type=float, default=0, help='recycle process after this many seconds (0: disable)')
+    parser.add_argument('--max-rss-growth', dest='max_rss_growth', type=int, default=0, help='recycle process when RSS grows this many MB from start (0: disable)')
+    parser.add_argument('--recycle-jitter', dest='recycle_jitter', type=float, default=0.1, help='add random 0..N ratio to each recycle limit per process')
+    parser.add_argument('--graceful-timeout', dest='graceful_timeout', type=float, default=10.0, help='wait for sub-processes to finish requests before SIGKILL')
+    parser.add_argument('--report-interval', dest='report_interval', type=float, default=60.0, help='interval of accept distribution report (0: disable)')
     cmdargs, _ = parser.parse_known_args()
 
-    config['extra']['procs'] = cmdargs.procs
-    config['extra']['max_request'] = cmdargs.max_request
+    procs = cmdargs.procs or cgroup.default_procs(cmdargs.pm_worker_memory * 1024 * 1024)
+    start_servers, min_spare, max_spare = procs, 0, procs
 
-    # https://www.delftstack.com/ja/howto/python/import-python-file-from-path/
+    if cmdargs.pm == PM_DYNAMIC:
+        # php-fpm と同様の既定値
+        min_spare = cmdargs.pm_min_spare if cmdargs.pm_min_spare >= 0 else 1
+        max_spare = cmdargs.pm_max_spare if cmdargs.pm_max_spare >= 0 else max(min_spare, procs // 2)
+        start_servers = cmdargs.pm_start_servers if cmdargs.pm_start_servers >= 0 else min_spare + (max_spare - min_spare) // 2
 
-    app_name = os.path.splitext(os.path.basename(cmdargs.app_path))[0]
-    spec = importlib.util.spec_from_file_location(app_name, cmdargs.app_path)
-    app_mod = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(app_mod)
+        if not 0 < min_spare <= max_spare <= procs or not min_spare <= start_servers <= max_spare:
+            parser.error(f'invalid pm settings: {min_spare=} <= {start_servers=} <= {max_spare=} <= {procs=}')
+
+    elif cmdargs.pm == PM_ONDEMAND:
+        # SO_REUSEPORT の場合は親プロセスで接続を検知できないので最低一つは残す
+        start_servers = 1 if config['reuseport'] and type(config['bind_addr']) != str else 0
+
+    config['extra']['procs'] = procs
+    config['extra']['pm'] = cmdargs.pm
+    config['extra']['pm_start_servers'] = start_servers
+    config['extra']['pm_min_spare'] = min_spare
+    config['extra']['pm_max_spare'] = max_spare
+    config['extra']['pm_idle_timeout'] = cmdargs.pm_idle_timeout
+    config['extra']['max_request'] = cmdargs.max_request
+    config['extra']['max_age'] = cmdargs.max_age
+    config['extra']['max_rss_growth'] = cmdargs.max_rss_growth * 1024 * 1024
+    config['extra']['recycle_jitter'] = cmdargs.recycle_jitter
+    config['extra']['graceful_timeout'] = cmdargs.graceful_timeout
+    config['extra']['report_interval'] = cmdargs.report_interval
+    config['extra']['app_path'] = None if (config['proxy_backends'] or config['asgi_app']) and not os.path.exists(cmdargs.app_path) else os.path.abspath(cmdargs.app_path)
+    config['extra']['event_handler'] = cmdargs.event_handler
+    config['extra']['responder_factory'] = cmdargs.responder_factory
+
+    orig_handler, responder_factory = load_app(config['extra']['app_path'], cmdargs.event_handler, cmdargs.responder_factory)
 
     has_fork = platform.system() in ('Linux', 'Darwin', )
 
-    orig_handler = getattr(app_mod, cmdargs.event_handler)
     ev_handler = functools.partial(event_handler_hook, orig_handler) if has_fork else orig_handler
 
-    responder_factory = getattr(app_mod, cmdargs.responder_factory)
-
     context = pyfastcgi.make_context(config, event_handler=ev_handler, responder_factory=responder_factory)
-    print(f'{context=}', file=sys.stderr)
+
+    # fork 前に共有メモリを確保する
+    # (reload や入れ替え中は新旧の子プロセスが同時に存在するので 2 倍)
+    context.scoreboard = scoreboard.make_scoreboard(procs * 2)
+
+    if context.cache_shared and context.cache_max_bytes > 0:
+        # 応答のキャッシュも子プロセス間で共有する
+        context.cache = shmcache.make_shared_cache(context)
+
+    if context.reuseport and not pyfastcgi.listener.use_reuseport(context):
+        '''
+        SO_REUSEPORT で分散できないので、共有した待ち受けソケットの accept を排他する
+        '''
+        context.accept_lock = multiprocessing.Lock()
+
+    log.prefork.debug(f'{context=}')
 
     '''
     https://linuxjm.osdn.jp/html/LDP_man-pages/man7/signal.7.html
@@ -228,6 +744,10 @@ def make_context(config:collections.Mapping):
     signal.signal(signal.SIGTERM, sig_handler)
     signal.signal(signal.SIGINT, sig_handler)
 
+    if context.profile_requests:
+        # プロファイリングの開始は子プロセスに送る (親プロセスが誤って受けても終了しないように)
+        signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
     return context
 
 
@@ -0,0 +1,77 @@
+import socket
+import struct
+
+
+'''
+待ち受けキュー (listen backlog) の状態をカーネルから読む (Linux)
+
+    listen_queue()      ... TCP_INFO (LISTEN 状態では tcpi_unacked が accept 待ちの接続数、
+                            tcpi_sacked が backlog の上限)
+    listen_overflows()  ... /proc/net/netstat の TcpExt: ListenOverflows, ListenDrops
+                            (ネットワーク名前空間全体の累計なので、他のプロセスの分も含む)
+
+* unix-domain-socket や Linux 以外では取得できない (None, 空の dict)
+'''
+
+NETSTAT_PATH = '/proc/net/netstat'
+
+# struct tcp_info の先頭 (u8 x 8, u32 rto, ato, snd_mss, rcv_mss, unacked, sacked)
+_TCP_INFO_HEAD = struct.Struct('=8B6I')
+
+NETSTAT_KEYS = {
+    'ListenOverflows':  'listen_overflows',
+    'ListenDrops':      'listen_drops',
+}
+
+
+def listen_queue(ssock:socket.socket) -> tuple:
+    '''
+    (accept 待ちの接続数, backlog の上限)
+    '''
+    if ssock.family == socket.AF_UNIX or not hasattr(socket, 'TCP_INFO'):
+        return None
+
+    try:
+        data = ssock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, _TCP_INFO_HEAD.size)
+
+    except OSError:
+        return None
+
+    if len(data) < _TCP_INFO_HEAD.size:
+        return None
+
+    a = _TCP_INFO_HEAD.unpack(data)
+
+    return a[12], a[13]
+
+
+def listen_overflows(path:str=NETSTAT_PATH) -> dict:
+    '''
+    { 'listen_overflows': n, 'listen_drops': n }
+
+    /proc/net/netstat は見出しと値の行が交互に並ぶ
+
+        TcpExt: SyncookiesSent ... ListenOverflows ListenDrops ...
+        TcpExt: 0 ... 12 12 ...
+    '''
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+
+    except OSError:
+        return {}
+
+    result = {}
+
+    for names, values in zip(lines[0::2], lines[1::2]):
+        if not names.startswith('TcpExt:'):
+            continue
+
+        for name, value in zip(names.split()[1:], values.split()[1:]):
+            if name in NETSTAT_KEYS:
+                result[NETSTAT_KEYS[name]] = int(value)
+
+    return result
+
+
+# EOF
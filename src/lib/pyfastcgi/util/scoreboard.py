@@ -0,0 +1,403 @@
+import ctypes
+import dataclasses
+import multiprocessing.sharedctypes
+import threading
+import time
+import pyfastcgi.histogram as histogram
+from dataclasses import dataclass
+
+
+STATE_STARTING  = 0
+STATE_READY     = 1
+STATE_RETIRING  = 2     # 入れ替えを要求中 (親プロセスが代わりを起動したら終了させる)
+
+# 子プロセス毎に記録する route (responder のクラス) の数 (最後の一つは ROUTE_OTHER 用)
+MAX_ROUTES = 8
+ROUTE_NAME_LEN = 64
+
+
+'''
+route 毎、処理段階毎の処理時間のヒストグラム (histogram.PHASES の順)
+'''
+class RouteLatency(ctypes.Structure):
+    _fields_ = (
+        ('name',    ctypes.c_char * ROUTE_NAME_LEN),
+        ('counts',  (ctypes.c_uint64 * histogram.NBUCKETS) * len(histogram.PHASES)),
+        ('sums',    ctypes.c_uint64 * len(histogram.PHASES)),  # usec
+    )
+
+
+def claim_route(table, name:str) -> RouteLatency:
+    '''
+    {name} の route の領域を返す (無ければ空いている領域を割り当てる)
+    '''
+    bname = name.encode('utf-8')[:ROUTE_NAME_LEN - 1]
+
+    for entry in table[:-1]:
+        if entry.name == bname:
+            return entry
+
+        if not entry.name:
+            entry.name = bname
+            return entry
+
+    entry = table[len(table) - 1]
+    entry.name = histogram.ROUTE_OTHER.encode('utf-8')
+
+    return entry
+
+
+'''
+prefork の親子プロセス間で共有するワーカーの状態表
+
+fork 前に親プロセスが共有メモリ上に確保し、子プロセスは割り当てられたスロットにのみ書き込む
+'''
+class WorkerSlot(ctypes.Structure):
+    _fields_ = (
+        ('pid',         ctypes.c_int64),        # 0: 未使用, -1: 予約済 (fork 中)
+        ('generation',  ctypes.c_int64),
+        ('state',       ctypes.c_int64),        # STATE_*
+        ('accepted',    ctypes.c_uint64),
+        ('ok',          ctypes.c_uint64),
+        ('ng',          ctypes.c_uint64),
+        ('bytes_in',    ctypes.c_uint64),
+        ('bytes_out',   ctypes.c_uint64),
+        ('cache_hit',   ctypes.c_uint64),
+        ('cache_stale', ctypes.c_uint64),
+        ('cache_miss',  ctypes.c_uint64),
+        ('cache_bytes', ctypes.c_int64),        # 応答のキャッシュ (--cache-max-bytes) の使用量
+        ('coalesced',   ctypes.c_uint64),       # 同じリクエストの応答を待って返した数 (--coalesce)
+        ('coalesce_fallback', ctypes.c_uint64), # 待った後に自分で処理した数
+        ('active',      ctypes.c_int64),        # 処理中のリクエスト数
+        ('queued',      ctypes.c_int64),        # 処理待ちのリクエスト数
+        ('listen_queue', ctypes.c_int64),       # accept 待ちの接続数 (カーネルの accept キュー、最後に読んだ値)
+        ('listen_queue_max', ctypes.c_int64),   # listen_queue の最大値
+        ('listen_backlog', ctypes.c_int64),     # accept キューの上限 (--backlog、カーネルの上限で切り詰められた値)
+        ('started',     ctypes.c_double),       # 起動した時刻 (time.time())
+        ('last_request', ctypes.c_double),      # 最後にリクエストを受け付けた時刻 (time.time())
+        ('last_active', ctypes.c_double),       # 最後にリクエストを開始/終了した時刻 (time.time())
+        ('latency',     RouteLatency * MAX_ROUTES),
+    )
+
+
+'''
+プール全体の状態
+
+終了した子プロセスの値は free() の際に親プロセスが retired_* に加算するので、
+子プロセスが入れ替わってもプール全体の累計は失われない
+'''
+class PoolStats(ctypes.Structure):
+    _fields_ = (
+        ('started',             ctypes.c_double),
+        ('retired_accepted',    ctypes.c_uint64),
+        ('retired_ok',          ctypes.c_uint64),
+        ('retired_ng',          ctypes.c_uint64),
+        ('retired_bytes_in',    ctypes.c_uint64),
+        ('retired_bytes_out',   ctypes.c_uint64),
+        ('retired_cache_hit',   ctypes.c_uint64),
+        ('retired_cache_stale', ctypes.c_uint64),
+        ('retired_cache_miss',  ctypes.c_uint64),
+        ('retired_coalesced',   ctypes.c_uint64),
+        ('retired_coalesce_fallback', ctypes.c_uint64),
+        ('retired_processes',   ctypes.c_uint64),
+        ('cache_bytes',         ctypes.c_int64),    # 共有の応答のキャッシュ (--cache-shared) の使用量
+        ('retired_latency',     RouteLatency * MAX_ROUTES),
+    )
+
+
+# 累計値として扱う項目 (WorkerSlot と PoolStats.retired_* で共通)
+COUNTERS = ('accepted', 'ok', 'ng', 'bytes_in', 'bytes_out', 'cache_hit', 'cache_stale', 'cache_miss', 'coalesced', 'coalesce_fallback')
+
+
+# 処理中のスレッドが数え、Worker.publish() でスロットに書き込む項目 (accepted は待ち受けのスレッドが直接書き込む)
+SHARD_COUNTERS = tuple(( name for name in COUNTERS if name != 'accepted' ))
+
+
+@dataclass
+class _Shard:
+    '''
+    スレッド毎の累計 (自スレッドしか書き込まないので排他しない)
+
+        latency ... { route: { (処理段階の位置, バケットの位置): 件数 } }
+        sums    ... { route: [ 処理段階毎の合計 (usec) ] }
+    '''
+    counts:dict = dataclasses.field(default_factory=lambda: dict.fromkeys(SHARD_COUNTERS + ('begun', 'ended'), 0))
+    latency:dict = dataclasses.field(default_factory=dict)
+    sums:dict = dataclasses.field(default_factory=dict)
+
+
+@dataclass
+class Worker:
+    '''
+    子プロセス側から自分のスロットを更新する
+
+    リクエスト毎の加算はスレッド毎の shard (pyfastcgi.metrics と同様) に対して行い、
+    全スレッドの合計は publish() でスロットに書き込む
+    (待ち受けのスレッドから定期的に、status-path の応答前と終了時に呼ぶ)
+
+    * スロットの値は最大で publish() の間隔 (待ち受けが --so-timeout で待っている間はその秒数) 遅れる
+    * 最後にリクエストを開始/終了した時刻 (last_*) は値を書き込むだけなので直接スロットに書き込む
+    '''
+    slot:WorkerSlot
+    lock:any = dataclasses.field(init=False, default_factory=threading.Lock)
+    recycle:any = dataclasses.field(init=False, default=None)
+    routes:dict = dataclasses.field(init=False, default_factory=dict)
+    listen_sampled:float = dataclasses.field(init=False, default=0.0)
+    _local:any = dataclasses.field(init=False, repr=False, default_factory=threading.local)
+    _shards:list = dataclasses.field(init=False, repr=False, default_factory=list)
+
+    def _shard(self) -> _Shard:
+        shard = getattr(self._local, 'shard', None)
+
+        if shard is None:
+            shard = _Shard()
+            self._local.shard = shard
+
+            with self.lock:
+                self._shards.append(shard)
+
+        return shard
+
+    def begin_request(self):
+        self._shard().counts['begun'] += 1
+        self.slot.last_request = self.slot.last_active = time.time()
+
+    def end_request(self, bytes_in:int=0, bytes_out:int=0):
+        counts = self._shard().counts
+        counts['ended'] += 1
+        counts['bytes_in'] += bytes_in
+        counts['bytes_out'] += bytes_out
+
+        self.slot.last_active = time.time()
+
+    def count_response(self, ok:bool):
+        self._shard().counts['ok' if ok else 'ng'] += 1
+
+    def count_cache(self, result:str):
+        '''
+        result は pyfastcgi.cache.RESULT_* ('hit', 'stale', 'miss')
+        '''
+        self._shard().counts['cache_' + result] += 1
+
+    def cache_usage(self, nbytes:int):
+        self.slot.cache_bytes = nbytes
+
+    def count_coalesced(self, served:bool):
+        self._shard().counts['coalesced' if served else 'coalesce_fallback'] += 1
+
+    def listen_queue(self, depth:int, backlog:int):
+        self.slot.listen_queue = depth
+        self.slot.listen_queue_max = max(self.slot.listen_queue_max, depth)
+        self.slot.listen_backlog = backlog
+
+    def record_timing(self, route:str, usecs:dict):
+        shard = self._shard()
+        latency = shard.latency.get(route)
+
+        if latency is None:
+            # publish() は latency から sums を引くので sums を先に作る
+            shard.sums[route] = [0] * len(histogram.PHASES)
+            latency = shard.latency[route] = {}
+
+        sums = shard.sums[route]
+
+        for n, phase in enumerate(histogram.PHASES):
+            usec = usecs.get(phase)
+
+            if not usec is None:
+                key = (n, histogram.bucket_index(usec))
+                latency[key] = latency.get(key, 0) + 1
+                sums[n] += usec
+
+    def publish(self):
+        '''
+        全スレッドの累計をスロットに書き込む
+        '''
+        with self.lock:
+            shards = list(self._shards)
+
+            totals = dict.fromkeys(shards[0].counts if shards else (), 0)
+            entries = {}
+
+            for shard in shards:
+                for name, value in list(shard.counts.items()):
+                    totals[name] += value
+
+                for route, latency in list(shard.latency.items()):
+                    entry = self.routes.get(route)
+
+                    if entry is None:
+                        entry = claim_route(self.slot.latency, route)
+                        self.routes[route] = entry
+
+                    # ROUTE_OTHER には複数の route が入るので、スロットの領域毎に合計する
+                    counts, sums = entries.setdefault(ctypes.addressof(entry), (entry, {}, [0] * len(histogram.PHASES)))[1:]
+
+                    for key, count in list(latency.items()):
+                        counts[key] = counts.get(key, 0) + count
+
+                    for n, usec in enumerate(list(shard.sums[route])):
+                        sums[n] += usec
+
+            for name in SHARD_COUNTERS:
+                setattr(self.slot, name, totals.get(name, 0))
+
+            self.slot.active = totals.get('begun', 0) - totals.get('ended', 0)
+
+            for entry, counts, sums in entries.values():
+                for (n, index), count in counts.items():
+                    entry.counts[n][index] = count
+
+                for n, usec in enumerate(sums):
+                    entry.sums[n] = usec
+
+
+@dataclass(frozen=True)
+class Scoreboard:
+    slots:any
+    pool:PoolStats
+
+    def alloc(self) -> int:
+        for index, slot in enumerate(self.slots):
+            if slot.pid == 0:
+                ctypes.memset(ctypes.addressof(slot), 0, ctypes.sizeof(slot))
+                slot.pid = -1
+                slot.started = time.time()
+
+                return index
+
+        raise OverflowError('no more worker-slot')
+
+    def free(self, index:int):
+        slot = self.slots[index]
+
+        for name in COUNTERS:
+            setattr(self.pool, 'retired_' + name, getattr(self.pool, 'retired_' + name) + getattr(slot, name))
+
+        self.pool.retired_processes += 1
+
+        for entry in slot.latency:
+            if not entry.name:
+                break
+
+            retired = claim_route(self.pool.retired_latency, entry.name.decode('utf-8'))
+
+            for n in range(len(histogram.PHASES)):
+                retired.sums[n] += entry.sums[n]
+
+                for index, count in enumerate(entry.counts[n]):
+                    if count:
+                        retired.counts[n][index] += count
+
+        slot.pid = 0
+
+    def latency(self) -> dict:
+        '''
+        プール全体の route 毎、処理段階毎のヒストグラム
+
+            { route: { phase: (counts, sum), ... }, ... }
+
+        * 全 route の合計を histogram.ROUTE_ALL として含む
+        '''
+        counts = {}
+        sums = {}
+        tables = [ self.pool.retired_latency ] + [ slot.latency for slot in self.slots if slot.pid > 0 ]
+
+        for table in tables:
+            for entry in table:
+                if not entry.name:
+                    continue
+
+                for route in (entry.name.decode('utf-8'), histogram.ROUTE_ALL):
+                    route_counts = counts.setdefault(route, [ [0] * histogram.NBUCKETS for _ in histogram.PHASES ])
+                    route_sums = sums.setdefault(route, [0] * len(histogram.PHASES))
+
+                    for n in range(len(histogram.PHASES)):
+                        route_sums[n] += entry.sums[n]
+
+                        for index, count in enumerate(entry.counts[n]):
+                            route_counts[n][index] += count
+
+        merged = {}
+
+        for route, route_counts in counts.items():
+            merged[route] = {
+                phase: (route_counts[n], sums[route][n]) for n, phase in enumerate(histogram.PHASES) if any(route_counts[n])
+            }
+
+        return merged
+
+    def snapshot(self) -> dict:
+        '''
+        プール全体と子プロセス毎の状態 (status-path の応答用)
+
+        * 子プロセスは排他せずに書き込んでいるため、厳密に同一時点の値ではない
+        '''
+        now = time.time()
+        procs = []
+
+        for slot in self.slots:
+            if slot.pid <= 0:
+                continue
+
+            a = { name: getattr(slot, name) for name, _ in WorkerSlot._fields_ if name != 'latency' }
+            a['uptime'] = now - slot.started
+            procs.append(a)
+
+        totals = { name: getattr(self.pool, 'retired_' + name) + sum(( a[name] for a in procs )) for name in COUNTERS }
+
+        pool = {
+            'started':      self.pool.started,
+            'uptime':       now - self.pool.started,
+            'processes':    len(procs),
+            'ready':        sum(( 1 for a in procs if a['state'] == STATE_READY )),
+            'active':       sum(( a['active'] for a in procs )),
+            'queued':       sum(( a['queued'] for a in procs )),
+            'cache_bytes':  self.pool.cache_bytes + sum(( a['cache_bytes'] for a in procs )),
+            # 待ち受けソケットを共有している場合と SO_REUSEPORT で分けている場合があるので、最も長いキューの値
+            'listen_queue': max(( a['listen_queue'] for a in procs ), default=0),
+            'listen_queue_max': max(( a['listen_queue_max'] for a in procs ), default=0),
+            'listen_backlog': max(( a['listen_backlog'] for a in procs ), default=0),
+            'retired_processes': self.pool.retired_processes,
+            **totals,
+        }
+
+        latency = {
+            route: { phase: histogram.summarize(counts, usec_sum) for phase, (counts, usec_sum) in phases.items() }
+                for route, phases in self.latency().items()
+        }
+
+        return { 'pool': pool, 'latency': latency, 'processes': procs }
+
+    def find(self, pid:int) -> int:
+        for index, slot in enumerate(self.slots):
+            if slot.pid == pid:
+                return index
+
+        return -1
+
+    def accept_distribution(self) -> dict:
+        return { slot.pid: slot.accepted for slot in self.slots if slot.pid > 0 }
+
+    def report(self) -> str:
+        dist = self.accept_distribution()
+        total = sum(dist.values())
+
+        if not total:
+            return 'accept distribution: no accepted'
+
+        mean = total / len(dist)
+        a = ', '.join(( f'{pid}={n}({n * 100 / total:.1f}%)' for pid, n in dist.items() ))
+
+        # max/mean が 1.0 に近いほど均等に分散している
+        return f'accept distribution: {total=} max/mean={max(dist.values()) / mean:.2f} [{a}]'
+
+
+def make_scoreboard(nslots:int) -> Scoreboard:
+    pool = multiprocessing.sharedctypes.RawValue(PoolStats)
+    pool.started = time.time()
+
+    return Scoreboard(multiprocessing.sharedctypes.RawArray(WorkerSlot, nslots), pool)
+
+
+# EOF
@@ -0,0 +1,446 @@
+import os
+import ctypes
+import dataclasses
+import hashlib
+import mmap
+import multiprocessing
+import struct
+import time
+import pyfastcgi
+import pyfastcgi.cache as cache
+import pyfastcgi.log as log
+from dataclasses import dataclass
+
+
+'''
+prefork の子プロセス間で共有する応答のキャッシュ (--cache-shared)
+
+fork 前に親プロセスが無名の共有メモリ (mmap) を確保し、子プロセスはそれを引き継ぐ
+(一つの子プロセスで保存した応答を全ての子プロセスが返せる)
+
+    ヘッダ (CacheHeader)
+    索引 (CacheSlot * nbuckets)     ... open addressing (線形探索)、削除は後ろの要素を詰める
+    データ (page_size * npages)     ... ページをチャンクの大きさ (MIN_CHUNK の 2 のべき乗倍) 毎の
+                                        クラスに割り当て、一つの応答 (キー + レコード) を一つのチャンクに置く
+
+* 書き込み (保存、削除、追い出し) は一つのプロセス間のロックで排他する
+* 読み込みはロックを取らず、索引の要素毎の seq (seqlock) で書き込み中や入れ替わりを検出して読み直す
+  (読み込んだ内容は seq を確認してから送信するので、レコードは一度だけ bytes に複写する)
+* 空きチャンクが無い場合は、同じクラスの応答を clock (参照されたものは一周待つ) で追い出す
+* ページは一度クラスに割り当てると戻さない (応答の大きさの分布が大きく変わると使われない領域が残る)
+* 時刻は time.monotonic() (Linux では全プロセスで共通の CLOCK_MONOTONIC)
+* reload (SIGHUP) しても共有メモリは親プロセスが保持したままなので、保存済の応答は有効期間まで残る
+* ロックを持ったまま子プロセスが終了した場合は、親プロセスがその子プロセスを回収する際に
+  保存済の応答を全て破棄してロックを解放する (CacheHeader.owner で判断する)
+'''
+
+MIN_CHUNK = 512
+MAX_CHUNK = 1024 * 1024
+
+# ページを分割するクラスの数 (MIN_CHUNK .. MAX_CHUNK)
+NCLASSES = (MAX_CHUNK // MIN_CHUNK).bit_length()
+
+# 読み込み中に書き換えられた場合に読み直す回数 (超えたら保存されていないものとする)
+READ_RETRIES = 3
+
+# 書き込みのロックを待つ最大時間 (秒)
+# ロックを持ったまま子プロセスが終了 (watchdog の os._exit()、SIGKILL) すると親プロセスが回収するまで
+# 解放されないため、待ちきれなければ保存されていないもの (lookup) / 保存しないもの (store) として処理を続ける
+LOCK_TIMEOUT = 0.1
+
+# ロックを待ちきれなかった警告を出力する間隔 (秒)
+LOCK_WARN_INTERVAL = 10.0
+
+_FREE_NEXT = struct.Struct('=q')
+
+
+class CacheHeader(ctypes.Structure):
+    _fields_ = (
+        ('nbuckets',    ctypes.c_uint64),
+        ('page_size',   ctypes.c_uint64),
+        ('npages',      ctypes.c_uint64),
+        ('pages_used',  ctypes.c_uint64),
+        ('clock_hand',  ctypes.c_uint64),
+        ('nbytes',      ctypes.c_int64),                    # 保存しているレコードのバイト数
+        ('nentries',    ctypes.c_int64),
+        ('owner',       ctypes.c_int64),                    # ロックを持っているプロセスの pid (0: 無し)
+        ('free_chunks', ctypes.c_int64 * NCLASSES),         # クラス毎の空きチャンクのリストの先頭 (-1: 無し)
+    )
+
+
+class CacheSlot(ctypes.Structure):
+    _fields_ = (
+        ('seq',         ctypes.c_uint32),                   # 奇数: 書き込み中
+        ('used',        ctypes.c_uint8),
+        ('referenced',  ctypes.c_uint8),                    # clock の参照ビット
+        ('sclass',      ctypes.c_uint8),
+        ('requestId',   ctypes.c_uint16),
+        ('hash',        ctypes.c_uint64),
+        ('chunk',       ctypes.c_int64),                    # データ領域の offset
+        ('key_len',     ctypes.c_uint32),
+        ('data_len',    ctypes.c_uint32),
+        ('expires',     ctypes.c_double),
+        ('stale_until', ctypes.c_double),
+        ('revalidating', ctypes.c_double),
+    )
+
+
+# 索引の要素を移動する際に複写する項目
+SLOT_VALUES = tuple(( name for name, _ in CacheSlot._fields_ if name != 'seq' ))
+
+
+def hash_key(kb:bytes) -> int:
+    return int.from_bytes(hashlib.blake2b(kb, digest_size=8).digest(), 'little')
+
+
+def chunk_class(size:int) -> int:
+    sclass = 0
+
+    while (MIN_CHUNK << sclass) < size:
+        sclass += 1
+
+    return sclass
+
+
+@dataclass
+class SharedResponseCache(cache.ResponseCache):
+    mm:mmap.mmap = dataclasses.field(init=False, default=None)
+    mlock:any = dataclasses.field(init=False, default=None)
+    skipped:int = dataclasses.field(init=False, default=0)
+    warned_at:float = dataclasses.field(init=False, default=-LOCK_WARN_INTERVAL)
+
+    def __post_init__(self):
+        page_size = MIN_CHUNK << chunk_class(min(max(self.max_entry_bytes, MIN_CHUNK), MAX_CHUNK))
+        npages = max(self.max_bytes // page_size, 1)
+
+        # 全てのチャンクが最小のクラスでも半分以上が空いている大きさ
+        nbuckets = 1 << (max(npages * page_size // MIN_CHUNK * 2, 1024) - 1).bit_length()
+
+        slots_offset = ctypes.sizeof(CacheHeader)
+        self.data_offset = slots_offset + nbuckets * ctypes.sizeof(CacheSlot)
+
+        # 無名の mmap は MAP_SHARED なので fork 後も共有される
+        self.mm = mmap.mmap(-1, self.data_offset + npages * page_size)
+        self.mlock = multiprocessing.Lock()
+
+        self.header = CacheHeader.from_buffer(self.mm)
+        self.slots = (CacheSlot * nbuckets).from_buffer(self.mm, slots_offset)
+        self.mask = nbuckets - 1
+
+        self.header.nbuckets = nbuckets
+        self.header.page_size = page_size
+        self.header.npages = npages
+
+        for sclass in range(NCLASSES):
+            self.header.free_chunks[sclass] = -1
+
+    def _read(self, h:int, kb:bytes) -> tuple:
+        '''
+        ロックを取らずに探す (index, Entry)、無ければ None
+        '''
+        for _ in range(READ_RETRIES):
+            index = h & self.mask
+            retry = False
+
+            for _ in range(self.header.nbuckets):
+                slot = self.slots[index]
+                seq = slot.seq
+
+                if seq & 1:
+                    retry = True
+                    break
+
+                if not slot.used:
+                    return None
+
+                if slot.hash == h and slot.key_len == len(kb):
+                    offset = self.data_offset + slot.chunk + len(kb)
+                    values = (slot.requestId, slot.expires, slot.stale_until, slot.revalidating)
+
+                    stored_key = self.mm[offset-len(kb):offset]
+                    data = self.mm[offset:offset+slot.data_len]
+
+                    if slot.seq != seq:
+                        retry = True
+                        break
+
+                    if stored_key == kb:
+                        requestId, expires, stale_until, revalidating = values
+                        return index, cache.Entry(requestId, data, expires, stale_until, revalidating)
+
+                index = (index + 1) & self.mask
+
+            if not retry:
+                return None
+
+        return None
+
+    def _locate(self, h:int, kb:bytes) -> int:
+        '''
+        ロックを取った状態で探す (無ければ -1)
+        '''
+        index = h & self.mask
+
+        for _ in range(self.header.nbuckets):
+            slot = self.slots[index]
+
+            if not slot.used:
+                return -1
+
+            if slot.hash == h and slot.key_len == len(kb):
+                offset = self.data_offset + slot.chunk
+
+                if self.mm[offset:offset+len(kb)] == kb:
+                    return index
+
+            index = (index + 1) & self.mask
+
+        return -1
+
+    def _write_slot(self, slot:CacheSlot, **values):
+        slot.seq += 1
+
+        for name, value in values.items():
+            setattr(slot, name, value)
+
+        slot.seq += 1
+
+    def _free_chunk(self, sclass:int, chunk:int):
+        _FREE_NEXT.pack_into(self.mm, self.data_offset + chunk, self.header.free_chunks[sclass])
+        self.header.free_chunks[sclass] = chunk
+
+    def _remove(self, index:int):
+        slot = self.slots[index]
+
+        self._free_chunk(slot.sclass, slot.chunk)
+        self.header.nbytes -= slot.data_len
+        self.header.nentries -= 1
+
+        '''
+        後ろに続く要素のうち、本来の位置 (home) が空いた位置より前のものを詰める
+        (削除の目印を残さないので、探索は空いている要素で止められる)
+        '''
+        hole = index
+        pos = index
+
+        while True:
+            pos = (pos + 1) & self.mask
+            moving = self.slots[pos]
+
+            if not moving.used:
+                break
+
+            home = moving.hash & self.mask
+
+            if (hole <= pos and (home <= hole or home > pos)) or (hole > pos and home <= hole and home > pos):
+                self._write_slot(self.slots[hole], **{ name: getattr(moving, name) for name in SLOT_VALUES })
+                hole = pos
+
+        self._write_slot(self.slots[hole], used=0, referenced=0)
+
+    def _evict(self, sclass:int) -> bool:
+        now = time.monotonic()
+
+        for _ in range(self.header.nbuckets * 2):
+            index = self.header.clock_hand
+            self.header.clock_hand = (index + 1) & self.mask
+
+            slot = self.slots[index]
+
+            if not slot.used or slot.sclass != sclass:
+                continue
+
+            if slot.referenced and now < slot.stale_until:
+                slot.referenced = 0
+                continue
+
+            self._remove(index)
+            return True
+
+        return False
+
+    def _alloc(self, sclass:int) -> int:
+        for _ in range(2):
+            chunk = self.header.free_chunks[sclass]
+
+            if chunk >= 0:
+                self.header.free_chunks[sclass] = _FREE_NEXT.unpack_from(self.mm, self.data_offset + chunk)[0]
+                return chunk
+
+            if self.header.pages_used < self.header.npages:
+                # 新しいページをクラスのチャンクに分割する
+                page = self.header.pages_used * self.header.page_size
+                self.header.pages_used += 1
+
+                chunk_size = MIN_CHUNK << sclass
+
+                for chunk in range(page + self.header.page_size - chunk_size, page - 1, -chunk_size):
+                    self._free_chunk(sclass, chunk)
+
+                continue
+
+            if not self._evict(sclass):
+                break
+
+        return -1
+
+    def _acquire(self, op:str) -> bool:
+        if self.mlock.acquire(timeout=LOCK_TIMEOUT):
+            self.header.owner = os.getpid()
+            return True
+
+        # 子プロセスが回収されるまでは全ての書き込みで待つので、警告は LOCK_WARN_INTERVAL 毎にまとめる
+        self.skipped += 1
+        now = time.monotonic()
+
+        if now - self.warned_at >= LOCK_WARN_INTERVAL:
+            log.listener.warning('shared cache: %d operation(s) skipped (last %s), lock not acquired in %.1fs (owner pid=%d)',
+                self.skipped, op, LOCK_TIMEOUT, self.header.owner)
+
+            self.skipped = 0
+            self.warned_at = now
+
+        return False
+
+    def _release(self):
+        self.header.owner = 0
+        self.mlock.release()
+
+    def recover(self, context:pyfastcgi.Context, pid:int):
+        '''
+        子プロセス {pid} がロックを持ったまま終了していれば、親プロセスでロックを解放する
+
+        書き込みの途中で終了した可能性があるので、保存済の応答は全て破棄する
+        '''
+        if pid <= 0 or self.header.owner != pid:
+            return
+
+        log.prefork.warning('shared cache: pid=%d terminated holding the lock, drop %d entries', pid, self.header.nentries)
+
+        # 索引を 0 で埋める (使用中の要素の seq は 2 以上なので、読み込み中のプロセスは seq の変化で検出する)
+        ctypes.memset(ctypes.addressof(self.slots), 0, ctypes.sizeof(self.slots))
+
+        self.header.pages_used = 0
+        self.header.clock_hand = 0
+        self.header.nbytes = 0
+        self.header.nentries = 0
+
+        for sclass in range(NCLASSES):
+            self.header.free_chunks[sclass] = -1
+
+        self.report_usage(context)
+        self._release()
+
+    def lookup(self, key:str, params:dict) -> tuple:
+        if cache.bypass_request(params):
+            return cache.RESULT_MISS, None
+
+        kb = key.encode('utf-8')
+        h = hash_key(kb)
+
+        found = self._read(h, kb)
+        if found is None:
+            return cache.RESULT_MISS, None
+
+        index, entry = found
+        now = time.monotonic()
+
+        if now < entry.expires:
+            self.slots[index].referenced = 1
+            return cache.RESULT_HIT, entry
+
+        if not self._acquire('lookup'):
+            return cache.RESULT_MISS, None
+
+        try:
+            index = self._locate(h, kb)
+            if index < 0:
+                return cache.RESULT_MISS, None
+
+            slot = self.slots[index]
+
+            if now < slot.stale_until:
+                if now - slot.revalidating < cache.REVALIDATE_TIMEOUT:
+                    # 他のリクエスト (他の子プロセスを含む) が更新中
+                    slot.referenced = 1
+                    return cache.RESULT_STALE, entry
+
+                self._write_slot(slot, revalidating=now)
+                return cache.RESULT_MISS, None
+
+            self._remove(index)
+
+        finally:
+            self._release()
+
+        return cache.RESULT_MISS, None
+
+    def store(self, key:str, requestId:int, data:bytes, ttl:float, stale:float):
+        kb = key.encode('utf-8')
+        size = len(kb) + len(data)
+
+        if size > self.header.page_size:
+            return
+
+        h = hash_key(kb)
+        sclass = chunk_class(size)
+        now = time.monotonic()
+
+        if not self._acquire('store'):
+            return
+
+        try:
+            index = self._locate(h, kb)
+            if index >= 0:
+                self._remove(index)
+
+            chunk = self._alloc(sclass)
+            if chunk < 0:
+                log.listener.debug('shared cache: no chunk for %d bytes', size)
+                return
+
+            # 索引に載せる前にデータを書き込む
+            offset = self.data_offset + chunk
+            self.mm[offset:offset+size] = kb + data
+
+            index = h & self.mask
+            while self.slots[index].used:
+                index = (index + 1) & self.mask
+
+            self._write_slot(self.slots[index], used=1, referenced=0, sclass=sclass, requestId=requestId, hash=h, chunk=chunk,
+                key_len=len(kb), data_len=len(data), expires=now + ttl, stale_until=now + ttl + stale, revalidating=0.0)
+
+            self.header.nbytes += len(data)
+            self.header.nentries += 1
+
+        finally:
+            self._release()
+
+    def state(self) -> dict:
+        return {
+            'entries':      self.header.nentries,
+            'bytes':        self.header.nbytes,
+            'max_bytes':    self.max_bytes,
+            'pages_used':   self.header.pages_used,
+            'npages':       self.header.npages,
+            'shared':       True,
+        }
+
+    def report_usage(self, context:pyfastcgi.Context):
+        if not context.scoreboard is None:
+            context.scoreboard.pool.cache_bytes = self.header.nbytes
+
+
+def make_shared_cache(context:pyfastcgi.Context) -> SharedResponseCache:
+    '''
+    fork 前に親プロセスで確保すること
+    '''
+    shared = SharedResponseCache(context.cache_max_bytes, context.cache_ttl, context.cache_stale, context.cache_vary)
+
+    log.prefork.info('shared response cache %d bytes (%d pages x %d, %d buckets)',
+        len(shared.mm), shared.header.npages, shared.header.page_size, shared.header.nbuckets)
+
+    return shared
+
+
+# EOF
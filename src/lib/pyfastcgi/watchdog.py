@@ -0,0 +1,292 @@
+import os
+import sys
+import contextlib
+import dataclasses
+import logging
+import socket
+import threading
+import time
+import traceback
+import pyfastcgi
+import pyfastcgi.admission as admission
+import pyfastcgi.log as log
+import pyfastcgi.protocol as protocol
+from dataclasses import dataclass
+
+
+'''
+処理中のリクエストの監視
+
+1) slowlog (php-fpm の request_slowlog_timeout)
+
+    responder の処理が --slowlog-timeout 秒を超えたら、処理中のスレッドのスタックを
+    sys._current_frames() で取得してリクエストの情報と共に出力する。
+    終わるまでは --slowlog-interval 秒毎に出力を続ける。
+
+2) terminate (php-fpm の request_terminate_timeout)
+
+    処理中のスレッドから --request-terminate-timeout 秒以上 heartbeat (ソケットの送受信、
+    または heartbeat() の呼び出し) が無ければ、停止 (deadlock など) したとみなして
+
+        * 処理中のリクエストに 503 (または FCGI_END_REQUEST) を返し
+        * accept をやめ、prefork の親プロセスに代わりの子プロセスの起動を依頼し
+        * 処理待ちの接続にも 503 を返して、子プロセスを終了する
+
+    (停止したスレッドは戻せないので、子プロセス一つを失うだけで済むようにする)
+
+    prefork でない場合は代わりのプロセスが無いので終了せず、停止したリクエストに応答を
+    返して接続を切るだけにする (停止したスレッドはそのまま残る)
+
+監視用のスレッドは子プロセス毎に一つで、次に確認が必要な時刻まで待機するだけなので
+遅いリクエストが無ければほとんど動かない
+'''
+
+# 停止により子プロセスを終了する際の終了コード
+EXIT_HUNG = 3
+
+NEVER = float('inf')
+
+
+@dataclass
+class Entry:
+    thread_id:int
+    conn:socket.socket
+    requestId:int
+    params:dict
+    started:float = dataclasses.field(init=False, default_factory=time.monotonic)
+    beat:float = dataclasses.field(init=False, default=0.0)
+    slow_due:float = dataclasses.field(init=False, default=NEVER)
+    dumps:int = dataclasses.field(init=False, default=0)
+    aborted:bool = dataclasses.field(init=False, default=False)
+
+    @property
+    def heartbeat(self) -> float:
+        return max(self.started, self.beat, getattr(self.conn, 'heartbeat', 0.0))
+
+
+@dataclass
+class Watchdog:
+    context:pyfastcgi.Context
+    cond:any = dataclasses.field(init=False, default_factory=threading.Condition)
+    entries:dict = dataclasses.field(init=False, default_factory=dict)
+    thread:any = dataclasses.field(init=False, default=None)
+    queue:admission.AdmissionQueue = dataclasses.field(init=False, default=None)
+    terminating:bool = dataclasses.field(init=False, default=False)
+
+    @property
+    def slowlog_timeout(self) -> float:
+        return self.context.slowlog_timeout
+
+    @property
+    def slowlog_interval(self) -> float:
+        return self.context.slowlog_interval or self.context.slowlog_timeout
+
+    @property
+    def terminate_timeout(self) -> float:
+        return self.context.request_terminate_timeout
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='pyfastcgi-watchdog', daemon=True)
+        self.thread.start()
+
+    @contextlib.contextmanager
+    def watch(self, conn:socket.socket, requestId:int, params:dict):
+        entry = Entry(threading.get_ident(), conn, requestId, params)
+
+        if self.slowlog_timeout:
+            entry.slow_due = entry.started + self.slowlog_timeout
+
+        with self.cond:
+            self.entries[entry.thread_id] = entry
+
+            if len(self.entries) == 1:
+                # 監視対象が無く待機し続けている
+                self.cond.notify()
+
+        try:
+            yield entry
+
+        finally:
+            with self.cond:
+                self.entries.pop(entry.thread_id, None)
+
+    def heartbeat(self):
+        entry = self.entries.get(threading.get_ident())
+
+        if not entry is None:
+            entry.beat = time.monotonic()
+
+    @property
+    def prefork(self) -> bool:
+        '''
+        prefork の子プロセスか (終了しても親プロセスが代わりを起動する)
+        '''
+        return self.context.pid != os.getpid()
+
+    def terminate_due(self, entry:Entry) -> float:
+        if not self.terminate_timeout or entry.aborted:
+            return NEVER
+
+        return entry.heartbeat + self.terminate_timeout
+
+    def _run(self):
+        # 最長でもこの間隔で確認する (heartbeat により期限が延びる場合があるため)
+        max_wait = min(( a for a in (self.slowlog_timeout, self.terminate_timeout) if a ))
+
+        while True:
+            with self.cond:
+                now = time.monotonic()
+                slow = [ entry for entry in self.entries.values() if entry.slow_due <= now ]
+                hung = [ entry for entry in self.entries.values() if self.terminate_due(entry) <= now ]
+
+                if not slow and not hung:
+                    if self.entries:
+                        due = min(( min(entry.slow_due, self.terminate_due(entry)) for entry in self.entries.values() ))
+                        self.cond.wait(min(max(due - now, 0.0), max_wait))
+
+                    else:
+                        self.cond.wait()
+
+                    continue
+
+                for entry in slow:
+                    entry.slow_due = now + self.slowlog_interval
+                    entry.dumps += 1
+
+            frames = sys._current_frames()
+
+            for entry in slow:
+                self.dump(entry, frames.get(entry.thread_id), now)
+
+            if hung:
+                if self.prefork:
+                    self.terminate(hung, frames, now)
+                    return
+
+                self.abandon(hung, frames, now)
+
+    def dump(self, entry:Entry, frame, now:float, level:int=logging.WARNING, title:str='slow request'):
+        params = entry.params
+        stack = ''.join(traceback.format_stack(frame)) if not frame is None else '(no frame)\n'
+
+        log.slowlog.log(level,
+            '%s %.3f sec (#%d) thread=%d %s %s script=%s\n%s',
+            title, now - entry.started, entry.dumps, entry.thread_id,
+            params.get('REQUEST_METHOD'), params.get('REQUEST_URI'), params.get('SCRIPT_FILENAME'),
+            stack.rstrip('\n'))
+
+    def terminate(self, hung:list, frames:dict, now:float):
+        self.terminating = True
+
+        for entry in hung:
+            self.dump(entry, frames.get(entry.thread_id), now, logging.ERROR, 'request terminate timeout, no heartbeat')
+            self.abort(entry)
+
+        # accept をやめ、代わりの子プロセスを起動してもらう
+        self.context.loop = False
+        self.context.handler(pyfastcgi.Event('WORKER-HUNG', { 'hung': len(hung) }))
+
+        '''
+        停止していないリクエストは終わるまで待つ (最大 so_timeout 秒)
+        '''
+        deadline = time.monotonic() + self.context.so_timeout
+
+        while time.monotonic() < deadline:
+            with self.cond:
+                running = [ entry for entry in self.entries.values() if not entry.aborted ]
+
+                if not running:
+                    break
+
+                self.cond.wait(0.05)
+
+        with self.cond:
+            remaining = list(self.entries.values())
+
+        for entry in remaining:
+            self.abort(entry)
+
+        if not self.queue is None:
+            self.queue.reject_pending()
+
+        log.slowlog.error('exit worker, %d thread(s) hung', len(hung))
+        log.flush()
+
+        # 停止したスレッドは終了を待てないので、そのまま終了する
+        os._exit(EXIT_HUNG)
+
+    def abandon(self, hung:list, frames:dict, now:float):
+        '''
+        prefork でない場合は終了するとサーバ全体が止まるので、停止したリクエストを切るだけにする
+        '''
+        for entry in hung:
+            self.dump(entry, frames.get(entry.thread_id), now, logging.ERROR, 'request terminate timeout, no heartbeat')
+            self.abort(entry)
+
+        log.slowlog.error('abort %d hung request(s), not exiting without prefork', len(hung))
+
+    def abort(self, entry:Entry):
+        '''
+        処理中のリクエストに応答を返して接続を切る
+        (スレッドが停止しているので、そのスレッドのソケットに直接送信する)
+        '''
+        if entry.aborted:
+            return
+
+        entry.aborted = True
+
+        conn = getattr(entry.conn, 'conn', entry.conn)
+
+        try:
+            if getattr(entry.conn, 'bytes_out', 0) == 0:
+                data = admission.overloaded_records(admission.OVERLOAD_RESPONSE_HTTP, entry.requestId)
+
+            else:
+                # 応答の途中なので終了のみ
+                endreq = protocol.FCGI_EndRequestBody(1, protocol.FCGI_REQUEST_COMPLETE)
+                data = protocol.make_record(protocol.FCGI_END_REQUEST, entry.requestId, contentData=endreq.dump()).dump()
+
+            conn.sendall(data)
+
+        except OSError:
+            # ignore
+            pass
+
+        finally:
+            try:
+                # close はスレッド側で行う (fd が再利用されないように)
+                conn.shutdown(socket.SHUT_RDWR)
+
+            except OSError:
+                pass
+
+
+def start_watchdog(context:pyfastcgi.Context) -> Watchdog:
+    '''
+    prefork の場合は fork 後の子プロセスで開始すること (スレッドは fork で引き継がれない)
+    '''
+    if not context.slowlog_timeout and not context.request_terminate_timeout:
+        return None
+
+    watchdog = Watchdog(context)
+    watchdog.start()
+
+    return watchdog
+
+
+def watch(context:pyfastcgi.Context, conn:socket.socket, requestId:int, params:dict):
+    if context.watchdog is None:
+        return contextlib.nullcontext()
+
+    return context.watchdog.watch(conn, requestId, params)
+
+
+def heartbeat(context:pyfastcgi.Context):
+    '''
+    ソケットの送受信を伴わない長い処理の途中で、停止していないことを通知する
+    '''
+    if not context.watchdog is None:
+        context.watchdog.heartbeat()
+
+
+# EOF
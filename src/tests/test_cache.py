@@ -0,0 +1,43 @@
+import unittest
+import pyfastcgi
+import pyfastcgi.cache as cache
+
+
+'''
+pyfastcgi.cache
+
+    cd src
+    PYTHONPATH=lib python -m unittest discover -s tests
+'''
+
+
+class StripHeaderTest(unittest.TestCase):
+    def strip(self, payload:bytes) -> bytes:
+        return cache.strip_header(payload, pyfastcgi.CONST_SERVER_TIMING)
+
+    def test_last_header(self):
+        payload = b'Status: 200 OK\r\nContent-Length: 5\r\nServer-Timing: app;dur=0.1\r\n\r\n// js'
+        self.assertEqual(self.strip(payload), b'Status: 200 OK\r\nContent-Length: 5\r\n\r\n// js')
+
+    def test_first_header(self):
+        payload = b'server-timing: app;dur=0.1\r\nContent-Length: 5\r\n\r\n// js'
+        self.assertEqual(self.strip(payload), b'Content-Length: 5\r\n\r\n// js')
+
+    def test_lf_only(self):
+        payload = b'Content-Length: 5\nServer-Timing: app;dur=0.1\n\n// js'
+        self.assertEqual(self.strip(payload), b'Content-Length: 5\n\n// js')
+
+    def test_not_found(self):
+        payload = b'Content-Length: 5\r\n\r\nServer-Timing: app'
+        self.assertIs(self.strip(payload), payload)
+
+    def test_split_headers(self):
+        payload = b'Content-Length: 5\r\nServer-Timing: app;dur=0.1\r\n\r\n// js'
+        headers = cache.split_headers(self.strip(payload))
+        self.assertEqual(headers, { 'content-length': '5' })
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# EOF